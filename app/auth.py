@@ -1,5 +1,12 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import NamedTuple, Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
@@ -8,15 +15,128 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from app.database import get_db
 from app.models import User
+from app.metrics import AUTH_SECONDS, Counter, Histogram
+from app.tracing import tracer
 
 SECRET_KEY = "secret_key_here"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_ENTRIES = int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")  # thread | process
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+logger = logging.getLogger(__name__)
+
+BCRYPT_QUEUE_WAIT_SECONDS = Histogram("fastchat_bcrypt_queue_wait_seconds", "Wait for a free password hashing slot")
+TOKEN_CACHE_LOOKUPS = Counter("fastchat_token_cache_lookups_total", "Token verification cache lookups", ["result"])
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
+class AuthenticatedUser(NamedTuple):
+    # Личность пользователя из токена: для авторизации не нужен ORM-объект User
+    id: int
+    username: str
+
+
+class TokenCache:
+    """LRU проверенных токенов по их sha256; запись живёт не дольше exp токена."""
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, dict]" = OrderedDict()
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token: str, now: Optional[float] = None) -> Optional[dict]:
+        digest = self._digest(token)
+        payload = self._entries.get(digest)
+        if payload is None:
+            return None
+        if payload["exp"] <= (time.time() if now is None else now):
+            del self._entries[digest]
+            return None
+        self._entries.move_to_end(digest)
+        return payload
+
+    def put(self, token: str, payload: dict):
+        if not isinstance(payload.get("exp"), (int, float)):
+            return
+        self._entries[self._digest(token)] = payload
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+class UserIdentityCache:
+    """username -> AuthenticatedUser с TTL. invalidate() заставляет следующую проверку сходить в БД,
+    даже если в токене уже есть id пользователя. Отметка об инвалидации живёт не дольше токена:
+    токены, выданные до неё, к этому времени истекают."""
+
+    def __init__(self, ttl: float = USER_CACHE_TTL_SECONDS, max_entries: int = USER_CACHE_MAX_ENTRIES,
+                 invalidation_ttl: float = ACCESS_TOKEN_EXPIRE_MINUTES * 60):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.invalidation_ttl = invalidation_ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # username -> момент, после которого отметка не нужна; порядок вставки совпадает с порядком истечения
+        self._invalidated: "OrderedDict[str, float]" = OrderedDict()
+
+    def get(self, username: str) -> Optional[AuthenticatedUser]:
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        user, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[username]
+            return None
+        self._entries.move_to_end(username)
+        return user
+
+    def put(self, user: AuthenticatedUser):
+        self._invalidated.pop(user.username, None)
+        self._entries[user.username] = (user, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user.username)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune_invalidated(self):
+        now = time.monotonic()
+        while self._invalidated and next(iter(self._invalidated.values())) <= now:
+            self._invalidated.popitem(last=False)
+
+    def needs_lookup(self, username: str) -> bool:
+        self._prune_invalidated()
+        return username in self._invalidated
+
+    def invalidate(self, username: str):
+        self._entries.pop(username, None)
+        self._invalidated.pop(username, None)
+        self._invalidated[username] = time.monotonic() + self.invalidation_ttl
+        self._prune_invalidated()
+
+    def clear(self):
+        self._entries.clear()
+        self._invalidated.clear()
+
+
+token_cache = TokenCache()
+user_cache = UserIdentityCache()
+
+
+def invalidate_user(username: str):
+    # Вызывать при изменении или удалении пользователя
+    user_cache.invalidate(username)
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -25,6 +145,100 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+class PasswordHasher:
+    """bcrypt вне event loop: пул потоков или процессов с ограничением одновременных вызовов.
+
+    Время ожидания свободного слота учитывается отдельно, чтобы всплески логинов были видны в метриках.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, kind: str = PASSWORD_HASH_EXECUTOR):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown password hash executor: {kind}")
+        self.workers = workers
+        self.kind = kind
+        self._executor: Optional[Executor] = None
+        self._semaphore = asyncio.Semaphore(workers)
+        self.calls = 0
+        self.waiting = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.run_time_total = 0.0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def _run(self, func, *args):
+        with tracer.span("bcrypt", operation=func.__name__) as span:
+            return await self._run_in_pool(span, func, *args)
+
+    async def _run_in_pool(self, span, func, *args):
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        started_at = time.perf_counter()
+        waited = started_at - queued_at
+        self.queue_wait_total += waited
+        self.queue_wait_max = max(self.queue_wait_max, waited)
+        BCRYPT_QUEUE_WAIT_SECONDS.observe(waited)
+        if span is not None:
+            span.set(queue_wait_ms=round(waited * 1000, 3))
+        self.calls += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            self.run_time_total += elapsed
+            AUTH_SECONDS.observe(elapsed, ("bcrypt",))
+            self._semaphore.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, plain_password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "calls": self.calls,
+            "waiting": self.waiting,
+            "queue_wait_avg": self.queue_wait_total / self.calls if self.calls else 0.0,
+            "queue_wait_max": self.queue_wait_max,
+            "run_time_avg": self.run_time_total / self.calls if self.calls else 0.0,
+        }
+
+
+password_hasher = PasswordHasher()
+
+
+async def check_password_hashing(hasher: PasswordHasher = password_hasher):
+    # Проверка при старте: параметр стоимости применяется, хеш проверяется, время одного хеша — в лог
+    if not 4 <= BCRYPT_ROUNDS <= 31:
+        raise RuntimeError(f"BCRYPT_ROUNDS must be between 4 and 31, got {BCRYPT_ROUNDS}")
+    started_at = time.perf_counter()
+    sample = await hasher.hash("startup-check")
+    elapsed = time.perf_counter() - started_at
+    rounds = int(sample.split("$")[2])
+    if rounds != BCRYPT_ROUNDS or not await hasher.verify("startup-check", sample):
+        raise RuntimeError(f"bcrypt self-check failed: expected cost {BCRYPT_ROUNDS}, got {rounds}")
+    logger.info("bcrypt cost %d: %.1f ms per hash (%s pool, %d workers)",
+                rounds, elapsed * 1000, hasher.kind, hasher.workers)
+
+
 async def get_user(db: AsyncSession, username: str) -> Optional[User]:
     result = await db.execute(select(User).where(User.username == username))
     return result.scalar_one_or_none()
@@ -34,7 +248,7 @@ async def authenticate_user(db: AsyncSession, username: str, password: str):
     user = await get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    if not await password_hasher.verify(password, user.password):
         return False
     return user
 
@@ -50,20 +264,46 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+def decode_access_token(token: str) -> dict:
+    started_at = time.perf_counter()
+    payload = token_cache.get(token)
+    if payload is not None:
+        TOKEN_CACHE_LOOKUPS.inc(1, ("hit",))
+    else:
+        TOKEN_CACHE_LOOKUPS.inc(1, ("miss",))
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        finally:
+            AUTH_SECONDS.observe(time.perf_counter() - started_at, ("jwt",))
+        token_cache.put(token, payload)
+    return payload
+
+
+@tracer.traced("auth.get_current_user")
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> AuthenticatedUser:
     credentials_exception = HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials",
             headers={"WWW-Authenticate": "Bearer"},
         )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = await get_user(db, username)
-    if user is None:
+
+    # Частый путь: id пользователя есть в токене, БД не нужна
+    user_id = payload.get("uid")
+    if isinstance(user_id, int) and not user_cache.needs_lookup(username):
+        return AuthenticatedUser(user_id, username)
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+    db_user = await get_user(db, username)
+    if db_user is None or (isinstance(user_id, int) and db_user.id != user_id):
         raise credentials_exception
+    user = AuthenticatedUser(db_user.id, db_user.username)
+    user_cache.put(user)
     return user
@@ -0,0 +1,124 @@
+import json
+import os
+from typing import AsyncIterator, Awaitable, Callable, Optional
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.requests import ClientDisconnect
+from app.database import async_session
+from app.metrics import Counter
+
+# Сколько элементов обрабатывается одной транзакцией (и одним многострочным INSERT)
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+# Предел для JSON-массива, который читается в память целиком; NDJSON обрабатывается потоком без предела
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "100000"))
+
+NDJSON_MEDIA_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+BULK_ITEMS = Counter("fastchat_bulk_items_total", "Items processed by bulk provisioning endpoints", ["kind", "result"])
+
+Batch = list[tuple[int, object]]
+ProcessBatch = Callable[[object, Batch], Awaitable[list[dict]]]
+
+
+def is_ndjson(request: Request) -> bool:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    return content_type in NDJSON_MEDIA_TYPES
+
+
+def _parse_line(line: bytes) -> Optional[object]:
+    # Битая строка не прерывает загрузку: элемент получит ошибку в своём результате
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+async def iter_ndjson(request: Request) -> AsyncIterator[object]:
+    """Элементы NDJSON по мере поступления тела запроса: весь файл в память не читается."""
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _parse_line(line)
+    if buffer.strip():
+        yield _parse_line(buffer)
+
+
+async def iter_batches(items: AsyncIterator[object], batch_size: int = BULK_BATCH_SIZE) -> AsyncIterator[Batch]:
+    batch = []
+    index = 0
+    async for item in items:
+        batch.append((index, item))
+        index += 1
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def _iter_list(items: list) -> AsyncIterator[object]:
+    for item in items:
+        yield item
+
+
+async def process_batches(kind: str, items: AsyncIterator[object], process: ProcessBatch) -> AsyncIterator[list[dict]]:
+    """Результаты по пачкам; пачка — одна транзакция. Сбой БД помечает ошибкой только свою пачку."""
+    async with async_session() as db:
+        async for batch in iter_batches(items):
+            try:
+                results = await process(db, batch)
+            except Exception as e:
+                await db.rollback()
+                results = [{"index": index, "error": str(e)} for index, _ in batch]
+            created = sum(1 for result in results if "error" not in result)
+            BULK_ITEMS.inc(created, (kind, "created"))
+            BULK_ITEMS.inc(len(results) - created, (kind, "failed"))
+            yield results
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """Потоковый ответ, который читает тело запроса, пока отдаёт результат.
+
+    Обычный StreamingResponse параллельно слушает receive и выбрасывает сообщения http.request,
+    поэтому тело, дочитываемое из генератора, теряется или ожидание зависает.
+    Здесь receive читает только генератор; разрыв соединения он увидит как ClientDisconnect.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.stream_response(send)
+        except OSError:
+            raise ClientDisconnect()
+        if self.background is not None:
+            await self.background()
+
+
+async def bulk_response(request: Request, kind: str, process: ProcessBatch):
+    """JSON-массив в теле — ответ {"created", "failed", "results"}.
+
+    NDJSON (Content-Type: application/x-ndjson) — потоковый ответ NDJSON по результату на строку:
+    загрузку на сотни тысяч элементов не нужно держать в памяти ни на сервере, ни у клиента.
+    """
+    if is_ndjson(request):
+        async def body():
+            async for results in process_batches(kind, iter_ndjson(request), process):
+                yield "".join(json.dumps(result) + "\n" for result in results).encode("utf-8")
+
+        return DuplexStreamingResponse(body(), media_type="application/x-ndjson")
+
+    try:
+        items = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BULK_MAX_ITEMS} items per request")
+    results = []
+    async for batch_results in process_batches(kind, _iter_list(items), process):
+        results.extend(batch_results)
+    failed = sum(1 for result in results if "error" in result)
+    return JSONResponse({"created": len(results) - failed, "failed": failed, "results": results})
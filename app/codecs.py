@@ -0,0 +1,101 @@
+import json
+import os
+import struct
+from typing import Dict, List, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # orjson — необязательная зависимость
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # msgpack — необязательная зависимость
+    msgpack = None
+
+Frame = Union[str, bytes]
+
+
+class CodecError(ValueError):
+    pass
+
+
+class JsonCodec:
+    name = "json"
+    binary = False
+
+    def encode(self, payload) -> Frame:
+        return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+
+    def pack_array(self, frames: List[Frame]) -> Frame:
+        # Уже закодированные события склеиваются в JSON-массив без повторной сериализации
+        return "[" + ",".join(frames) + "]"
+
+    def decode(self, data: Frame):
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise CodecError(str(e)) from e
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def encode(self, payload) -> Frame:
+        # Текстовый фрейм: тот же JSON на проводе, но сериализация в разы быстрее
+        return orjson.dumps(payload).decode("utf-8")
+
+    def decode(self, data: Frame):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            raise CodecError(str(e)) from e
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+
+    def encode(self, payload) -> Frame:
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def pack_array(self, frames: List[Frame]) -> Frame:
+        # Заголовок массива msgpack, за ним уже закодированные элементы
+        count = len(frames)
+        if count < 16:
+            header = bytes((0x90 | count,))
+        elif count < 0x10000:
+            header = b"\xdc" + struct.pack(">H", count)
+        else:
+            header = b"\xdd" + struct.pack(">I", count)
+        return header + b"".join(frames)
+
+    def decode(self, data: Frame):
+        if isinstance(data, str):
+            # Текстовые фреймы от msgpack-клиента разбираем как JSON (удобно для отладки)
+            return JSON_CODEC.decode(data)
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise CodecError(str(e)) from e
+
+
+JSON_CODEC = JsonCodec()
+
+CODECS: Dict[str, object] = {"json": JSON_CODEC}
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec()
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+DEFAULT_CODEC_NAME = os.getenv("WS_DEFAULT_CODEC", "orjson" if orjson is not None else "json")
+
+
+def get_codec(name: Optional[str] = None):
+    """Возвращает кодек по имени (None — кодек по умолчанию) или None, если он недоступен."""
+    if name is None:
+        name = DEFAULT_CODEC_NAME
+    codec = CODECS.get(name)
+    if codec is None and name == DEFAULT_CODEC_NAME:
+        return JSON_CODEC
+    return codec
@@ -0,0 +1,427 @@
+import asyncio
+import datetime
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+from sqlalchemy import delete, tuple_
+from sqlalchemy.future import select
+from app.models import Message
+from app.pagination import MessageKey
+
+logger = logging.getLogger(__name__)
+
+COLD_STORAGE_DIR = os.getenv("COLD_STORAGE_DIR", "cold_storage")
+COLD_ARCHIVE_AFTER_DAYS = float(os.getenv("COLD_ARCHIVE_AFTER_DAYS", "90"))
+# Период фонового архивирования в воркере, с (0 — только вручную: python -m app.cold_storage)
+COLD_ARCHIVE_INTERVAL_SECONDS = float(os.getenv("COLD_ARCHIVE_INTERVAL_SECONDS", "0"))
+COLD_BLOCK_MESSAGES = int(os.getenv("COLD_BLOCK_MESSAGES", "128"))
+COLD_SEGMENT_MESSAGES = int(os.getenv("COLD_SEGMENT_MESSAGES", "100000"))
+COLD_ARCHIVE_BATCH = int(os.getenv("COLD_ARCHIVE_BATCH", "1024"))
+# Как долго индекс чата считается актуальным без проверки каталога (дозапись другим процессом видна с этой задержкой)
+COLD_INDEX_CHECK_SECONDS = float(os.getenv("COLD_INDEX_CHECK_SECONDS", "1"))
+# Сколько индексов чатов держать в памяти (LRU); чаты без холодного слоя тоже занимают запись
+COLD_INDEX_CACHE_MAX_CHATS = int(os.getenv("COLD_INDEX_CACHE_MAX_CHATS", "10000"))
+
+# Запись разреженного индекса — одна на сжатый блок сегмента:
+# first_us, first_id, last_us, last_id, min_id, max_id, offset, length, count
+_INDEX_ENTRY = struct.Struct("<qqqqqqQII")
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+# Ключ в холодном слое: (created_at в микросекундах, id) — тот же порядок, что (created_at, id) в БД
+ColdKey = Tuple[int, int]
+
+
+def _to_us(value: datetime.datetime) -> int:
+    return (value - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _cold_key(key: MessageKey) -> ColdKey:
+    return _to_us(key[0]), key[1]
+
+
+def _message_key(record: dict) -> ColdKey:
+    return _to_us(datetime.datetime.fromisoformat(record["created_at"])), record["id"]
+
+
+def _from_cold_key(key: ColdKey) -> MessageKey:
+    return _EPOCH + datetime.timedelta(microseconds=key[0]), key[1]
+
+
+def _to_message(record: dict) -> Message:
+    return Message(
+        id=record["id"],
+        chat_id=record["chat_id"],
+        sender_id=record["sender_id"],
+        text=record["text"],
+        created_at=datetime.datetime.fromisoformat(record["created_at"]),
+        is_read=record["is_read"],
+        client_msg_id=record.get("client_msg_id"),
+    )
+
+
+class Block(NamedTuple):
+    segment: str
+    first_key: ColdKey
+    last_key: ColdKey
+    min_id: int
+    max_id: int
+    offset: int
+    length: int
+    count: int
+
+
+class ColdBoundary(NamedTuple):
+    count: int
+    # Ключ последнего сообщения: в БД читаются только сообщения новее него
+    last_key: Optional[MessageKey]
+    max_id: int
+
+
+_NO_COLD = ColdBoundary(0, None, 0)
+
+
+class _ChatIndex:
+    def __init__(self, signature: tuple, blocks: List[Block]):
+        # signature — размеры индексных файлов: по ней видно, что другой процесс дописал сегмент
+        self.signature = signature
+        self.blocks = blocks
+        # Позиция первого сообщения каждого блока в истории чата
+        self.starts: List[int] = []
+        self.first_keys = [block.first_key for block in blocks]
+        self.last_keys = [block.last_key for block in blocks]
+        total = 0
+        for block in blocks:
+            self.starts.append(total)
+            total += block.count
+        self.count = total
+        self.max_id = max((block.max_id for block in blocks), default=0)
+
+    @property
+    def last_key(self) -> Optional[ColdKey]:
+        return self.blocks[-1].last_key if self.blocks else None
+
+
+class ColdStore:
+    """Холодный слой истории: старые сообщения чата в сжатых сегментах только на дозапись.
+
+    Каталог чата содержит пары файлов NNNNNN.seg / NNNNNN.idx. Сегмент — последовательность
+    zlib-блоков NDJSON по COLD_BLOCK_MESSAGES сообщений в порядке (created_at, id).
+    Индекс — записи фиксированной длины (первый/последний id и время, смещение блока),
+    читаются через mmap. Сначала на диск пишется блок, затем запись индекса: всё, что
+    видно в индексе, уже целиком лежит в сегменте.
+
+    Каталог чата проверяется не чаще раза в COLD_INDEX_CHECK_SECONDS, и только в пуле потоков
+    (boundary); в остальное время граница слоёв берётся из памяти. Своя дозапись сбрасывает проверку сразу.
+    """
+
+    def __init__(self, root: str = COLD_STORAGE_DIR, block_messages: int = COLD_BLOCK_MESSAGES,
+                 segment_messages: int = COLD_SEGMENT_MESSAGES, check_seconds: float = COLD_INDEX_CHECK_SECONDS,
+                 max_chats: int = COLD_INDEX_CACHE_MAX_CHATS):
+        self.root = root
+        self.block_messages = block_messages
+        self.segment_messages = segment_messages
+        self.check_seconds = check_seconds
+        self.max_chats = max_chats
+        # chat_id -> (момент проверки каталога, индекс); None — у чата нет холодного слоя
+        self._indexes: "OrderedDict[int, Tuple[float, Optional[_ChatIndex]]]" = OrderedDict()
+        # Индексы читаются и из пула потоков
+        self._lock = threading.Lock()
+
+    def _chat_dir(self, chat_id: int) -> str:
+        return os.path.join(self.root, str(chat_id))
+
+    def _cached(self, chat_id: int) -> Tuple[bool, Optional[_ChatIndex]]:
+        # (индекс актуален, последний прочитанный индекс)
+        with self._lock:
+            entry = self._indexes.get(chat_id)
+            if entry is None:
+                return False, None
+            checked_at, index = entry
+            if time.monotonic() - checked_at >= self.check_seconds:
+                return False, index
+            self._indexes.move_to_end(chat_id)
+            return True, index
+
+    def _store(self, chat_id: int, index: Optional[_ChatIndex]):
+        with self._lock:
+            self._indexes[chat_id] = (time.monotonic(), index)
+            self._indexes.move_to_end(chat_id)
+            while len(self._indexes) > self.max_chats:
+                self._indexes.popitem(last=False)
+
+    def _expire(self, chat_id: int):
+        with self._lock:
+            self._indexes.pop(chat_id, None)
+
+    def _index(self, chat_id: int) -> Optional[_ChatIndex]:
+        fresh, cached = self._cached(chat_id)
+        if fresh:
+            return cached
+        directory = self._chat_dir(chat_id)
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith(".idx"))
+        except FileNotFoundError:
+            self._store(chat_id, None)
+            return None
+        paths = [os.path.join(directory, name) for name in names]
+        signature = tuple((path, os.path.getsize(path)) for path in paths)
+        if cached is not None and cached.signature == signature:
+            index = cached
+        else:
+            blocks = []
+            for path, size in signature:
+                blocks.extend(self._read_index(path, size))
+            index = _ChatIndex(signature, blocks)
+        self._store(chat_id, index)
+        return index
+
+    async def boundary(self, chat_id: int) -> ColdBoundary:
+        """Сводка холодного слоя чата из памяти; проверка каталога, если пора, — в пуле потоков."""
+        fresh, index = self._cached(chat_id)
+        if not fresh:
+            index = await asyncio.to_thread(self._index, chat_id)
+        if index is None or index.last_key is None:
+            return _NO_COLD
+        return ColdBoundary(index.count, _from_cold_key(index.last_key), index.max_id)
+
+    @staticmethod
+    def _read_index(path: str, size: int) -> List[Block]:
+        # Недописанная запись в конце (сбой во время архивирования) игнорируется
+        entries = size // _INDEX_ENTRY.size
+        if not entries:
+            return []
+        segment = path[:-4] + ".seg"
+        blocks = []
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for position in range(entries):
+                (first_us, first_id, last_us, last_id, min_id, max_id,
+                 offset, length, count) = _INDEX_ENTRY.unpack_from(mapped, position * _INDEX_ENTRY.size)
+                blocks.append(Block(
+                    segment, (first_us, first_id), (last_us, last_id), min_id, max_id, offset, length, count
+                ))
+        return blocks
+
+    @staticmethod
+    def _read_block(block: Block) -> List[dict]:
+        with open(block.segment, "rb") as f:
+            data = os.pread(f.fileno(), block.length, block.offset)
+        return [json.loads(line) for line in zlib.decompress(data).splitlines()]
+
+    def count(self, chat_id: int) -> int:
+        index = self._index(chat_id)
+        return index.count if index is not None else 0
+
+    def last_key(self, chat_id: int) -> Optional[MessageKey]:
+        # Граница слоёв: в БД читаются только сообщения новее этого ключа
+        index = self._index(chat_id)
+        if index is None or index.last_key is None:
+            return None
+        return _from_cold_key(index.last_key)
+
+    def read_range(self, chat_id: int, start: int, stop: int) -> List[Message]:
+        """Сообщения с позициями [start, stop) от начала истории чата."""
+        index = self._index(chat_id)
+        if index is None or start >= stop:
+            return []
+        messages = []
+        first = max(0, bisect_right(index.starts, start) - 1)
+        for block, block_start in zip(index.blocks[first:], index.starts[first:]):
+            if block_start >= stop:
+                break
+            records = self._read_block(block)
+            messages.extend(_to_message(r) for r in records[max(0, start - block_start):stop - block_start])
+        return messages
+
+    def read_before(self, chat_id: int, key: Optional[MessageKey], limit: int) -> List[Message]:
+        """До limit сообщений с ключом меньше key (None — с конца) от новых к старым."""
+        index = self._index(chat_id)
+        if index is None or limit <= 0:
+            return []
+        bound = _cold_key(key) if key is not None else None
+        # Блоки, начинающиеся не раньше границы, целиком новее неё
+        end = bisect_left(index.first_keys, bound) if bound is not None else len(index.blocks)
+        messages = []
+        for block in reversed(index.blocks[:end]):
+            for record in reversed(self._read_block(block)):
+                if bound is None or _message_key(record) < bound:
+                    messages.append(_to_message(record))
+                    if len(messages) >= limit:
+                        return messages
+        return messages
+
+    def read_after(self, chat_id: int, key: Optional[MessageKey], limit: int) -> List[Message]:
+        """До limit сообщений с ключом больше key (None — с начала) от старых к новым."""
+        index = self._index(chat_id)
+        if index is None or limit <= 0:
+            return []
+        bound = _cold_key(key) if key is not None else None
+        # Блоки, заканчивающиеся не позже границы, целиком старше неё
+        start = bisect_right(index.last_keys, bound) if bound is not None else 0
+        messages = []
+        for block in index.blocks[start:]:
+            for record in self._read_block(block):
+                if bound is None or _message_key(record) > bound:
+                    messages.append(_to_message(record))
+                    if len(messages) >= limit:
+                        return messages
+        return messages
+
+    def iter_partitions(self, chat_id: int) -> Iterator[List[Message]]:
+        index = self._index(chat_id)
+        if index is None:
+            return
+        for block in index.blocks:
+            yield [_to_message(record) for record in self._read_block(block)]
+
+    def find_key(self, chat_id: int, message_id: int) -> Optional[MessageKey]:
+        index = self._index(chat_id)
+        if index is None:
+            return None
+        for block in index.blocks:
+            if block.min_id <= message_id <= block.max_id:
+                for record in self._read_block(block):
+                    if record["id"] == message_id:
+                        return datetime.datetime.fromisoformat(record["created_at"]), message_id
+        return None
+
+    def append(self, chat_id: int, records: List[dict]):
+        """Дописывает сообщения (по возрастанию ключа, новее уже заархивированных) в хвост сегментов чата."""
+        if not records:
+            return
+        directory = self._chat_dir(chat_id)
+        os.makedirs(directory, exist_ok=True)
+        self._expire(chat_id)
+        index = self._index(chat_id)
+        blocks = index.blocks if index is not None else []
+        segment_count = 0
+        if blocks:
+            segment = blocks[-1].segment
+            segment_count = sum(block.count for block in blocks if block.segment == segment)
+            segment_number = int(os.path.basename(segment)[:-4])
+        else:
+            segment_number = 1
+            segment = os.path.join(directory, f"{segment_number:06d}.seg")
+        for start in range(0, len(records), self.block_messages):
+            chunk = records[start:start + self.block_messages]
+            if segment_count and segment_count + len(chunk) > self.segment_messages:
+                segment_number += 1
+                segment = os.path.join(directory, f"{segment_number:06d}.seg")
+                segment_count = 0
+            self._append_block(segment, chunk)
+            segment_count += len(chunk)
+        self._expire(chat_id)
+
+    @staticmethod
+    def _append_block(segment: str, records: List[dict]):
+        index_path = segment[:-4] + ".idx"
+        data = zlib.compress("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records).encode("utf-8"))
+        index_size = os.path.getsize(index_path) if os.path.exists(index_path) else 0
+        # Конец последнего блока из индекса: хвост после него — остаток прерванной записи
+        offset = 0
+        if index_size >= _INDEX_ENTRY.size:
+            with open(index_path, "rb") as f:
+                f.seek((index_size // _INDEX_ENTRY.size - 1) * _INDEX_ENTRY.size)
+                last = _INDEX_ENTRY.unpack(f.read(_INDEX_ENTRY.size))
+            offset = last[6] + last[7]
+        with open(segment, "ab") as f:
+            f.truncate(offset)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        first, last = _message_key(records[0]), _message_key(records[-1])
+        ids = [record["id"] for record in records]
+        entry = _INDEX_ENTRY.pack(*first, *last, min(ids), max(ids), offset, len(data), len(records))
+        with open(index_path, "ab") as f:
+            f.truncate(index_size - index_size % _INDEX_ENTRY.size)
+            f.write(entry)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @contextmanager
+    def lock(self):
+        """Эксклюзивная блокировка архивирования между процессами; yield False, если занята."""
+        os.makedirs(self.root, exist_ok=True)
+        fd = os.open(os.path.join(self.root, ".archive.lock"), os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            yield True
+        finally:
+            os.close(fd)
+
+
+cold_store = ColdStore()
+
+
+async def archive_chat(db, store: ColdStore, chat_id: int, cutoff: datetime.datetime,
+                       batch_size: int = COLD_ARCHIVE_BATCH) -> int:
+    """Переносит сообщения чата старше cutoff из БД в холодный слой. Возвращает число перенесённых."""
+    key = tuple_(Message.created_at, Message.id)
+    moved = 0
+    while True:
+        last = await asyncio.to_thread(store.last_key, chat_id)
+        if last is not None:
+            # Остаток прерванного прогона: уже в сегменте, но ещё в БД
+            await db.execute(delete(Message).where(Message.chat_id == chat_id, key <= tuple_(*last)))
+        query = select(Message).where(Message.chat_id == chat_id, Message.created_at < cutoff)
+        if last is not None:
+            query = query.where(key > tuple_(*last))
+        result = await db.execute(query.order_by(Message.created_at, Message.id).limit(batch_size))
+        rows = result.scalars().all()
+        if not rows:
+            await db.commit()
+            return moved
+        records = [row.to_dict() for row in rows]
+        await asyncio.to_thread(store.append, chat_id, records)
+        newest = (rows[-1].created_at, rows[-1].id)
+        await db.execute(delete(Message).where(Message.chat_id == chat_id, key <= tuple_(*newest)))
+        await db.commit()
+        moved += len(rows)
+
+
+async def archive_cold_messages(session_factory, store: ColdStore = cold_store,
+                                older_than_days: float = COLD_ARCHIVE_AFTER_DAYS) -> int:
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=older_than_days)
+    with store.lock() as acquired:
+        if not acquired:
+            # Архивирует другой воркер
+            return 0
+        async with session_factory() as db:
+            result = await db.execute(select(Message.chat_id).where(Message.created_at < cutoff).distinct())
+            chat_ids = result.scalars().all()
+        moved = 0
+        for chat_id in chat_ids:
+            async with session_factory() as db:
+                moved += await archive_chat(db, store, chat_id, cutoff)
+        if moved:
+            logger.info("Archived %d messages from %d chats", moved, len(chat_ids))
+        return moved
+
+
+async def run_archiver(session_factory, interval: float = COLD_ARCHIVE_INTERVAL_SECONDS):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await archive_cold_messages(session_factory)
+        except Exception:
+            logger.exception("Cold archiving failed")
+
+
+if __name__ == "__main__":
+    from app.database import async_session
+
+    logging.basicConfig(level=logging.INFO)
+    print(asyncio.run(archive_cold_messages(async_session)))
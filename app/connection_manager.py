@@ -1,34 +1,476 @@
+import asyncio
+import enum
+import os
+import time
+import zlib
+from collections import deque
 from fastapi import WebSocket
-from typing import List, Dict
+from typing import Callable, Deque, Iterable, List, Dict, Optional
+from app.codecs import Frame, get_codec
+from app.dedup import RecentMessageFilter
+from app.membership import membership_cache
+from app.metrics import (
+    BROADCAST_RECIPIENTS,
+    BROADCAST_SECONDS,
+    BUS_PUBLISH_SECONDS,
+    DUPLICATES_REJECTED,
+    WS_FRAMES_SENT,
+    Counter,
+    Gauge
+)
+from app.pubsub import create_bus
+from app.tracing import tracer
+
+
+class SlowConsumerPolicy(str, enum.Enum):
+    drop_oldest = "drop_oldest"  # выбрасываем самое старое сообщение из очереди
+    coalesce = "coalesce"  # заменяем ожидающее сообщение с тем же ключом, иначе как drop_oldest
+    disconnect = "disconnect"  # закрываем соединение медленного клиента
+
+
+OUTBOX_MAX_SIZE = int(os.getenv("WS_OUTBOX_MAX_SIZE", "256"))
+SLOW_CONSUMER_POLICY = SlowConsumerPolicy(os.getenv("WS_SLOW_CONSUMER_POLICY", SlowConsumerPolicy.drop_oldest.value))
+# Сколько пропущенных сообщений досылается при переподключении с last_seen_id; больше — клиент перечитывает историю
+RESUME_MAX_MESSAGES = int(os.getenv("WS_RESUME_MAX_MESSAGES", "500"))
+
+# Склейка исходящих событий (?batch=1): сколько ждать следующих событий и сколько класть в один фрейм
+WS_BATCH_WINDOW_MS = float(os.getenv("WS_BATCH_WINDOW_MS", "5"))
+WS_BATCH_MAX_EVENTS = int(os.getenv("WS_BATCH_MAX_EVENTS", "64"))
+# Сжатие (?compress=deflate): фреймы меньше порога отправляются как есть
+WS_COMPRESS_MIN_BYTES = int(os.getenv("WS_COMPRESS_MIN_BYTES", "512"))
+WS_COMPRESS_LEVEL = int(os.getenv("WS_COMPRESS_LEVEL", "6"))
+
+# Эфемерные события (присутствие, набор текста) получают только сокеты, подключённые с ?presence=1
+EPHEMERAL_ACTIONS = frozenset({"presence"})
+# Служебные события между воркерами: передаются обработчику on_internal_event и не доходят до сокетов
+PRESENCE_SYNC_ACTION = "presence_sync"
+INTERNAL_ACTIONS = frozenset({PRESENCE_SYNC_ACTION})
+
+# Код закрытия для клиентов, не успевающих читать ("Try Again Later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# Код закрытия для сокетов пользователя, удалённого из чата ("Policy Violation")
+MEMBER_REMOVED_CLOSE_CODE = 1008
+
+OUTBOX_DROPPED = Counter("fastchat_outbox_dropped_total", "Frames dropped from slow consumers' outboxes", ["policy"])
+OUTBOX_COALESCED = Counter("fastchat_outbox_coalesced_total", "Pending frames replaced by a newer frame with the same key")
+SLOW_CONSUMERS_DISCONNECTED = Counter("fastchat_slow_consumers_disconnected_total", "Sockets closed by the disconnect policy")
+FRAMES_SAVED = Counter("fastchat_ws_frames_saved_total", "Events sent inside batched frames beyond the first one")
+COMPRESSION_BYTES_SAVED = Counter("fastchat_ws_compression_bytes_saved_total", "Bytes saved by compressing outbound frames")
+
+
+def deflate(data: bytes, level: int = WS_COMPRESS_LEVEL) -> bytes:
+    # Сырой deflate без заголовка zlib, каждый фрейм сжимается независимо (как permessage-deflate без context takeover)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _QueuedFrame:
+    __slots__ = ("data", "key", "message_id")
+
+    def __init__(self, data: Frame, key: Optional[str], message_id: Optional[int] = None):
+        self.data = data
+        self.key = key
+        # id сообщения чата, если фрейм — новое сообщение (нужен для склейки досылки с живой рассылкой)
+        self.message_id = message_id
+
+
+class ConnectionOutbox:
+    """Ограниченная исходящая очередь и задача-писатель одного WebSocket-соединения."""
+
+    def __init__(self, websocket: WebSocket, chat_id: int, user_id: Optional[int] = None,
+                 max_size: int = OUTBOX_MAX_SIZE, policy: SlowConsumerPolicy = SLOW_CONSUMER_POLICY,
+                 codec=None, ephemeral: bool = False, batch: bool = False, compress: bool = False):
+        self.websocket = websocket
+        self.ephemeral = ephemeral
+        # batch: события отправляются массивом, собранным за WS_BATCH_WINDOW_MS
+        self.batch = batch
+        self.compress = compress
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.codec = codec or get_codec()
+        self.max_size = max_size
+        self.policy = SlowConsumerPolicy(policy)
+        self.queue: Deque[_QueuedFrame] = deque()
+        self.pending_by_key: Dict[str, _QueuedFrame] = {}
+        self.closed = False
+        # На паузе фреймы копятся, но не отправляются: пока идёт досылка пропущенных сообщений
+        self.paused = False
+        # Живая рассылка переполнила очередь на паузе: после resync_required соединение закрывается
+        self.resync_sent = False
+        # Статистика для поиска "плохих" клиентов
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.events = 0
+        self.frames_saved = 0
+        self.bytes_saved = 0
+        self._wakeup = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return len(self.queue)
+
+    def start(self):
+        self._writer = asyncio.create_task(self._run())
+
+    def enqueue(self, data: Frame, key: Optional[str] = None, message_id: Optional[int] = None) -> bool:
+        """Ставит закодированный фрейм в очередь. Возвращает False, если клиента нужно отключить."""
+        if self.closed:
+            return False
+        if self.resync_sent:
+            # Клиент всё равно перечитает историю
+            return True
+        # Пока идёт досылка, живая рассылка не вытесняется политикой медленного клиента: очередь растёт
+        # до max_size + RESUME_MAX_MESSAGES, а дальше вместо молчаливой потери — resync_required
+        if self.paused and len(self.queue) >= self.max_size + RESUME_MAX_MESSAGES:
+            self._require_resync()
+            return True
+        if self.policy == SlowConsumerPolicy.coalesce and key is not None:
+            pending = self.pending_by_key.get(key)
+            if pending is not None:
+                pending.data = data
+                self.coalesced += 1
+                OUTBOX_COALESCED.inc()
+                return True
+        if len(self.queue) >= self.max_size and not self.paused:
+            if self.policy == SlowConsumerPolicy.disconnect:
+                self.dropped += len(self.queue)
+                OUTBOX_DROPPED.inc(len(self.queue), (self.policy.value,))
+                SLOW_CONSUMERS_DISCONNECTED.inc()
+                self.closed = True
+                self.queue.clear()
+                self.pending_by_key.clear()
+                self._wakeup.set()
+                return False
+            oldest = self.queue.popleft()
+            self._forget(oldest)
+            self.dropped += 1
+            OUTBOX_DROPPED.inc(1, (self.policy.value,))
+        frame = _QueuedFrame(data, key, message_id)
+        self.queue.append(frame)
+        if key is not None:
+            self.pending_by_key[key] = frame
+        if len(self.queue) > self.max_depth:
+            self.max_depth = len(self.queue)
+        self._wakeup.set()
+        return True
+
+    def pause(self):
+        self.paused = True
+
+    def _require_resync(self):
+        # Без досылки и накопленной рассылки: только сигнал перечитать историю, затем закрытие
+        self.dropped += len(self.queue)
+        OUTBOX_DROPPED.inc(len(self.queue), ("resync",))
+        self.queue.clear()
+        self.pending_by_key.clear()
+        self.resync_sent = True
+        self.paused = False
+        self.queue.append(_QueuedFrame(
+            self.codec.encode({"action": "resync_required", "chat_id": self.chat_id, "reason": "live_backlog_overflow"}),
+            None,
+        ))
+        self._wakeup.set()
+
+    def resume(self, replay: Iterable[tuple] = ()):
+        """Ставит фреймы досылки [(data, message_id)] перед накопленной живой рассылкой и снимает паузу.
+
+        Сообщения, попавшие и в досылку, и в живую рассылку, отправляются один раз.
+        """
+        if self.resync_sent:
+            return
+        replay = list(replay)
+        replayed = {message_id for _, message_id in replay if message_id is not None}
+        if replayed:
+            for frame in [frame for frame in self.queue if frame.message_id in replayed]:
+                self.queue.remove(frame)
+                self._forget(frame)
+        self.queue.extendleft(_QueuedFrame(data, None, message_id) for data, message_id in reversed(replay))
+        self.paused = False
+        self._wakeup.set()
+
+    def _forget(self, frame: _QueuedFrame):
+        if frame.key is not None and self.pending_by_key.get(frame.key) is frame:
+            del self.pending_by_key[frame.key]
+
+    async def _run(self):
+        try:
+            while True:
+                while not self.queue or self.paused:
+                    if self.closed:
+                        return
+                    if self.resync_sent:
+                        # resync_required отправлен: закрываем, клиент переподключится и перечитает историю
+                        self.closed = True
+                        await self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+                        return
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                if self.closed:
+                    return
+                frame = self.queue.popleft()
+                self._forget(frame)
+                if self.batch:
+                    frames = await self._collect([frame.data])
+                    data = self.codec.pack_array(frames)
+                    self.events += len(frames)
+                    self.frames_saved += len(frames) - 1
+                    FRAMES_SAVED.inc(len(frames) - 1)
+                else:
+                    data = frame.data
+                    self.events += 1
+                if self.compress:
+                    data = self._compress(data)
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+                self.sent += 1
+                WS_FRAMES_SENT.inc()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Сокет уже закрыт: цикл чтения в websocket_endpoint сам получит disconnect
+            self.closed = True
+
+    async def _collect(self, frames: List[Frame]) -> List[Frame]:
+        """Добирает в фрейм события, пришедшие за окно склейки (с нулевым окном — только уже ожидающие)."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + WS_BATCH_WINDOW_MS / 1000
+        while len(frames) < WS_BATCH_MAX_EVENTS and not self.closed:
+            if self.queue:
+                frame = self.queue.popleft()
+                self._forget(frame)
+                frames.append(frame.data)
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return frames
+
+    def _compress(self, data: Frame) -> Frame:
+        # Сжатый фрейм всегда бинарный; текстовые кодеки отличают его от обычного текстового фрейма
+        raw = data.encode("utf-8") if isinstance(data, str) else data
+        if len(raw) < WS_COMPRESS_MIN_BYTES:
+            return data
+        compressed = deflate(raw)
+        if len(compressed) >= len(raw):
+            return data
+        self.bytes_saved += len(raw) - len(compressed)
+        COMPRESSION_BYTES_SAVED.inc(len(raw) - len(compressed))
+        return compressed
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        self.pending_by_key.clear()
+        if self._writer is not None and not self._writer.done():
+            self._writer.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "chat_id": self.chat_id,
+            "user_id": self.user_id,
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "events": self.events,
+            "frames_saved": self.frames_saved,
+            "bytes_saved": self.bytes_saved,
+            "policy": self.policy.value,
+            "codec": self.codec.name,
+        }
 
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, max_queue_size: int = OUTBOX_MAX_SIZE, policy: SlowConsumerPolicy = SLOW_CONSUMER_POLICY,
+                 bus=None, membership=None):
         # chat_id -> список WebSocket-соединений
         self.active_connections: Dict[int, List[WebSocket]] = {}
-        self.last_message_timestamps: Dict[tuple, float] = {}  # (chat_id, sender_id, text) -> время отправки
+        # WebSocket -> исходящая очередь соединения
+        self.outboxes: Dict[WebSocket, ConnectionOutbox] = {}
+        self.max_queue_size = max_queue_size
+        self.policy = SlowConsumerPolicy(policy)
+        # Шина рассылки между воркерами: воркер подписан только на чаты, которые он обслуживает
+        self.bus = bus if bus is not None else create_bus()
+        self.bus.set_handler(self._deliver_local)
+        # Кэш участников: рассылка пропускает сокеты пользователей, покинувших чат.
+        # Пока чат в кэше, воркер подписан на него: member_left дойдёт и без открытых сокетов
+        self.membership = membership
+        if membership is not None:
+            membership.on_cached = self.bus.subscribe
+            membership.on_dropped = self._unsubscribe_idle
+        # Ограниченный по размеру и времени жизни фильтр повторов (ключи — хеши, не тексты)
+        self.recent_messages = RecentMessageFilter()
+        # Вызывается с chat_id при открытии и закрытии сокета (app.presence)
+        self.on_connections_changed: Optional[Callable[[int], None]] = None
+        # Вызывается с (chat_id, message) для служебных событий шины (app.presence)
+        self.on_internal_event: Optional[Callable[[int, dict], None]] = None
 
-    async def connect(self, chat_id: int, websocket: WebSocket):
+    async def connect(self, chat_id: int, websocket: WebSocket, user_id: Optional[int] = None, codec=None,
+                      paused: bool = False, ephemeral: bool = False, batch: bool = False, compress: bool = False):
+        """paused=True: живая рассылка копится до resume(), чтобы сначала дослать пропущенное.
+        ephemeral=True: сокет получает события присутствия и набора текста.
+        batch / compress: склейка событий в массивы и сжатие крупных фреймов."""
         await websocket.accept()
+        outbox = ConnectionOutbox(websocket, chat_id, user_id, self.max_queue_size, self.policy, codec, ephemeral,
+                                  batch, compress)
+        if paused:
+            outbox.pause()
+        outbox.start()
+        self.outboxes[websocket] = outbox
         if chat_id not in self.active_connections:
             self.active_connections[chat_id] = []
+            self.bus.subscribe(chat_id)
         self.active_connections[chat_id].append(websocket)
+        if self.on_connections_changed is not None:
+            self.on_connections_changed(chat_id)
 
-    def disconnect(self, chat_id: int, websocket: WebSocket):
+    def _unsubscribe_idle(self, chat_id: int):
+        # Подписка нужна, пока есть сокеты чата или его состав в кэше
         if chat_id in self.active_connections:
-            self.active_connections[chat_id].remove(websocket)
+            return
+        if self.membership is not None and self.membership.holds(chat_id):
+            return
+        self.bus.unsubscribe(chat_id)
 
-    async def broadcast(self, chat_id: int, message: dict):
-        if chat_id in self.active_connections:
-            for connection in self.active_connections[chat_id]:
-                await connection.send_json(message)
+    def resume(self, websocket: WebSocket, messages: List[dict]):
+        # Досылка пропущенных сообщений по порядку, затем накопленная за это время живая рассылка
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None:
+            outbox.resume((outbox.codec.encode(message), message.get("id")) for message in messages)
 
-    def is_duplicate(self, chat_id: int, sender_id: int, text: str, current_time: float, threshold: float = 1.0):
-        key = (chat_id, sender_id, text)
-        last_time = self.last_message_timestamps.get(key, 0)
-        if current_time - last_time < threshold:
-            return True
-        self.last_message_timestamps[key] = current_time
-        return False
+    async def start(self):
+        await self.bus.start()
+
+    async def stop(self):
+        await self.bus.stop()
+
+    def disconnect(self, chat_id: int, websocket: WebSocket):
+        connections = self.active_connections.get(chat_id)
+        if connections is not None and websocket in connections:
+            connections.remove(websocket)
+            if not connections:
+                del self.active_connections[chat_id]
+                self._unsubscribe_idle(chat_id)
+            if self.on_connections_changed is not None:
+                self.on_connections_changed(chat_id)
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            outbox.close()
+
+    async def broadcast(self, chat_id: int, message: dict, key: Optional[str] = None):
+        # Событие публикуется один раз; шина доставит его всем воркерам с подписчиками этого чата.
+        # Время раздачи по сокетам меряется в _deliver_local на каждом воркере (BROADCAST_SECONDS)
+        started_at = time.perf_counter()
+        with tracer.span("broadcast", chat_id=chat_id, action=message.get("action") or "message"):
+            await self.bus.publish(chat_id, message, key)
+        BUS_PUBLISH_SECONDS.observe(time.perf_counter() - started_at)
+
+    def _deliver_local(self, chat_id: int, message: dict, key: Optional[str] = None):
+        members = None
+        action = message.get("action")
+        if action in INTERNAL_ACTIONS:
+            if self.on_internal_event is not None:
+                self.on_internal_event(chat_id, message)
+            return
+        if self.membership is not None:
+            # События состава приходят через шину на каждый воркер с подписчиками чата
+            if action == "member_joined":
+                self.membership.add_members(chat_id, message["user_ids"])
+            elif action == "member_left":
+                self.membership.remove_member(chat_id, message["user_id"])
+                self._disconnect_user(chat_id, message["user_id"], MEMBER_REMOVED_CLOSE_CODE)
+            members = self.membership.get_members(chat_id)
+
+        started_at = time.perf_counter()
+        span = tracer.start_span("fanout", chat_id=chat_id)
+        # Только ставим сообщение в очереди соединений: медленный клиент не задерживает остальных.
+        # Сообщение сериализуется один раз на кодек, а не на каждого получателя.
+        frames: Dict[str, Frame] = {}
+        message_id = message.get("id") if action is None else None
+        ephemeral = action in EPHEMERAL_ACTIONS
+        recipients = 0
+        for websocket in list(self.active_connections.get(chat_id, ())):
+            outbox = self.outboxes.get(websocket)
+            if outbox is None:
+                continue
+            if members is not None and outbox.user_id is not None and outbox.user_id not in members:
+                continue
+            if ephemeral and not outbox.ephemeral:
+                continue
+            frame = frames.get(outbox.codec.name)
+            if frame is None:
+                frame = frames[outbox.codec.name] = outbox.codec.encode(message)
+            if outbox.enqueue(frame, key, message_id):
+                recipients += 1
+            else:
+                self._drop_slow_consumer(chat_id, websocket)
+        BROADCAST_SECONDS.observe(time.perf_counter() - started_at)
+        if recipients:
+            BROADCAST_RECIPIENTS.observe(recipients)
+        if span is not None:
+            span.set(recipients=recipients, codecs=len(frames))
+            span.finish()
+
+    def send_local(self, chat_id: int, message: dict):
+        # Только сокетам этого воркера, минуя шину
+        self._deliver_local(chat_id, message)
+
+    async def send_personal(self, websocket: WebSocket, message: dict):
+        outbox = self.outboxes.get(websocket)
+        if outbox is None:
+            await websocket.send_json(message)
+            return
+        if not outbox.enqueue(outbox.codec.encode(message)):
+            self._drop_slow_consumer(outbox.chat_id, websocket)
+
+    def _drop_slow_consumer(self, chat_id: int, websocket: WebSocket):
+        self.disconnect(chat_id, websocket)
+        asyncio.create_task(self._close_quietly(websocket, SLOW_CONSUMER_CLOSE_CODE))
+
+    def _disconnect_user(self, chat_id: int, user_id: int, code: int):
+        for websocket in list(self.active_connections.get(chat_id, ())):
+            outbox = self.outboxes.get(websocket)
+            if outbox is not None and outbox.user_id == user_id:
+                self.disconnect(chat_id, websocket)
+                asyncio.create_task(self._close_quietly(websocket, code))
+
+    @staticmethod
+    async def _close_quietly(websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    def connection_stats(self) -> List[dict]:
+        stats = [outbox.stats() for outbox in self.outboxes.values()]
+        stats.sort(key=lambda item: (item["depth"], item["dropped"]), reverse=True)
+        return stats
+
+    def is_duplicate(self, chat_id: int, sender_id: int, text: str, current_time: float,
+                     threshold: Optional[float] = None):
+        duplicate = self.recent_messages.is_duplicate(chat_id, sender_id, text, current_time, threshold)
+        if duplicate:
+            DUPLICATES_REJECTED.inc(1, ("text_window",))
+        return duplicate
+
+manager = ConnectionManager(membership=membership_cache)
 
-manager = ConnectionManager()
+Gauge(
+    "fastchat_active_sockets", "Open WebSocket connections per chat on this worker", ["chat_id"],
+    function=lambda: {(str(chat_id),): len(sockets) for chat_id, sockets in manager.active_connections.items()},
+)
+Gauge(
+    "fastchat_outbox_depth", "Frames waiting in all outboxes on this worker",
+    function=lambda: sum(outbox.depth for outbox in manager.outboxes.values()),
+)
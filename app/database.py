@@ -1,13 +1,146 @@
 import os
+import time
+from sqlalchemy import event, exc
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from app.metrics import DB_STATEMENT_SECONDS, CounterFunction, Gauge
+from app.tracing import tracer
 
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql+asyncpg://postgres:password@db:5432/postgres")
 
-engine = create_async_engine(DATABASE_URL, echo=True)
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() in ("1", "true", "yes")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def record_checkout(self, waited: float):
+        self.checkouts += 1
+        self.checkout_wait_total += waited
+        if waited > self.checkout_wait_max:
+            self.checkout_wait_max = waited
+
+
+pool_metrics = PoolMetrics()
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    # Замеряет ожидание свободного соединения: при исчерпании пула это главный источник задержек
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.timeouts += 1
+            raise
+        pool_metrics.record_checkout(time.perf_counter() - started_at)
+        return connection
+
+
+def create_engine_from_settings(url: str = DATABASE_URL, **overrides):
+    options = {
+        "echo": DB_ECHO,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_recycle": DB_POOL_RECYCLE,
+    }
+    if not url.startswith("sqlite"):
+        options.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+    if "+asyncpg" in url:
+        options["connect_args"] = {"statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    options.update(overrides)
+    new_engine = create_async_engine(url, **options)
+    instrument_statements(new_engine)
+    return new_engine
+
+
+def _statement_kind(statement: str) -> str:
+    # Метка — только первое слово выражения, чтобы не раздувать число временных рядов
+    kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "EMPTY"
+    return kind if kind in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "BEGIN", "COMMIT", "ROLLBACK") else "OTHER"
+
+
+def instrument_statements(target_engine):
+    sync_engine = target_engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+        # Дочерний спан текущего запроса или WebSocket-события (None вне трассы)
+        conn.info.setdefault("query_spans", []).append(
+            tracer.start_span("db", statement=_statement_kind(statement), sql=statement[:200])
+        )
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("query_started_at")
+        if started:
+            DB_STATEMENT_SECONDS.observe(time.perf_counter() - started.pop(), (_statement_kind(statement),))
+        spans = conn.info.get("query_spans")
+        if spans:
+            span = spans.pop()
+            if span is not None:
+                span.finish()
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(context):
+        # После ошибки after_cursor_execute не вызывается: снимаем незакрытый замер выражения
+        conn = context.connection
+        if conn is None:
+            return
+        started = conn.info.get("query_started_at")
+        if started:
+            started.pop()
+        spans = conn.info.get("query_spans")
+        if spans:
+            span = spans.pop()
+            if span is not None:
+                span.set(error=type(context.original_exception).__name__)
+                span.finish()
+
+
+engine = create_engine_from_settings()
 async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
 
+def pool_stats() -> dict:
+    pool = engine.pool
+    stats = {
+        "checkouts": pool_metrics.checkouts,
+        "timeouts": pool_metrics.timeouts,
+        "checkout_wait_avg": pool_metrics.checkout_wait_total / pool_metrics.checkouts if pool_metrics.checkouts else 0.0,
+        "checkout_wait_max": pool_metrics.checkout_wait_max,
+    }
+    if hasattr(pool, "checkedout"):
+        stats.update(in_use=pool.checkedout(), idle=pool.checkedin(), size=pool.size(), overflow=pool.overflow())
+    return stats
+
+
+Gauge("fastchat_db_pool_in_use", "Pooled connections checked out", function=lambda: pool_stats().get("in_use", 0))
+Gauge("fastchat_db_pool_size", "Configured pool size", function=lambda: pool_stats().get("size", 0))
+CounterFunction("fastchat_db_pool_checkouts_total", "Pool checkouts", lambda: pool_metrics.checkouts)
+CounterFunction("fastchat_db_pool_timeouts_total", "Pool checkout timeouts", lambda: pool_metrics.timeouts)
+CounterFunction(
+    "fastchat_db_pool_checkout_wait_seconds_total", "Total time spent waiting for a pooled connection",
+    lambda: pool_metrics.checkout_wait_total,
+)
+
+
 async def get_db():
     async with async_session() as session:
         yield session
@@ -0,0 +1,56 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Optional
+
+DEDUP_WINDOW_SECONDS = float(os.getenv("DEDUP_WINDOW_SECONDS", "1.0"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
+
+
+class RecentMessageFilter:
+    """Ограниченный детектор повторов: хеш (chat_id, sender_id, text) -> время последней отправки.
+
+    Записи хранятся в порядке вставки, поэтому устаревшие всегда лежат в начале
+    и вытесняются за O(1) на запись. Размер жёстко ограничен max_entries.
+    """
+
+    def __init__(self, ttl: float = DEDUP_WINDOW_SECONDS, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[bytes, float]" = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(chat_id: int, sender_id: int, text: str) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{chat_id}:{sender_id}:".encode())
+        digest.update(text.encode("utf-8"))
+        return digest.digest()
+
+    def _evict_expired(self, now: float):
+        entries = self._entries
+        while entries:
+            key, seen_at = next(iter(entries.items()))
+            if now - seen_at < self.ttl:
+                break
+            entries.popitem(last=False)
+            self.evicted += 1
+
+    def is_duplicate(self, chat_id: int, sender_id: int, text: str, now: float,
+                     threshold: Optional[float] = None) -> bool:
+        # threshold не может превышать ttl: более старые записи уже вытеснены
+        window = self.ttl if threshold is None else min(threshold, self.ttl)
+        self._evict_expired(now)
+        key = self._key(chat_id, sender_id, text)
+        seen_at = self._entries.get(key)
+        if seen_at is not None and now - seen_at < window:
+            return True
+        self._entries[key] = now
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+        return False
@@ -0,0 +1,202 @@
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from app.metrics import CounterFunction, Gauge
+from app.pubsub import CHAT_BUS
+
+RECENT_HISTORY_PER_CHAT = int(os.getenv("RECENT_HISTORY_PER_CHAT", "100"))
+RECENT_HISTORY_MEMORY_BYTES = int(os.getenv("RECENT_HISTORY_MEMORY_BYTES", str(64 * 1024 * 1024)))
+RECENT_HISTORY_TTL_SECONDS = float(os.getenv("RECENT_HISTORY_TTL_SECONDS", "60"))
+# При общей шине (CHAT_BUS=unix) сообщения пишут и другие воркеры: буфер по умолчанию выключен
+RECENT_HISTORY_ENABLED = os.getenv("RECENT_HISTORY_ENABLED", "false" if CHAT_BUS == "unix" else "true").lower() == "true"
+
+# Грубая оценка памяти на сообщение сверх текста: объект модели, словарь атрибутов, datetime
+MESSAGE_OVERHEAD_BYTES = 400
+
+
+def _message_size(message) -> int:
+    return MESSAGE_OVERHEAD_BYTES + len(message.text or "") + len(message.client_msg_id or "")
+
+
+def _sort_key(message):
+    return message.created_at, message.id
+
+
+class _ChatHistory:
+    __slots__ = ("messages", "complete", "warming", "expires_at", "size", "read_state", "read_generation")
+
+    def __init__(self, expires_at: float):
+        # Последние сообщения по возрастанию (created_at, id)
+        self.messages: list = []
+        # True, если в буфере вся история чата (сообщений меньше ёмкости)
+        self.complete = False
+        # Буфер прогревается из БД; новые сообщения уже копятся, но читать его ещё нельзя
+        self.warming = True
+        self.expires_at = expires_at
+        self.size = 0
+        self.read_state = None
+        self.read_generation = 0
+
+
+class RecentHistoryCache:
+    """Кольцевой буфер последних сообщений для горячих чатов.
+
+    Пополняется при отправке сообщений и лениво прогревается из БД при первом запросе
+    свежей страницы истории. Общий объём ограничен бюджетом памяти: холодные чаты
+    вытесняются по LRU. Буфер видит только сообщения своего воркера, поэтому
+    при нескольких воркерах на общей шине он выключается (enabled=False): все страницы идут в БД.
+    Вместе с сообщениями кэшируется сводка позиций прочтения; она сбрасывается
+    при любом продвижении прочтения или изменении состава чата.
+    """
+
+    def __init__(self, per_chat: int = RECENT_HISTORY_PER_CHAT, memory_bytes: int = RECENT_HISTORY_MEMORY_BYTES,
+                 ttl: float = RECENT_HISTORY_TTL_SECONDS, enabled: bool = RECENT_HISTORY_ENABLED):
+        self.enabled = enabled
+        self.per_chat = per_chat
+        self.memory_bytes = memory_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._chats: "OrderedDict[int, _ChatHistory]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _get(self, chat_id: int) -> Optional[_ChatHistory]:
+        entry = self._chats.get(chat_id)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._drop(chat_id)
+            return None
+        self._chats.move_to_end(chat_id)
+        return entry
+
+    def _drop(self, chat_id: int):
+        entry = self._chats.pop(chat_id, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _insert(self, entry: _ChatHistory, message):
+        messages = entry.messages
+        key = _sort_key(message)
+        if any(existing.id == message.id for existing in messages):
+            return
+        position = len(messages)
+        while position and _sort_key(messages[position - 1]) > key:
+            position -= 1
+        if position == 0 and messages and not entry.complete and not entry.warming:
+            # Старше всего окна: в буфер последних сообщений не попадает
+            return
+        messages.insert(position, message)
+        size = _message_size(message)
+        entry.size += size
+        self.size += size
+        while len(messages) > self.per_chat:
+            removed = _message_size(messages.pop(0))
+            entry.size -= removed
+            self.size -= removed
+            entry.complete = False
+
+    def _evict(self):
+        while self.size > self.memory_bytes and len(self._chats) > 1:
+            chat_id = next(iter(self._chats))
+            self._drop(chat_id)
+            self.evicted += 1
+
+    def add(self, message):
+        """Новое сообщение попадает только в уже прогретые (или прогреваемые) буферы."""
+        entry = self._get(message.chat_id)
+        if entry is None:
+            return
+        self._insert(entry, message)
+        self._evict()
+
+    def get_latest(self, chat_id: int, count: int) -> Optional[list]:
+        """До count последних сообщений от новых к старым или None, если буфер не может ответить.
+
+        Ответ возможен, если в буфере не меньше count сообщений или в нём вся история чата.
+        """
+        entry = self._get(chat_id)
+        if entry is None or entry.warming or (len(entry.messages) < count and not entry.complete):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry.messages[:-count - 1:-1] if count else []
+
+    def get_all(self, chat_id: int) -> Optional[list]:
+        # Вся история чата по возрастанию, если она целиком помещается в буфер
+        entry = self._get(chat_id)
+        if entry is None or entry.warming or not entry.complete:
+            return None
+        self.hits += 1
+        return list(entry.messages)
+
+    def begin_warm(self, chat_id: int):
+        """Создаёт прогреваемый буфер. Сообщения, отправленные пока идёт запрос к БД,
+        копятся в нём и не теряются при complete_warm."""
+        if not self.enabled:
+            return None
+        entry = self._get(chat_id)
+        if entry is None:
+            entry = self._chats[chat_id] = _ChatHistory(time.monotonic() + self.ttl)
+        return entry
+
+    def complete_warm(self, token, chat_id: int, rows: List, complete: bool):
+        # rows — последние сообщения из БД в любом порядке
+        entry = self._chats.get(chat_id)
+        if entry is None or entry is not token:
+            # Буфер сбросили, пока шёл запрос: результат мог устареть
+            return
+        if not entry.warming:
+            return
+        entry.complete = complete
+        for message in rows:
+            self._insert(entry, message)
+        entry.warming = False
+        self._evict()
+
+    def get_read_state(self, chat_id: int):
+        entry = self._get(chat_id)
+        return entry.read_state if entry is not None else None
+
+    def read_generation(self, chat_id: int) -> Optional[int]:
+        entry = self._get(chat_id)
+        return entry.read_generation if entry is not None else None
+
+    def set_read_state(self, chat_id: int, read_state, generation: Optional[int]):
+        # Сохраняем, только если позиции прочтения не менялись, пока шёл запрос
+        entry = self._get(chat_id)
+        if entry is not None and generation is not None and entry.read_generation == generation:
+            entry.read_state = read_state
+
+    def invalidate_read_state(self, chat_id: int):
+        entry = self._chats.get(chat_id)
+        if entry is not None:
+            entry.read_state = None
+            entry.read_generation += 1
+
+    def invalidate(self, chat_id: int):
+        self._drop(chat_id)
+
+    def clear(self):
+        self._chats.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "chats": len(self._chats),
+            "memory_bytes": self.size,
+            "memory_budget_bytes": self.memory_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evicted_chats": self.evicted,
+        }
+
+
+history_cache = RecentHistoryCache()
+
+CounterFunction("fastchat_history_cache_hits_total", "History pages served from memory", lambda: history_cache.hits)
+CounterFunction("fastchat_history_cache_misses_total", "History pages that went to the database", lambda: history_cache.misses)
+Gauge("fastchat_history_cache_bytes", "Estimated memory held by recent-message buffers", function=lambda: history_cache.size)
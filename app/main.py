@@ -1,21 +1,34 @@
-import json
+import asyncio
 import time
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Body
+from typing import Literal, Optional
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, Depends, HTTPException, Body
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
 from pydantic import BaseModel
-from app.database import get_db, engine
+from app.database import get_db, engine, async_session, pool_stats
 from app import models
-from app.connection_manager import manager
+from app.connection_manager import RESUME_MAX_MESSAGES, manager
+from app.membership import membership_cache
+from app.codecs import CodecError, get_codec
 from app.auth import (
-    get_password_hash,
+    AuthenticatedUser,
     authenticate_user,
+    check_password_hashing,
     create_access_token,
-    get_current_user
+    get_current_user,
+    password_hasher
 )
 from app.services import UserService, ChatService, MessageService
+from app.bulk import bulk_response
+from app.repositories import DuplicateMessageError
+from app.write_batcher import write_batcher
+from app.cold_storage import COLD_ARCHIVE_INTERVAL_SECONDS, run_archiver
+from app.rate_limit import flow_control
+from app.presence import presence
+from app.read_receipts import read_receipts
+from app.metrics import REGISTRY, DUPLICATES_REJECTED, WS_MESSAGES_RECEIVED
+from app.tracing import TracingMiddleware, tracer
 
 
 # Pydantic-модель для создания чата
@@ -24,13 +37,29 @@ class ChatCreate(BaseModel):
     user_ids: list[int]
 
 
+class ChatMembersAdd(BaseModel):
+    user_ids: list[int]
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     async with engine.begin() as conn:
         await conn.run_sync(models.Base.metadata.create_all)
+    await check_password_hashing()
+    await manager.start()
+    # Фоновый перенос старых сообщений в холодный слой (между воркерами его сериализует flock)
+    archiver = asyncio.create_task(run_archiver(async_session)) if COLD_ARCHIVE_INTERVAL_SECONDS > 0 else None
     yield
+    if archiver is not None:
+        archiver.cancel()
+    if write_batcher is not None:
+        await write_batcher.close()
+    await manager.stop()
+    password_hasher.shutdown()
+    tracer.write()
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(TracingMiddleware)
 
 
 @app.get("/")
@@ -42,18 +71,24 @@ async def root():
 async def create_user(username: str, email: str, password: str, db=Depends(get_db)):
     user_service = UserService()
     try:
-        user = await user_service.create_user(db, username, email, get_password_hash(password))
+        user = await user_service.create_user(db, username, email, await password_hasher.hash(password))
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
     return {"id": user.id, "username": user.username, "email": user.email}
 
 
+@app.post("/users/bulk")
+async def create_users_bulk(request: Request):
+    # JSON-массив или NDJSON {"username", "email", "password"}; результат или ошибка на каждый элемент
+    return await bulk_response(request, "users", UserService().bulk_create_users)
+
+
 @app.post("/token")
 async def login(form_data: OAuth2PasswordRequestForm = Depends(), db=Depends(get_db)):
     user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
-    access_token = create_access_token(data={"sub": user.username})
+    access_token = create_access_token(data={"sub": user.username, "uid": user.id})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
@@ -68,21 +103,120 @@ async def create_chat(chat: ChatCreate, db=Depends(get_db)):
     return {"id": new_chat.id, "name": new_chat.name, "type": new_chat.type.value}
 
 
+@app.post("/chats/bulk")
+async def create_chats_bulk(request: Request):
+    # JSON-массив или NDJSON {"name", "user_ids"}; чаты и связи chat_users — многострочными INSERT
+    return await bulk_response(request, "chats", ChatService().bulk_create_chats)
+
+
+@app.post("/chats/{chat_id}/members")
+async def add_chat_members(chat_id: int, members: ChatMembersAdd, db=Depends(get_db)):
+    chat_service = ChatService()
+    try:
+        added = await chat_service.add_members(db, chat_id, members.user_ids)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if added:
+        await manager.broadcast(chat_id, {"action": "member_joined", "chat_id": chat_id, "user_ids": added})
+    return {"chat_id": chat_id, "added": added}
+
+
+@app.delete("/chats/{chat_id}/members/{user_id}")
+async def remove_chat_member(chat_id: int, user_id: int, db=Depends(get_db)):
+    chat_service = ChatService()
+    if not await chat_service.remove_member(db, chat_id, user_id):
+        raise HTTPException(status_code=404, detail="Member not found")
+    # Событие закроет сокеты удалённого участника на всех воркерах
+    await manager.broadcast(chat_id, {"action": "member_left", "chat_id": chat_id, "user_id": user_id})
+    return {"chat_id": chat_id, "removed": user_id}
+
+
 @app.get("/history/{chat_id}")
-async def get_history(chat_id: int, limit: int = 50, offset: int = 0, db=Depends(get_db)):
+async def get_history(chat_id: int, limit: int = 50, offset: int = 0, before_id: Optional[int] = None,
+                      after_id: Optional[int] = None, cursor: Optional[str] = None,
+                      order: Literal["asc", "desc"] = "asc", db=Depends(get_db)):
+    chat_service = ChatService()
+    if before_id is None and after_id is None and cursor is None and order == "asc":
+        # Старый режим: offset-пагинация от самых старых сообщений
+        messages = await chat_service.get_history(db, chat_id, limit, offset)
+        read_state = await chat_service.get_read_state(db, chat_id)
+        return [read_state.message_dict(msg) for msg in messages]
+
+    # Keyset-режим: before_id / after_id / cursor, order=desc без якоря — последние N сообщений
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    if offset:
+        raise HTTPException(status_code=400, detail="offset cannot be combined with cursor pagination")
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id")
+    try:
+        page = await chat_service.get_history_page(db, chat_id, limit, before_id, after_id, cursor, order)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    read_state = await chat_service.get_read_state(db, chat_id)
+    return {"messages": [read_state.message_dict(msg) for msg in page.messages], "next_cursor": page.next_cursor}
+
+
+@app.get("/chats/{chat_id}/export")
+async def export_history(chat_id: int, gzip: bool = False):
+    # Сессия открывается внутри генератора: она нужна, пока отдаётся ответ, а не только до return
+    async def body():
+        async with async_session() as db:
+            async for chunk in ChatService().export_history(db, chat_id, compress=gzip):
+                yield chunk
+
+    filename = f"chat-{chat_id}.ndjson" + (".gz" if gzip else "")
+    return StreamingResponse(
+        body(),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/chats/{chat_id}/search")
+async def search_chat(chat_id: int, q: str, limit: int = 20, cursor: Optional[str] = None, db=Depends(get_db)):
+    return await search_messages(db, [chat_id], q, limit, cursor)
+
+
+@app.get("/search")
+async def search_my_chats(q: str, limit: int = 20, cursor: Optional[str] = None,
+                          user: AuthenticatedUser = Depends(get_current_user), db=Depends(get_db)):
+    # Поиск по всем чатам пользователя
+    chat_ids = await ChatService().get_user_chat_ids(db, user.id)
+    return await search_messages(db, chat_ids, q, limit, cursor)
+
+
+async def search_messages(db, chat_ids: list[int], q: str, limit: int, cursor: Optional[str]):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Empty search query")
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be positive")
+    try:
+        page = await ChatService().search(db, chat_ids, q, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "messages": [{**message.to_dict(), "rank": rank} for message, rank in page.messages],
+        "next_cursor": page.next_cursor,
+    }
+
+
+@app.get("/me/unread")
+async def get_my_unread(user: AuthenticatedUser = Depends(get_current_user), db=Depends(get_db)):
+    # Бейджи непрочитанного по всем чатам пользователя из счётчиков в памяти
+    counts = await ChatService().get_unread_counts(db, user.id)
+    chats = [{"chat_id": chat_id, "unread": unread} for chat_id, unread in sorted(counts.items())]
+    return {"chats": chats, "total": sum(counts.values())}
+
+
+@app.get("/chats/{chat_id}/read_state")
+async def get_read_state(chat_id: int, db=Depends(get_db)):
+    # Позиции прочтения участников: сообщение прочитано всеми, если его id не больше позиций остальных участников
     chat_service = ChatService()
-    messages = await chat_service.get_history(db, chat_id, limit, offset)
-    return [
-        {
-            "id": msg.id,
-            "chat_id": msg.chat_id,
-            "sender_id": msg.sender_id,
-            "text": msg.text,
-            "created_at": msg.created_at.isoformat(),
-            "is_read": msg.is_read
-        }
-        for msg in messages
-    ]
+    watermarks = await chat_service.get_watermarks(db, chat_id)
+    return [{"user_id": w.user_id, "up_to": w.last_read_message_id} for w in watermarks]
 
 
 @app.post("/messages/{message_id}/read")
@@ -95,82 +229,214 @@ async def mark_message_read(message_id: int, db=Depends(get_db)):
     return {"message": "Message marked as read"}
 
 
+@app.get("/debug/traces")
+async def export_traces(format: Literal["chrome", "otlp"] = "chrome"):
+    # Накопленные трассы файлом для разбора офлайн: chrome://tracing / Perfetto или OTLP-приёмник
+    return JSONResponse(
+        tracer.export(format),
+        headers={"Content-Disposition": f'attachment; filename="traces.{format}.json"'},
+    )
+
+
+@app.get("/stats/connections")
+async def connection_stats():
+    # Глубина исходящих очередей по соединениям: самые отстающие клиенты первыми
+    return manager.connection_stats()
+
+
+@app.get("/stats/writes")
+async def write_stats():
+    # Размеры пачек group commit (пусто, если батчер выключен)
+    return write_batcher.stats() if write_batcher is not None else {"enabled": False}
+
+
+@app.get("/stats/auth")
+async def auth_stats():
+    # Очередь к пулу bcrypt: сколько логинов ждут и сколько ждали
+    return password_hasher.stats()
+
+
+@app.get("/stats/db")
+async def db_stats():
+    # Пул соединений: занятые соединения и ожидание выдачи
+    return pool_stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Формат экспозиции Prometheus; значения собираются только в этом процессе-воркере
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+async def resume_missed_messages(websocket: WebSocket, chat_id: int, last_seen_id: int):
+    # Пропуск больше RESUME_MAX_MESSAGES не досылаем: клиент получает resync_required и перечитывает историю
+    chat_service = ChatService()
+    reason = None
+    try:
+        async with async_session() as db:
+            page = await chat_service.get_history_page(db, chat_id, RESUME_MAX_MESSAGES, after_id=last_seen_id)
+        if page.next_cursor is not None:
+            reason = "gap_too_large"
+    except LookupError:
+        # Сообщения last_seen_id нет в этом чате: досылать не от чего
+        reason = "unknown_last_seen_id"
+    except Exception:
+        reason = "unavailable"
+    if reason is None:
+        manager.resume(websocket, [message.to_dict() for message in page.messages])
+    else:
+        manager.resume(websocket, [{"action": "resync_required", "chat_id": chat_id, "reason": reason}])
+
+
 @app.websocket("/ws/{chat_id}")
-async def websocket_endpoint(websocket: WebSocket, chat_id: int, db=Depends(get_db)):
+async def websocket_endpoint(websocket: WebSocket, chat_id: int):
+    # Сессия БД берётся только на время отдельной операции: простаивающий сокет не держит соединение пула
     token = websocket.query_params.get("token")
     if token is None:
         await websocket.close(code=1008)
         return
-    try:
-        user = await get_current_user(token, db)
-    except Exception:
-        await websocket.close(code=1008)
+    # Формат кадров согласуется при подключении: ?codec=json|orjson|msgpack
+    codec = get_codec(websocket.query_params.get("codec"))
+    if codec is None:
+        await websocket.close(code=1003)
         return
-    user_id = user.id
-
-    # Проверка, является ли пользователь участником чата:
-    result = await db.execute(
-        select(models.Chat)
-        .options(selectinload(models.Chat.users))
-        .where(models.Chat.id == chat_id)
-    )
-    chat = result.scalar_one_or_none()
-    if not chat or user_id not in [u.id for u in chat.users]:
-        await websocket.close(code=1008)
+    # ?last_seen_id=N: после переподключения сначала досылаются сообщения новее N
+    last_seen_id = websocket.query_params.get("last_seen_id")
+    if last_seen_id is not None:
+        try:
+            last_seen_id = int(last_seen_id)
+        except ValueError:
+            await websocket.close(code=1003)
+            return
+    # ?presence=1: сокет получает снимок и диффы присутствия и набора текста
+    with_presence = websocket.query_params.get("presence") in ("1", "true")
+    # ?batch=1: события за короткое окно приходят одним фреймом-массивом.
+    # ?compress=deflate: фреймы крупнее порога приходят бинарными, сжатыми raw deflate (только текстовые кодеки)
+    batch = websocket.query_params.get("batch") in ("1", "true")
+    compress = websocket.query_params.get("compress")
+    if compress not in (None, "deflate") or (compress is not None and codec.binary):
+        await websocket.close(code=1003)
         return
+    with tracer.root("ws.connect", chat_id=chat_id):
+        async with async_session() as db:
+            try:
+                user = await get_current_user(token, db)
+            except Exception:
+                await websocket.close(code=1008)
+                return
+            user_id = user.id
+
+            # Проверка, является ли пользователь участником чата: кэш состава или EXISTS по chat_users
+            with tracer.span("membership"):
+                is_member = await membership_cache.is_member(db, chat_id, user_id)
+            if not is_member:
+                await websocket.close(code=1008)
+                return
 
-    await manager.connect(chat_id, websocket)
+    # Сокет регистрируется до запроса пропущенных сообщений: всё, что разослано после этого,
+    # копится в его очереди, поэтому на стыке досылки и живой рассылки ничего не теряется
+    await manager.connect(chat_id, websocket, user_id, codec, paused=last_seen_id is not None,
+                          ephemeral=with_presence, batch=batch, compress=compress is not None)
     try:
+        if last_seen_id is not None:
+            await resume_missed_messages(websocket, chat_id, last_seen_id)
+        if with_presence:
+            await manager.send_personal(websocket, presence.snapshot(chat_id))
         while True:
-            data = await websocket.receive_text()
-            try:
-                message_data = json.loads(data)
-            except json.JSONDecodeError:
-                await websocket.send_json({"error": "Invalid message format"})
-                continue
-
-            # Обработка события прочтения
-            if message_data.get("action") == "read":
-                message_id = message_data.get("message_id")
-                if message_id is None:
-                    await websocket.send_json({"error": "Missing message_id for read action"})
-                    continue
-                message_service = MessageService()
-                try:
-                    await message_service.mark_read(db, message_id)
-                except Exception as e:
-                    await websocket.send_json({"error": str(e)})
-                    continue
-                notification = {"action": "read_update", "message_id": message_id, "is_read": True}
-                await manager.broadcast(chat_id, notification)
-                continue
-
-            text = message_data.get("text")
-            if not text:
-                await websocket.send_json({"error": "No text provided"})
-                continue
-
-            # Предотвращаем дублирование сообщений
-            current_time = time.time()
-            if manager.is_duplicate(chat_id, user_id, text, current_time):
-                await websocket.send_json({"error": "Duplicate message detected"})
-                continue
-
-            message_service = MessageService()
-            try:
-                new_message = await message_service.create_message(db, chat_id, user_id, text)
-            except Exception as e:
-                await websocket.send_json({"error": "Error saving message: " + str(e)})
-                continue
-
-            message_to_send = {
-                "id": new_message.id,
-                "chat_id": chat_id,
-                "sender_id": user_id,
-                "text": text,
-                "created_at": new_message.created_at.isoformat(),
-                "is_read": new_message.is_read
-            }
-            await manager.broadcast(chat_id, message_to_send)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            with tracer.root("ws.event", chat_id=chat_id, user_id=user_id) as span:
+                await handle_ws_frame(websocket, chat_id, user_id, codec, frame, span)
     except WebSocketDisconnect:
+        pass
+    finally:
+        flow_control.release_socket(websocket)
         manager.disconnect(chat_id, websocket)
+
+
+def count_ws_event(span, kind: str):
+    WS_MESSAGES_RECEIVED.inc(1, (kind,))
+    if span is not None:
+        span.name = f"ws.{kind}"
+
+
+async def handle_ws_frame(websocket: WebSocket, chat_id: int, user_id: int, codec, frame: dict, span=None):
+    # Один входящий фрейм; в трассе — корневой спан WebSocket-события (span None вне выборки).
+    # Лимиты сокета, пользователя и чата проверяются до разбора фрейма и любой работы с БД
+    throttled = flow_control.acquire(websocket, user_id, chat_id)
+    if throttled is not None:
+        if span is not None:
+            span.name = "ws.throttled"
+        await manager.send_personal(websocket, throttled.error())
+        return
+    data = frame.get("text")
+    if data is None:
+        data = frame.get("bytes")
+    try:
+        message_data = codec.decode(data)
+    except CodecError:
+        message_data = None
+    if not isinstance(message_data, dict):
+        count_ws_event(span, "invalid")
+        await manager.send_personal(websocket, {"error": "Invalid message format"})
+        return
+
+    # Набор текста не сохраняется и не трогает БД: только индикатор в памяти, дебаунс и рассылка по тику
+    if message_data.get("action") == "typing":
+        count_ws_event(span, "typing")
+        presence.set_typing(chat_id, user_id, message_data.get("state", True) is not False)
+        return
+
+    # Обработка события прочтения: {"action": "read", "up_to": id} продвигает позицию прочтения
+    # участника одним UPSERT. Старый формат с message_id читается как up_to.
+    if message_data.get("action") == "read":
+        count_ws_event(span, "read")
+        up_to = message_data.get("up_to", message_data.get("message_id"))
+        if not isinstance(up_to, int) or isinstance(up_to, bool):
+            await manager.send_personal(websocket, {"error": "Missing up_to for read action"})
+            return
+        message_service = MessageService()
+        try:
+            async with async_session() as db:
+                watermark = await message_service.mark_read_up_to(db, chat_id, user_id, up_to)
+        except Exception as e:
+            await manager.send_personal(websocket, {"error": str(e)})
+            return
+        read_receipts.add(chat_id, user_id, watermark)
+        return
+
+    count_ws_event(span, "message")
+    text = message_data.get("text")
+    if not text:
+        await manager.send_personal(websocket, {"error": "No text provided"})
+        return
+    if not isinstance(text, str):
+        await manager.send_personal(websocket, {"error": "text must be a string"})
+        return
+
+    # Повтор с тем же client_msg_id отсекается уникальным ключом в БД (в т.ч. после
+    # переподключения к другому воркеру); без ключа — окном по одинаковому тексту
+    client_msg_id = message_data.get("client_msg_id")
+    if client_msg_id is not None and (not isinstance(client_msg_id, str) or not 0 < len(client_msg_id) <= 64):
+        await manager.send_personal(websocket, {"error": "client_msg_id must be a string of 1-64 characters"})
+        return
+    current_time = time.time()
+    if client_msg_id is None and manager.is_duplicate(chat_id, user_id, text, current_time):
+        await manager.send_personal(websocket, {"error": "Duplicate message detected"})
+        return
+
+    message_service = MessageService(write_batcher)
+    try:
+        async with async_session() as db:
+            new_message = await message_service.create_message(db, chat_id, user_id, text, client_msg_id)
+    except DuplicateMessageError as e:
+        # Сообщение уже разослано: подтверждаем его только отправителю
+        DUPLICATES_REJECTED.inc(1, ("client_msg_id",))
+        await manager.send_personal(websocket, {**e.message.to_dict(), "duplicate": True})
+        return
+    except Exception as e:
+        await manager.send_personal(websocket, {"error": "Error saving message: " + str(e)})
+        return
+
+    await manager.broadcast(chat_id, new_message.to_dict())
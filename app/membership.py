@@ -0,0 +1,90 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, Iterable, Optional, Set
+from app.repositories import ChatRepository
+
+MEMBERSHIP_CACHE_TTL_SECONDS = float(os.getenv("MEMBERSHIP_CACHE_TTL_SECONDS", "300"))
+MEMBERSHIP_CACHE_MAX_CHATS = int(os.getenv("MEMBERSHIP_CACHE_MAX_CHATS", "10000"))
+
+
+class MembershipCache:
+    """chat_id -> множество user_id участников.
+
+    Наполняется при создании чата и изменении состава; при промахе (TTL истёк, воркер
+    перезапущен) состав читается одним запросом id из chat_users и снова попадает в кэш.
+    Изменения состава с других воркеров приходят событиями шины: on_cached / on_dropped
+    позволяют держать подписку на чат, пока он в кэше, даже без открытых сокетов.
+    TTL — страховка на случай потерянного события.
+    """
+
+    def __init__(self, ttl: float = MEMBERSHIP_CACHE_TTL_SECONDS, max_chats: int = MEMBERSHIP_CACHE_MAX_CHATS):
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self._members: "OrderedDict[int, tuple]" = OrderedDict()
+        self.on_cached: Optional[Callable[[int], None]] = None
+        self.on_dropped: Optional[Callable[[int], None]] = None
+        # Растёт при любом изменении состава: загрузка, во время которой состав менялся, не кэшируется
+        self._version = 0
+
+    def holds(self, chat_id: int) -> bool:
+        return chat_id in self._members
+
+    def _drop(self, chat_id: int):
+        if self._members.pop(chat_id, None) is not None and self.on_dropped is not None:
+            self.on_dropped(chat_id)
+
+    def get_members(self, chat_id: int) -> Optional[Set[int]]:
+        entry = self._members.get(chat_id)
+        if entry is None:
+            return None
+        members, expires_at = entry
+        if expires_at <= time.monotonic():
+            self._drop(chat_id)
+            return None
+        self._members.move_to_end(chat_id)
+        return members
+
+    def set_members(self, chat_id: int, user_ids: Iterable[int]):
+        self._version += 1
+        cached = chat_id in self._members
+        self._members[chat_id] = (set(user_ids), time.monotonic() + self.ttl)
+        self._members.move_to_end(chat_id)
+        if not cached and self.on_cached is not None:
+            self.on_cached(chat_id)
+        if len(self._members) > self.max_chats:
+            self._drop(next(iter(self._members)))
+
+    def add_members(self, chat_id: int, user_ids: Iterable[int]):
+        self._version += 1
+        members = self.get_members(chat_id)
+        if members is not None:
+            members.update(user_ids)
+
+    def remove_member(self, chat_id: int, user_id: int):
+        self._version += 1
+        members = self.get_members(chat_id)
+        if members is not None:
+            members.discard(user_id)
+
+    def invalidate(self, chat_id: int):
+        self._version += 1
+        self._drop(chat_id)
+
+    def clear(self):
+        for chat_id in list(self._members):
+            self._drop(chat_id)
+
+    async def is_member(self, db, chat_id: int, user_id: int) -> bool:
+        members = self.get_members(chat_id)
+        if members is not None:
+            return user_id in members
+        version = self._version
+        members = await ChatRepository(db).get_member_ids(chat_id)
+        if self._version == version and chat_id not in self._members:
+            # Без записи в кэше фильтр рассылки не отсекал бы удалённых участников
+            self.set_members(chat_id, members)
+        return user_id in members
+
+
+membership_cache = MembershipCache()
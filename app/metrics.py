@@ -0,0 +1,209 @@
+import bisect
+import functools
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from app.tracing import tracer
+
+# Границы по умолчанию для задержек, с
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric"):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        if registry is not None:
+            registry.register(self)
+
+    def render(self) -> Iterable[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """Монотонный счётчик. Запись — одно сложение в словаре, без блокировок (всё в одном event loop)."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, labels: Labels = ()):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, labels: Labels = ()) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """Значение, которое может расти и падать. С function значения вычисляются в момент сбора:
+    function возвращает число или словарь {кортеж значений меток: число}."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 function: Optional[Callable] = None, registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = function
+        self._values: Dict[Labels, float] = {}
+
+    def set(self, value: float, labels: Labels = ()):
+        self._values[labels] = value
+
+    def inc(self, amount: float = 1.0, labels: Labels = ()):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, labels: Labels = ()):
+        self.inc(-amount, labels)
+
+    def values(self) -> Dict[Labels, float]:
+        if self.function is None:
+            return self._values
+        result = self.function()
+        return result if isinstance(result, dict) else {(): result}
+
+    def render(self) -> Iterable[str]:
+        for labels, value in self.values().items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class CounterFunction(Gauge):
+    # Счётчик, который ведётся в другом месте (статистика батчера, пула и т.п.) и читается при сборе
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, function: Callable, labelnames: Sequence[str] = (),
+                 registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, documentation, labelnames, function, registry)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, registry: Optional[Registry] = REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [счётчики по корзинам..., +Inf], сумма
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def count(self, labels: Labels = ()) -> int:
+        return sum(self._counts.get(labels, ()))
+
+    def time(self, labels: Labels = ()):
+        return _Timer(self, labels)
+
+    def render(self) -> Iterable[str]:
+        for labels, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(self._sums[labels])}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "started_at")
+
+    def __init__(self, histogram: Histogram, labels: Labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started_at, self.labels)
+
+
+def observe_latency(histogram: Histogram, *labels: str):
+    """Декоратор для корутин: время выполнения пишется в гистограмму с заданными метками."""
+
+    def decorator(func):
+        # Внутри трассы (app.tracing) вызов заодно становится дочерним спаном
+        traced = tracer.traced(func.__qualname__)(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await traced(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started_at, labels)
+        return wrapper
+    return decorator
+
+
+# Метрики горячего пути, общие для нескольких модулей
+WS_MESSAGES_RECEIVED = Counter("fastchat_ws_messages_received_total", "Inbound WebSocket frames", ["kind"])
+WS_FRAMES_SENT = Counter("fastchat_ws_frames_sent_total", "Outbound WebSocket frames written to sockets")
+BROADCAST_SECONDS = Histogram("fastchat_broadcast_seconds", "Time to fan out one chat event into local socket outboxes")
+BUS_PUBLISH_SECONDS = Histogram("fastchat_bus_publish_seconds", "Time to publish one chat event to the bus")
+BROADCAST_RECIPIENTS = Histogram(
+    "fastchat_broadcast_recipients", "Local sockets an event was enqueued to",
+    buckets=(1, 2, 5, 10, 50, 100, 500, 1000, 5000),
+)
+DUPLICATES_REJECTED = Counter("fastchat_duplicates_rejected_total", "Rejected duplicate messages", ["reason"])
+REPOSITORY_SECONDS = Histogram("fastchat_repository_seconds", "Time spent in repository operations", ["operation"])
+DB_STATEMENT_SECONDS = Histogram("fastchat_db_statement_seconds", "Per-statement database time", ["statement"])
+AUTH_SECONDS = Histogram("fastchat_auth_seconds", "Authentication time by stage", ["stage"])
@@ -1,10 +1,16 @@
 import datetime
 import enum
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Table, Enum
+import os
+from sqlalchemy import (
+    DDL, Column, Integer, String, Boolean, DateTime, ForeignKey, Table, Enum, Index, UniqueConstraint, event
+)
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
 
+# Конфигурация полнотекстового поиска PostgreSQL ('simple' не зависит от языка сообщений)
+SEARCH_TS_CONFIG = os.getenv("SEARCH_TS_CONFIG", "simple")
+
 
 class ChatType(str, enum.Enum):
     personal = "personal"
@@ -41,14 +47,54 @@ class Chat(Base):
     messages = relationship("Message", back_populates="chat")
 
 
+class ChatReadWatermark(Base):
+    # Позиция прочтения участника: прочитаны все сообщения чата с id <= last_read_message_id
+    __tablename__ = "chat_read_watermarks"
+    chat_id = Column(Integer, ForeignKey("chats.id"), primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+
 class Message(Base):
     __tablename__ = "messages"
+    # Keyset-пагинация истории чата идёт по (created_at, id) внутри chat_id
+    __table_args__ = (
+        Index("ix_messages_chat_created_id", "chat_id", "created_at", "id"),
+        # Идемпотентность повторных отправок: один client_msg_id на отправителя
+        UniqueConstraint("sender_id", "client_msg_id", name="uq_messages_sender_client_msg_id"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("chats.id"))
     sender_id = Column(Integer, ForeignKey("users.id"))
     text = Column(String)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     is_read = Column(Boolean, default=False)
+    client_msg_id = Column(String(64), nullable=True)  # ключ идемпотентности от клиента
 
     chat = relationship("Chat", back_populates="messages")
     sender = relationship("User", back_populates="messages")
+
+    def to_dict(self) -> dict:
+        # Единое представление сообщения для REST-ответов и WebSocket-рассылки
+        data = {
+            "id": self.id,
+            "chat_id": self.chat_id,
+            "sender_id": self.sender_id,
+            "text": self.text,
+            "created_at": self.created_at.isoformat(),
+            "is_read": self.is_read
+        }
+        if self.client_msg_id is not None:
+            data["client_msg_id"] = self.client_msg_id
+        return data
+
+
+# Поисковый вектор — вычисляемая колонка PostgreSQL: обновляется самой базой при INSERT/UPDATE.
+# В модели её нет, чтобы схема создавалась и на SQLite; запросы обращаются к ней по имени.
+for statement in (
+    "ALTER TABLE messages ADD COLUMN search_vector tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_TS_CONFIG}', coalesce(text, ''))) STORED",
+    "CREATE INDEX ix_messages_search_vector ON messages USING GIN (search_vector)",
+):
+    event.listen(Message.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
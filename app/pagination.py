@@ -0,0 +1,58 @@
+import base64
+import datetime
+import json
+from typing import Optional, Tuple
+
+BEFORE = "before"
+AFTER = "after"
+
+# Ключ сортировки сообщения в чате: (created_at, id)
+MessageKey = Tuple[datetime.datetime, int]
+
+
+def _encode(payload: dict) -> str:
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _decode(cursor: str) -> dict:
+    payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    if not isinstance(payload, dict):
+        raise ValueError("Invalid cursor")
+    return payload
+
+
+def encode_cursor(direction: str, key: MessageKey, order: str) -> str:
+    return _encode({"d": direction, "t": key[0].isoformat(), "i": key[1], "o": order})
+
+
+def decode_cursor(cursor: str) -> Tuple[str, MessageKey, str]:
+    """Разбирает непрозрачный курсор. Бросает ValueError, если курсор повреждён."""
+    try:
+        payload = _decode(cursor)
+        direction, order = payload["d"], payload["o"]
+        key = (datetime.datetime.fromisoformat(payload["t"]), int(payload["i"]))
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if direction not in (BEFORE, AFTER) or order not in ("asc", "desc"):
+        raise ValueError("Invalid cursor")
+    return direction, key, order
+
+
+def encode_search_cursor(key: Tuple[float, int]) -> str:
+    # Курсор поиска: (rank, id) последнего результата страницы
+    return _encode({"r": key[0], "i": key[1]})
+
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        payload = _decode(cursor)
+        return float(payload["r"]), int(payload["i"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+class HistoryPage:
+    def __init__(self, messages: list, next_cursor: Optional[str]):
+        self.messages = messages
+        self.next_cursor = next_cursor
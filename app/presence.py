@@ -0,0 +1,218 @@
+import asyncio
+import os
+import time
+import uuid
+from typing import Dict, NamedTuple, Set
+from app.connection_manager import PRESENCE_SYNC_ACTION, manager
+
+PRESENCE_TICK_MS = float(os.getenv("PRESENCE_TICK_MS", "250"))
+TYPING_TTL_SECONDS = float(os.getenv("TYPING_TTL_SECONDS", "5"))
+# Общая шина (CHAT_BUS=unix): как часто воркер повторяет своё состояние и когда чужое считается устаревшим
+PRESENCE_HEARTBEAT_SECONDS = float(os.getenv("PRESENCE_HEARTBEAT_SECONDS", "10"))
+PRESENCE_REMOTE_TTL_SECONDS = float(os.getenv("PRESENCE_REMOTE_TTL_SECONDS", "30"))
+
+
+class _WorkerState(NamedTuple):
+    online: frozenset
+    typing: frozenset
+    expires_at: float
+
+
+class PresenceTracker:
+    """Эфемерные события присутствия и набора текста: не сохраняются в БД.
+
+    Присутствие выводится из открытых сокетов чата (любое устройство пользователя — online).
+    Набор текста дебаунсится: повторные {"action": "typing"} лишь продлевают TTL.
+    Изменения копятся и раз в тик отправляются локальным сокетам одним диффом на чат.
+    При общей шине воркеры обмениваются своими локальными состояниями (presence_sync),
+    и каждый воркер считает диффы по объединённому состоянию всех воркеров.
+    """
+
+    def __init__(self, manager, tick_ms: float = PRESENCE_TICK_MS, typing_ttl: float = TYPING_TTL_SECONDS,
+                 heartbeat: float = PRESENCE_HEARTBEAT_SECONDS, remote_ttl: float = PRESENCE_REMOTE_TTL_SECONDS):
+        self.manager = manager
+        self.tick = tick_ms / 1000
+        self.typing_ttl = typing_ttl
+        self.heartbeat = heartbeat
+        self.remote_ttl = remote_ttl
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        # Последнее разосланное клиентам состояние по чатам
+        self.online: Dict[int, Set[int]] = {}
+        self.typing_published: Dict[int, Set[int]] = {}
+        # chat_id -> {user_id: момент, когда индикатор набора гаснет} (только сокеты этого воркера)
+        self.typing: Dict[int, Dict[int, float]] = {}
+        # chat_id -> worker_id -> состояние другого воркера
+        self.remote: Dict[int, Dict[str, _WorkerState]] = {}
+        # Последнее локальное состояние, опубликованное другим воркерам
+        self.local_published: Dict[int, tuple] = {}
+        self.republish: Set[int] = set()
+        self.dirty: Set[int] = set()
+        self._timer = None
+        self._heartbeat_timer = None
+        self._tasks = set()
+        manager.on_connections_changed = self.touch
+        manager.on_internal_event = self._on_sync
+
+    @property
+    def shared(self) -> bool:
+        return getattr(self.manager.bus, "shared", False)
+
+    def local_online(self, chat_id: int) -> Set[int]:
+        users = set()
+        for websocket in self.manager.active_connections.get(chat_id, ()):
+            outbox = self.manager.outboxes.get(websocket)
+            if outbox is not None and outbox.user_id is not None:
+                users.add(outbox.user_id)
+        return users
+
+    def _local_typing(self, chat_id: int, online: Set[int], now: float) -> Set[int]:
+        typing_users = self.typing.get(chat_id, {})
+        for user_id in [u for u, expires_at in typing_users.items() if expires_at <= now or u not in online]:
+            del typing_users[user_id]
+        if not typing_users:
+            self.typing.pop(chat_id, None)
+        return set(typing_users)
+
+    def _remote_states(self, chat_id: int, now: float) -> list:
+        states = self.remote.get(chat_id)
+        if not states:
+            return []
+        for worker_id in [w for w, state in states.items() if state.expires_at <= now]:
+            del states[worker_id]
+        if not states:
+            del self.remote[chat_id]
+        return list(states.values())
+
+    def online_users(self, chat_id: int) -> Set[int]:
+        users = self.local_online(chat_id)
+        for state in self._remote_states(chat_id, time.monotonic()):
+            users |= state.online
+        return users
+
+    def snapshot(self, chat_id: int) -> dict:
+        now = time.monotonic()
+        online = self.local_online(chat_id)
+        typing = {user_id for user_id, expires_at in self.typing.get(chat_id, {}).items() if expires_at > now}
+        for state in self._remote_states(chat_id, now):
+            online |= state.online
+            typing |= state.typing
+        return {"action": "presence", "chat_id": chat_id, "online": sorted(online), "typing": sorted(typing)}
+
+    def touch(self, chat_id: int):
+        self.dirty.add(chat_id)
+        if self._timer is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            self._timer = loop.call_later(self.tick, self._flush)
+
+    def set_typing(self, chat_id: int, user_id: int, typing: bool = True):
+        if typing:
+            users = self.typing.setdefault(chat_id, {})
+            started = user_id not in users
+            users[user_id] = time.monotonic() + self.typing_ttl
+            if started:
+                self.touch(chat_id)
+        elif self.typing.get(chat_id, {}).pop(user_id, None) is not None:
+            self.touch(chat_id)
+
+    def _on_sync(self, chat_id: int, message: dict):
+        # Состояние другого воркера пришло по шине; своё же событие шина доставляет и нам — пропускаем
+        if message.get("action") != PRESENCE_SYNC_ACTION or message.get("worker") == self.worker_id:
+            return
+        states = self.remote.setdefault(chat_id, {})
+        if message["online"] or message["typing"]:
+            states[message["worker"]] = _WorkerState(
+                frozenset(message["online"]), frozenset(message["typing"]), time.monotonic() + self.remote_ttl
+            )
+        else:
+            states.pop(message["worker"], None)
+        if not states:
+            del self.remote[chat_id]
+        if message.get("request") and chat_id in self.local_published:
+            # Воркер впервые обслуживает чат и просит остальных прислать состояние
+            self.republish.add(chat_id)
+        self.touch(chat_id)
+
+    def _publish(self, chat_id: int, online: Set[int], typing: Set[int]):
+        state = (frozenset(online), frozenset(typing))
+        previous = self.local_published.get(chat_id)
+        if previous == state and chat_id not in self.republish:
+            return
+        self.republish.discard(chat_id)
+        message = {
+            "action": PRESENCE_SYNC_ACTION,
+            "chat_id": chat_id,
+            "worker": self.worker_id,
+            "online": sorted(online),
+            "typing": sorted(typing),
+        }
+        if previous is None:
+            message["request"] = True
+        if online:
+            self.local_published[chat_id] = state
+        else:
+            self.local_published.pop(chat_id, None)
+        task = asyncio.create_task(self.manager.bus.publish(chat_id, message))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _diff(self, chat_id: int, now: float):
+        local_online = self.local_online(chat_id)
+        local_typing = self._local_typing(chat_id, local_online, now)
+        if self.shared and (local_online or chat_id in self.local_published):
+            self._publish(chat_id, local_online, local_typing)
+        online, typing = set(local_online), set(local_typing)
+        for state in self._remote_states(chat_id, now):
+            online |= state.online
+            typing |= state.typing
+        typing &= online
+        previous_online = self.online.get(chat_id, set())
+        previous_typing = self.typing_published.get(chat_id, set())
+
+        if online:
+            self.online[chat_id] = online
+        else:
+            self.online.pop(chat_id, None)
+        if typing:
+            self.typing_published[chat_id] = typing
+        else:
+            self.typing_published.pop(chat_id, None)
+
+        diff = {
+            "online": sorted(online - previous_online),
+            "offline": sorted(previous_online - online),
+            "typing": sorted(typing - previous_typing),
+            "stopped_typing": sorted(previous_typing - typing),
+        }
+        if not any(diff.values()):
+            return None
+        return {"action": "presence", "chat_id": chat_id, **diff}
+
+    def _flush(self):
+        self._timer = None
+        now = time.monotonic()
+        chats, self.dirty = self.dirty, set()
+        for chat_id in chats:
+            diff = self._diff(chat_id, now)
+            if diff is not None:
+                # Каждый воркер сам оповещает свои сокеты: по шине диффы не идут
+                self.manager.send_local(chat_id, diff)
+        # Пока кто-то набирает текст, проверяем истечение индикаторов каждый тик
+        for chat_id in self.typing:
+            self.touch(chat_id)
+        if self.shared and (self.local_published or self.remote) and self._heartbeat_timer is None:
+            self._heartbeat_timer = asyncio.get_running_loop().call_later(self.heartbeat, self._on_heartbeat)
+
+    def _on_heartbeat(self):
+        # Повторяем своё состояние (новые и потерявшие его воркеры) и проверяем устаревание чужих
+        self._heartbeat_timer = None
+        for chat_id in list(self.local_published):
+            self.republish.add(chat_id)
+            self.touch(chat_id)
+        for chat_id in list(self.remote):
+            self.touch(chat_id)
+
+
+presence = PresenceTracker(manager)
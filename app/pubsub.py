@@ -0,0 +1,272 @@
+import asyncio
+import fcntl
+import logging
+import os
+from typing import Callable, Dict, Optional, Set
+from app.codecs import JSON_CODEC, get_codec
+
+logger = logging.getLogger(__name__)
+
+CHAT_BUS = os.getenv("CHAT_BUS", "inprocess")
+CHAT_BUS_PATH = os.getenv("CHAT_BUS_PATH", "/tmp/fastchat-bus.sock")
+# Предел длины одного события на проводе (у StreamReader по умолчанию всего 64 КиБ)
+CHAT_BUS_MAX_LINE_BYTES = int(os.getenv("CHAT_BUS_MAX_LINE_BYTES", str(16 * 1024 * 1024)))
+
+# Если воркер не успевает читать, хаб отключает его (воркер переподключится и переподпишется)
+HUB_CLIENT_MAX_BUFFER = 16 * 1024 * 1024
+RECONNECT_DELAY = 0.2
+
+# Обработчик доставки события локальным сокетам: (chat_id, message, key) -> None
+DeliveryHandler = Callable[[int, dict, Optional[str]], None]
+
+_wire_codec = get_codec("orjson") or JSON_CODEC
+
+
+def _encode_line(payload: dict) -> bytes:
+    return _wire_codec.encode(payload).encode("utf-8") + b"\n"
+
+
+async def _read_line(reader: asyncio.StreamReader) -> Optional[bytes]:
+    """Следующая строка; None — строка длиннее предела (она уже пропущена, поток читается дальше)."""
+    try:
+        return await reader.readline()
+    except ValueError:
+        logger.warning("Bus: event longer than %d bytes dropped", CHAT_BUS_MAX_LINE_BYTES)
+        return None
+
+
+class InProcessBus:
+    """Шина для одного процесса: событие сразу доставляется локальным подписчикам."""
+
+    # Доходят ли события до других процессов
+    shared = False
+
+    def __init__(self):
+        self.subscriptions: Set[int] = set()
+        self._handler: Optional[DeliveryHandler] = None
+
+    def set_handler(self, handler: DeliveryHandler):
+        self._handler = handler
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, chat_id: int):
+        self.subscriptions.add(chat_id)
+
+    def unsubscribe(self, chat_id: int):
+        self.subscriptions.discard(chat_id)
+
+    def _deliver_local(self, chat_id: int, message: dict, key: Optional[str]):
+        if chat_id in self.subscriptions and self._handler is not None:
+            self._handler(chat_id, message, key)
+
+    async def publish(self, chat_id: int, message: dict, key: Optional[str] = None):
+        self._deliver_local(chat_id, message, key)
+
+
+class UnixSocketHub:
+    """Маршрутизатор событий между воркерами одного хоста через Unix-сокет.
+
+    Каждый воркер сообщает, на какие чаты он подписан, и хаб пересылает событие
+    только тем воркерам, у которых есть подписчики этого чата.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.subscribers: Dict[int, Set[asyncio.StreamWriter]] = {}
+        self._clients: Set[asyncio.StreamWriter] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_client, path=self.path,
+                                                       limit=CHAT_BUS_MAX_LINE_BYTES)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._clients):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        chats: Set[int] = set()
+        self._clients.add(writer)
+        try:
+            while True:
+                line = await _read_line(reader)
+                if line is None:
+                    continue
+                if not line:
+                    break
+                try:
+                    event = _wire_codec.decode(line)
+                except ValueError:
+                    continue
+                op, chat_id = event.get("op"), event.get("chat_id")
+                if op == "sub":
+                    chats.add(chat_id)
+                    self.subscribers.setdefault(chat_id, set()).add(writer)
+                elif op == "unsub":
+                    chats.discard(chat_id)
+                    self._remove(chat_id, writer)
+                elif op == "pub":
+                    self._forward(chat_id, line, origin=writer)
+        except ConnectionError:
+            pass
+        finally:
+            for chat_id in chats:
+                self._remove(chat_id, writer)
+            self._clients.discard(writer)
+            writer.close()
+
+    def _remove(self, chat_id: int, writer: asyncio.StreamWriter):
+        writers = self.subscribers.get(chat_id)
+        if writers is not None:
+            writers.discard(writer)
+            if not writers:
+                del self.subscribers[chat_id]
+
+    def _forward(self, chat_id: int, line: bytes, origin: asyncio.StreamWriter):
+        for writer in list(self.subscribers.get(chat_id, ())):
+            if writer is origin:
+                continue
+            if writer.transport.get_write_buffer_size() > HUB_CLIENT_MAX_BUFFER:
+                logger.warning("Bus hub: dropping stalled worker connection")
+                writer.close()
+                continue
+            writer.write(line)
+
+
+class UnixSocketBus(InProcessBus):
+    """Шина между воркерами одного хоста. Хабом становится воркер, захвативший lock-файл."""
+
+    shared = True
+
+    def __init__(self, path: str = CHAT_BUS_PATH):
+        super().__init__()
+        self.path = path
+        self.hub: Optional[UnixSocketHub] = None
+        self._lock_fd: Optional[int] = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self):
+        self._stopping = False
+        await self._connect()
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def stop(self):
+        self._stopping = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self.hub is not None:
+            await self.hub.stop()
+            self.hub = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _try_become_hub(self) -> bool:
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self.path + ".lock", os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    async def _connect(self):
+        while True:
+            if self.hub is None and self._try_become_hub():
+                self.hub = UnixSocketHub(self.path)
+                await self.hub.start()
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(
+                    self.path, limit=CHAT_BUS_MAX_LINE_BYTES
+                )
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                # Хаб ещё запускается или его процесс только что упал
+                await asyncio.sleep(RECONNECT_DELAY)
+        for chat_id in self.subscriptions:
+            self._send({"op": "sub", "chat_id": chat_id})
+
+    async def _read_loop(self):
+        while not self._stopping:
+            try:
+                line = await _read_line(self._reader)
+            except ConnectionError:
+                line = b""
+            if line is None:
+                continue
+            if not line:
+                self._writer = None
+                if self._stopping:
+                    return
+                await self._connect()
+                continue
+            try:
+                event = _wire_codec.decode(line)
+            except ValueError:
+                continue
+            if event.get("op") == "pub":
+                self._deliver_local(event["chat_id"], event["message"], event.get("key"))
+
+    def _send(self, payload: dict):
+        if self._writer is not None:
+            line = _encode_line(payload)
+            if len(line) > CHAT_BUS_MAX_LINE_BYTES:
+                # Хаб всё равно не примет такую строку: не гоняем её по сокету
+                logger.warning("Bus: event of %d bytes exceeds CHAT_BUS_MAX_LINE_BYTES, not sent", len(line))
+                return
+            self._writer.write(line)
+
+    def subscribe(self, chat_id: int):
+        if chat_id not in self.subscriptions:
+            super().subscribe(chat_id)
+            self._send({"op": "sub", "chat_id": chat_id})
+
+    def unsubscribe(self, chat_id: int):
+        if chat_id in self.subscriptions:
+            super().unsubscribe(chat_id)
+            self._send({"op": "unsub", "chat_id": chat_id})
+
+    async def publish(self, chat_id: int, message: dict, key: Optional[str] = None):
+        # Локальным сокетам доставляем сразу, остальным воркерам — через хаб
+        self._deliver_local(chat_id, message, key)
+        if self._writer is not None:
+            writer = self._writer
+            self._send({"op": "pub", "chat_id": chat_id, "message": message, "key": key})
+            try:
+                await writer.drain()
+            except ConnectionError:
+                # Цикл чтения сам переподключится к хабу
+                pass
+
+
+def create_bus(kind: str = CHAT_BUS):
+    if kind == "inprocess":
+        return InProcessBus()
+    if kind == "unix":
+        return UnixSocketBus(CHAT_BUS_PATH)
+    raise ValueError(f"Unknown chat bus: {kind}")
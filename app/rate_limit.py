@@ -0,0 +1,116 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, NamedTuple, Optional
+from app.metrics import Counter
+
+# Скорость (событий/с) и ёмкость корзин; скорость 0 отключает ограничение уровня
+WS_RATE_PER_SOCKET = float(os.getenv("WS_RATE_PER_SOCKET", "10"))
+WS_BURST_PER_SOCKET = float(os.getenv("WS_BURST_PER_SOCKET", "20"))
+WS_RATE_PER_USER = float(os.getenv("WS_RATE_PER_USER", "20"))
+WS_BURST_PER_USER = float(os.getenv("WS_BURST_PER_USER", "40"))
+WS_RATE_PER_CHAT = float(os.getenv("WS_RATE_PER_CHAT", "200"))
+WS_BURST_PER_CHAT = float(os.getenv("WS_BURST_PER_CHAT", "400"))
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+THROTTLED = Counter("fastchat_throttled_total", "Inbound WebSocket frames rejected by flow control", ["scope"])
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def retry_after(self) -> float:
+        # Через сколько секунд наберётся один жетон (после refill)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class _BucketLevel:
+    """Корзины одного уровня (сокет, пользователь или чат) с вытеснением давно не использованных."""
+
+    def __init__(self, scope: str, rate: float, burst: float, max_buckets: int):
+        self.scope = scope
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.max_buckets = max_buckets
+        self.buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def get(self, key: Hashable, now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            # Вытесненная корзина просто начнёт заново полной
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+            if len(self.buckets) > self.max_buckets:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+            bucket.refill(now)
+        return bucket
+
+
+class Throttled(NamedTuple):
+    scope: str
+    retry_after: float
+
+    def error(self) -> dict:
+        return {
+            "error": "Rate limit exceeded",
+            "code": "rate_limited",
+            "scope": self.scope,
+            "retry_after": round(self.retry_after, 3),
+        }
+
+
+class FlowController:
+    """Ограничение входящих фреймов корзинами жетонов на сокет, пользователя (все устройства) и чат.
+
+    Жетон списывается сразу со всех уровней и только если их хватает везде:
+    отклонённый на уровне чата фрейм не расходует лимит пользователя.
+    Лимиты действуют в пределах одного воркера.
+    """
+
+    def __init__(self, socket_rate: float = WS_RATE_PER_SOCKET, socket_burst: float = WS_BURST_PER_SOCKET,
+                 user_rate: float = WS_RATE_PER_USER, user_burst: float = WS_BURST_PER_USER,
+                 chat_rate: float = WS_RATE_PER_CHAT, chat_burst: float = WS_BURST_PER_CHAT,
+                 max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.sockets = _BucketLevel("socket", socket_rate, socket_burst, max_buckets)
+        self.users = _BucketLevel("user", user_rate, user_burst, max_buckets)
+        self.chats = _BucketLevel("chat", chat_rate, chat_burst, max_buckets)
+
+    def acquire(self, socket_key: Hashable, user_id: int, chat_id: int,
+                now: Optional[float] = None) -> Optional[Throttled]:
+        """None, если фрейм можно обрабатывать, иначе уровень, на котором он отклонён, и retry_after."""
+        now = time.monotonic() if now is None else now
+        buckets = [
+            (level.scope, level.get(key, now))
+            for level, key in ((self.sockets, socket_key), (self.users, user_id), (self.chats, chat_id))
+            if level.enabled
+        ]
+        exhausted = [Throttled(scope, bucket.retry_after()) for scope, bucket in buckets if bucket.tokens < 1]
+        if exhausted:
+            # Клиенту сообщаем самый долгий срок: раньше повтор всё равно будет отклонён
+            throttled = max(exhausted, key=lambda item: item.retry_after)
+            THROTTLED.inc(1, (throttled.scope,))
+            return throttled
+        for _, bucket in buckets:
+            bucket.tokens -= 1
+        return None
+
+    def release_socket(self, socket_key: Hashable):
+        self.sockets.buckets.pop(socket_key, None)
+
+
+flow_control = FlowController()
@@ -0,0 +1,68 @@
+import asyncio
+import os
+from typing import Dict, List, Tuple
+from app.connection_manager import manager
+
+READ_RECEIPT_TICK_MS = float(os.getenv("READ_RECEIPT_TICK_MS", "50"))
+
+
+class ReadState:
+    """Сводка позиций прочтения чата для вычисления "прочитано всеми".
+
+    Сообщение прочитано всеми, если его id не больше минимальной позиции прочтения
+    среди участников, кроме отправителя. Для этого достаточно двух наименьших позиций.
+    """
+
+    def __init__(self, lowest: List[Tuple[int, int]]):
+        # [(user_id, last_read_message_id)] по возрастанию позиции, не более двух элементов
+        self.lowest = lowest
+
+    def read_by_all_up_to(self, sender_id: int) -> float:
+        for user_id, watermark in self.lowest:
+            if user_id != sender_id:
+                return watermark
+        # Кроме отправителя в чате никого нет
+        return float("inf")
+
+    def is_read_by_all(self, message) -> bool:
+        return message.id <= self.read_by_all_up_to(message.sender_id)
+
+    def message_dict(self, message) -> dict:
+        data = message.to_dict()
+        data["is_read"] = bool(data["is_read"]) or self.is_read_by_all(message)
+        return data
+
+
+class ReadReceiptCoalescer:
+    """Копит продвижения позиций прочтения и рассылает не больше одного read_update на чат за тик."""
+
+    def __init__(self, manager, tick_ms: float = READ_RECEIPT_TICK_MS):
+        self.manager = manager
+        self.tick = tick_ms / 1000
+        # chat_id -> {user_id: новая позиция}
+        self.pending: Dict[int, Dict[int, int]] = {}
+        self._tasks = set()
+
+    def add(self, chat_id: int, user_id: int, up_to: int):
+        updates = self.pending.get(chat_id)
+        if updates is None:
+            updates = self.pending[chat_id] = {}
+            asyncio.get_running_loop().call_later(self.tick, self._flush, chat_id)
+        if up_to > updates.get(user_id, 0):
+            updates[user_id] = up_to
+
+    def _flush(self, chat_id: int):
+        updates = self.pending.pop(chat_id, None)
+        if not updates:
+            return
+        notification = {
+            "action": "read_update",
+            "chat_id": chat_id,
+            "watermarks": [{"user_id": user_id, "up_to": up_to} for user_id, up_to in updates.items()],
+        }
+        task = asyncio.create_task(self.manager.broadcast(chat_id, notification))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+read_receipts = ReadReceiptCoalescer(manager)
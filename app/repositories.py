@@ -1,6 +1,29 @@
+import asyncio
+import datetime
+from typing import Optional
+from sqlalchemy import case, delete, exists, func, insert, literal_column, or_, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from app.models import User, Chat, Message
+from app.models import SEARCH_TS_CONFIG, ChatType, User, Chat, Message, ChatReadWatermark, chat_users
+from app.metrics import REPOSITORY_SECONDS, observe_latency
+from app.cold_storage import ColdBoundary, ColdStore, cold_store
+from app.pagination import MessageKey
+from app.search import SearchKey
+
+
+def dialect_insert(db: AsyncSession, table):
+    # INSERT с поддержкой ON CONFLICT для текущего диалекта (PostgreSQL в проде, SQLite в стендах)
+    if db.bind.dialect.name == "sqlite":
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+
+class DuplicateMessageError(Exception):
+    # Сообщение с таким client_msg_id уже сохранено: повтор после переподключения
+    def __init__(self, message: Message):
+        super().__init__("Duplicate message")
+        self.message = message
 
 
 class UserRepository:
@@ -18,10 +41,34 @@ class UserRepository:
         result = await self.db.execute(select(User).where(User.username == username))
         return result.scalar_one_or_none()
 
+    async def get_taken(self, usernames: list[str], emails: list[str]) -> tuple[set[str], set[str]]:
+        # Уже занятые имена и адреса пачки одним запросом: для них не тратим время на bcrypt
+        result = await self.db.execute(
+            select(User.username, User.email).where(or_(User.username.in_(usernames), User.email.in_(emails)))
+        )
+        rows = result.all()
+        return {row.username for row in rows}, {row.email for row in rows}
+
+    @observe_latency(REPOSITORY_SECONDS, "bulk_create_users")
+    async def bulk_create_users(self, rows: list[dict]) -> dict[str, int]:
+        """Многострочный INSERT пачки пользователей одной транзакцией: {username: id} вставленных.
+
+        Строки, конфликтующие по имени или адресу (например, созданные параллельно), пропускаются.
+        """
+        statement = dialect_insert(self.db, User).values(rows).on_conflict_do_nothing().returning(
+            User.username, User.id
+        )
+        result = await self.db.execute(statement)
+        created = {row.username: row.id for row in result.all()}
+        await self.db.commit()
+        return created
+
 
 class ChatRepository:
-    def __init__(self, db: AsyncSession):
+    def __init__(self, db: AsyncSession, cold: Optional[ColdStore] = None):
         self.db = db
+        # Холодный слой истории (app.cold_storage)
+        self.cold = cold if cold is not None else cold_store
 
     async def create_chat(self, name: str, user_ids: list[int], creator_id: int) -> Chat:
         chat = Chat(name=name, type="group", creator_id=creator_id)
@@ -35,29 +82,287 @@ class ChatRepository:
         await self.db.refresh(chat)
         return chat
 
-    async def get_chat_history(self, chat_id: int, limit: int, offset: int) -> list[Message]:
+    async def get_existing_user_ids(self, user_ids: list[int]) -> set[int]:
+        result = await self.db.execute(select(User.id).where(User.id.in_(user_ids)))
+        return set(result.scalars().all())
+
+    @observe_latency(REPOSITORY_SECONDS, "bulk_create_chats")
+    async def bulk_create_chats(self, chats: list[tuple[str, int, list[int]]]) -> list[int]:
+        """Пачка групповых чатов (name, creator_id, user_ids) одной транзакцией: id в порядке входа.
+
+        Чаты и связи chat_users вставляются многострочными INSERT, без загрузки объектов.
+        """
+        result = await self.db.execute(
+            insert(Chat).returning(Chat.id, sort_by_parameter_order=True),
+            [{"name": name, "type": ChatType.group, "creator_id": creator_id} for name, creator_id, _ in chats],
+        )
+        chat_ids = list(result.scalars().all())
+        links = [
+            {"chat_id": chat_id, "user_id": user_id}
+            for chat_id, (_, _, user_ids) in zip(chat_ids, chats)
+            for user_id in user_ids
+        ]
+        if links:
+            await self.db.execute(insert(chat_users), links)
+        await self.db.commit()
+        return chat_ids
+
+    async def is_member(self, chat_id: int, user_id: int) -> bool:
+        # EXISTS по первичному ключу chat_users: участников чата не загружаем
+        result = await self.db.execute(
+            select(exists().where(chat_users.c.chat_id == chat_id, chat_users.c.user_id == user_id))
+        )
+        return bool(result.scalar())
+
+    async def get_member_ids(self, chat_id: int) -> set[int]:
+        result = await self.db.execute(select(chat_users.c.user_id).where(chat_users.c.chat_id == chat_id))
+        return set(result.scalars().all())
+
+    async def add_members(self, chat_id: int, user_ids: list[int]) -> list[int]:
+        result = await self.db.execute(select(User.id).where(User.id.in_(user_ids)))
+        existing_ids = result.scalars().all()
+        if not existing_ids:
+            raise Exception("Users not found")
+        statement = dialect_insert(self.db, chat_users).values(
+            [{"chat_id": chat_id, "user_id": user_id} for user_id in existing_ids]
+        ).on_conflict_do_nothing().returning(chat_users.c.user_id)
+        result = await self.db.execute(statement)
+        added = result.scalars().all()
+        await self.db.commit()
+        return added
+
+    async def remove_member(self, chat_id: int, user_id: int) -> bool:
         result = await self.db.execute(
-            select(Message).where(Message.chat_id == chat_id).order_by(Message.created_at.asc()).offset(offset).limit(limit)
+            delete(chat_users).where(chat_users.c.chat_id == chat_id, chat_users.c.user_id == user_id)
         )
+        await self.db.commit()
+        return result.rowcount > 0
+
+    @staticmethod
+    def _hot(chat_id: int, cold: ColdBoundary):
+        # Сообщения чата в БД; уже заархивированные (ещё не удалённые прерванным прогоном) не видны
+        query = select(Message).where(Message.chat_id == chat_id)
+        if cold.last_key is not None:
+            query = query.where(tuple_(Message.created_at, Message.id) > tuple_(*cold.last_key))
+        return query
+
+    @staticmethod
+    async def _read_cold(cold: ColdBoundary, read, chat_id: int, *args) -> list[Message]:
+        # Чтение и распаковка блоков — в пуле потоков, как и дозапись при архивировании.
+        # Чаты без холодного слоя обходятся без перехода в поток
+        if not cold.count:
+            return []
+        return await asyncio.to_thread(read, chat_id, *args)
+
+    @observe_latency(REPOSITORY_SECONDS, "get_chat_history")
+    async def get_chat_history(self, chat_id: int, limit: int, offset: int) -> list[Message]:
+        # Старые сообщения лежат в холодном слое и идут первыми; offset отсчитывается от начала всей истории
+        cold = await self.cold.boundary(chat_id)
+        messages = await self._read_cold(cold, self.cold.read_range, chat_id, offset, min(cold.count, offset + limit))
+        if len(messages) < limit:
+            result = await self.db.execute(
+                self._hot(chat_id, cold)
+                .order_by(Message.created_at.asc(), Message.id.asc())
+                .offset(max(0, offset - cold.count))
+                .limit(limit - len(messages))
+            )
+            messages.extend(result.scalars().all())
+        return messages
+
+    async def stream_chat_history(self, chat_id: int, batch_size: int):
+        """Вся история чата пачками по batch_size через серверный курсор: в памяти не больше одной пачки."""
+        cold = await self.cold.boundary(chat_id)
+        if cold.count:
+            partitions = self.cold.iter_partitions(chat_id)
+            while (partition := await asyncio.to_thread(next, partitions, None)) is not None:
+                yield partition
+        result = await self.db.stream_scalars(
+            self._hot(chat_id, cold)
+            .order_by(Message.created_at.asc(), Message.id.asc())
+            .execution_options(yield_per=batch_size)
+        )
+        async for partition in result.partitions():
+            yield partition
+
+    @observe_latency(REPOSITORY_SECONDS, "get_chat_history_page")
+    async def get_chat_history_page(self, chat_id: int, limit: int, before: Optional[MessageKey] = None,
+                                    after: Optional[MessageKey] = None, descending: bool = False) -> list[Message]:
+        # Keyset-пагинация: условие по (created_at, id) идёт по индексу, пропущенные строки не читаются.
+        # Холодный слой целиком старше БД: при обходе назад он дочитывается после БД, вперёд — до неё.
+        cold = await self.cold.boundary(chat_id)
+        query = self._hot(chat_id, cold)
+        key = tuple_(Message.created_at, Message.id)
+        if before is not None:
+            query = query.where(key < tuple_(*before))
+        if after is not None:
+            query = query.where(key > tuple_(*after))
+        if descending:
+            result = await self.db.execute(query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit))
+            messages = list(result.scalars().all())
+            older = await self._read_cold(cold, self.cold.read_before, chat_id, before, limit - len(messages))
+            return messages + [m for m in older if after is None or (m.created_at, m.id) > after]
+        messages = await self._read_cold(cold, self.cold.read_after, chat_id, after, limit)
+        if before is not None:
+            messages = [m for m in messages if (m.created_at, m.id) < before]
+        if len(messages) < limit:
+            result = await self.db.execute(
+                query.order_by(Message.created_at.asc(), Message.id.asc()).limit(limit - len(messages))
+            )
+            messages.extend(result.scalars().all())
+        return messages
+
+    async def get_user_chat_ids(self, user_id: int) -> list[int]:
+        result = await self.db.execute(select(chat_users.c.chat_id).where(chat_users.c.user_id == user_id))
         return result.scalars().all()
 
+    @observe_latency(REPOSITORY_SECONDS, "search_messages")
+    async def search_messages(self, chat_ids: list[int], query: str, limit: int,
+                              after: Optional[SearchKey] = None) -> list[tuple]:
+        """Полнотекстовый поиск по GIN-индексу tsvector (только PostgreSQL): [(Message, rank)] по убыванию (rank, id)."""
+        search_vector = literal_column("messages.search_vector")
+        tsquery = func.websearch_to_tsquery(SEARCH_TS_CONFIG, query)
+        rank = func.ts_rank_cd(search_vector, tsquery)
+        statement = select(Message, rank.label("rank")).where(
+            Message.chat_id.in_(chat_ids), search_vector.op("@@")(tsquery)
+        )
+        if after is not None:
+            statement = statement.where(tuple_(rank, Message.id) < tuple_(*after))
+        result = await self.db.execute(statement.order_by(rank.desc(), Message.id.desc()).limit(limit))
+        return result.all()
+
+    async def get_messages_by_ids(self, message_ids: list[int]) -> list[Message]:
+        result = await self.db.execute(select(Message).where(Message.id.in_(message_ids)))
+        return result.scalars().all()
+
+    async def get_message_key(self, chat_id: int, message_id: int) -> Optional[MessageKey]:
+        result = await self.db.execute(
+            select(Message.created_at, Message.id).where(Message.id == message_id, Message.chat_id == chat_id)
+        )
+        row = result.first()
+        if row is None:
+            cold = await self.cold.boundary(chat_id)
+            if not cold.count:
+                return None
+            return await asyncio.to_thread(self.cold.find_key, chat_id, message_id)
+        return row.created_at, row.id
+
 
 class MessageRepository:
     def __init__(self, db: AsyncSession):
         self.db = db
 
-    async def create_message(self, chat_id: int, sender_id: int, text: str) -> Message:
+    @observe_latency(REPOSITORY_SECONDS, "create_message")
+    async def create_message(self, chat_id: int, sender_id: int, text: str,
+                             client_msg_id: Optional[str] = None) -> Message:
+        if client_msg_id is not None:
+            return await self._create_message_once(chat_id, sender_id, text, client_msg_id)
         message = Message(chat_id=chat_id, sender_id=sender_id, text=text)
         self.db.add(message)
         await self.db.commit()
         await self.db.refresh(message)
         return message
 
+    async def _create_message_once(self, chat_id: int, sender_id: int, text: str, client_msg_id: str) -> Message:
+        # Уникальный (sender_id, client_msg_id) отсекает повторы даже с другого воркера
+        statement = dialect_insert(self.db, Message).values(
+            chat_id=chat_id, sender_id=sender_id, text=text, client_msg_id=client_msg_id
+        ).on_conflict_do_nothing(
+            index_elements=[Message.sender_id, Message.client_msg_id]
+        ).returning(Message)
+        result = await self.db.execute(statement)
+        message = result.scalar_one_or_none()
+        await self.db.commit()
+        if message is None:
+            raise DuplicateMessageError(await self.get_by_client_msg_id(sender_id, client_msg_id))
+        return message
+
+    async def get_by_client_msg_id(self, sender_id: int, client_msg_id: str) -> Optional[Message]:
+        result = await self.db.execute(
+            select(Message).where(Message.sender_id == sender_id, Message.client_msg_id == client_msg_id)
+        )
+        return result.scalar_one_or_none()
+
+    @observe_latency(REPOSITORY_SECONDS, "mark_message_read")
     async def mark_message_read(self, message_id: int) -> Message:
-        result = await self.db.execute(select(Message).where(Message.id == message_id))
+        # Один UPDATE ... RETURNING вместо SELECT + изменения объекта
+        result = await self.db.execute(
+            update(Message).where(Message.id == message_id).values(is_read=True).returning(Message)
+        )
         message = result.scalar_one_or_none()
         if not message:
             raise Exception("Message not found")
-        message.is_read = True
         await self.db.commit()
         return message
+
+
+class ReadStateRepository:
+    def __init__(self, db: AsyncSession, cold: Optional[ColdStore] = None):
+        self.db = db
+        self.cold = cold if cold is not None else cold_store
+
+    @observe_latency(REPOSITORY_SECONDS, "advance_watermark")
+    async def advance_watermark(self, chat_id: int, user_id: int, up_to: int) -> int:
+        # Один UPSERT: позиция прочтения только растёт и не заходит дальше последнего сообщения чата
+        now = datetime.datetime.utcnow()
+        # Граница — наибольший id чата в обоих слоях: max(id) в БД и max_id блоков холодного слоя
+        cold = await self.cold.boundary(chat_id)
+        hot_max = func.coalesce(select(func.max(Message.id)).where(Message.chat_id == chat_id).scalar_subquery(), 0)
+        latest = case((hot_max > cold.max_id, hot_max), else_=cold.max_id)
+        statement = dialect_insert(self.db, ChatReadWatermark).values(
+            chat_id=chat_id, user_id=user_id, last_read_message_id=case((latest < up_to, latest), else_=up_to),
+            updated_at=now,
+        )
+        current = ChatReadWatermark.last_read_message_id
+        proposed = statement.excluded.last_read_message_id
+        statement = statement.on_conflict_do_update(
+            index_elements=[ChatReadWatermark.chat_id, ChatReadWatermark.user_id],
+            set_={
+                "last_read_message_id": case((proposed > current, proposed), else_=current),
+                "updated_at": now,
+            },
+        ).returning(ChatReadWatermark.last_read_message_id)
+        result = await self.db.execute(statement)
+        watermark = result.scalar_one()
+        await self.db.commit()
+        return watermark
+
+    async def get_lowest_watermarks(self, chat_id: int, count: int = 2) -> list[tuple[int, int]]:
+        # Участники без записи считаются не прочитавшими ничего
+        watermark = func.coalesce(ChatReadWatermark.last_read_message_id, 0)
+        result = await self.db.execute(
+            select(chat_users.c.user_id, watermark)
+            .select_from(chat_users)
+            .outerjoin(
+                ChatReadWatermark,
+                (ChatReadWatermark.chat_id == chat_users.c.chat_id) & (ChatReadWatermark.user_id == chat_users.c.user_id),
+            )
+            .where(chat_users.c.chat_id == chat_id)
+            .order_by(watermark.asc())
+            .limit(count)
+        )
+        return [(row[0], row[1]) for row in result.all()]
+
+    @observe_latency(REPOSITORY_SECONDS, "get_unread_counts")
+    async def get_unread_counts(self, user_id: int) -> list[tuple[int, int, int, int]]:
+        """[(chat_id, непрочитано, позиция прочтения, id последнего учтённого сообщения)] по всем чатам пользователя.
+
+        Один сгруппированный запрос: читаются только сообщения новее позиции прочтения.
+        """
+        watermark = func.coalesce(ChatReadWatermark.last_read_message_id, 0)
+        unread = func.coalesce(func.sum(case((Message.sender_id != user_id, 1), else_=0)), 0)
+        result = await self.db.execute(
+            select(chat_users.c.chat_id, unread, watermark, func.coalesce(func.max(Message.id), watermark))
+            .select_from(chat_users)
+            .outerjoin(
+                ChatReadWatermark,
+                (ChatReadWatermark.chat_id == chat_users.c.chat_id) & (ChatReadWatermark.user_id == user_id),
+            )
+            .outerjoin(Message, (Message.chat_id == chat_users.c.chat_id) & (Message.id > watermark))
+            .where(chat_users.c.user_id == user_id)
+            .group_by(chat_users.c.chat_id, ChatReadWatermark.last_read_message_id)
+        )
+        return [(row[0], row[1], row[2], row[3]) for row in result.all()]
+
+    async def get_watermarks(self, chat_id: int) -> list[ChatReadWatermark]:
+        result = await self.db.execute(select(ChatReadWatermark).where(ChatReadWatermark.chat_id == chat_id))
+        return result.scalars().all()
@@ -0,0 +1,81 @@
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+# Ключ ранжирования результата поиска: (rank, id), по убыванию
+SearchKey = Tuple[float, int]
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    return [token.lower() for token in _TOKEN_RE.findall(text or "")]
+
+
+class InvertedIndex:
+    """Инвертированный индекс по тексту сообщений в памяти процесса.
+
+    Используется вместо tsvector + GIN, когда база не PostgreSQL (SQLite в стендах и бенчмарках).
+    Чаты индексируются лениво при первом поиске по ним, дальше новые сообщения добавляются при отправке.
+    Ранг зависит только от самого сообщения (доля совпавших слов), поэтому keyset-пагинация
+    по (rank, id) стабильна, пока индекс растёт.
+    """
+
+    def __init__(self):
+        # слово -> {message_id: сколько раз слово встречается}
+        self.postings: Dict[str, Dict[int, int]] = {}
+        # message_id -> (chat_id, число слов)
+        self.documents: Dict[int, Tuple[int, int]] = {}
+        self.indexed_chats: Set[int] = set()
+
+    def is_indexed(self, chat_id: int) -> bool:
+        return chat_id in self.indexed_chats
+
+    def add(self, message):
+        # Сообщения чатов, которые ещё не индексировались, подхватит index_chat
+        if message.chat_id not in self.indexed_chats:
+            return
+        self._add(message)
+
+    def _add(self, message):
+        if message.id in self.documents:
+            return
+        tokens = tokenize(message.text)
+        self.documents[message.id] = (message.chat_id, len(tokens))
+        for token, count in Counter(tokens).items():
+            self.postings.setdefault(token, {})[message.id] = count
+
+    def index_chat(self, chat_id: int, messages: Iterable):
+        for message in messages:
+            self._add(message)
+        self.indexed_chats.add(chat_id)
+
+    def clear(self):
+        self.postings.clear()
+        self.documents.clear()
+        self.indexed_chats.clear()
+
+    def search(self, chat_ids: Iterable[int], query: str, limit: int,
+               after: Optional[SearchKey] = None) -> List[Tuple[int, float]]:
+        """[(message_id, rank)] сообщений, содержащих все слова запроса, по убыванию (rank, id)."""
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        postings = sorted((self.postings.get(term, {}) for term in terms), key=len)
+        allowed = set(chat_ids)
+        results = []
+        for message_id in postings[0]:
+            if not all(message_id in posting for posting in postings[1:]):
+                continue
+            chat_id, length = self.documents[message_id]
+            if chat_id not in allowed:
+                continue
+            rank = sum(posting[message_id] for posting in postings) / length
+            if after is not None and (rank, message_id) >= after:
+                continue
+            results.append((message_id, rank))
+        results.sort(key=lambda item: (item[1], item[0]), reverse=True)
+        return results[:limit]
+
+
+search_index = InvertedIndex()
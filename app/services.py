@@ -1,4 +1,28 @@
-from app.repositories import UserRepository, ChatRepository, MessageRepository
+import asyncio
+import os
+import zlib
+from typing import AsyncIterator, Optional
+from app.auth import password_hasher
+from app.codecs import JSON_CODEC, get_codec
+from app.pagination import (
+    AFTER, BEFORE, HistoryPage, decode_cursor, decode_search_cursor, encode_cursor, encode_search_cursor
+)
+from app.membership import membership_cache
+from app.history_cache import history_cache
+from app.read_receipts import ReadState
+from app.search import search_index
+from app.unread import unread_counters
+from app.repositories import UserRepository, ChatRepository, MessageRepository, ReadStateRepository
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+_export_codec = get_codec("orjson") or JSON_CODEC
+
+
+def _is_id_list(value) -> bool:
+    return isinstance(value, list) and bool(value) and all(
+        isinstance(item, int) and not isinstance(item, bool) for item in value
+    )
 
 
 class UserService:
@@ -6,22 +30,266 @@ class UserService:
         repo = UserRepository(db)
         return await repo.create_user(username, email, password)
 
+    async def bulk_create_users(self, db, batch: list[tuple[int, object]], hasher=password_hasher) -> list[dict]:
+        """Пачка пользователей [(index, {"username", "email", "password"})]: результат или ошибка на каждый элемент.
+
+        Занятые имена отсеиваются одним запросом до хеширования. Пароли хешируются параллельно
+        окнами по числу воркеров пула: логины в очереди пула ждут не дольше одного окна.
+        """
+        repo = UserRepository(db)
+        results = {}
+        valid = []
+        usernames, emails = set(), set()
+        for index, item in batch:
+            if not isinstance(item, dict) or not all(
+                isinstance(item.get(field), str) and item[field] for field in ("username", "email", "password")
+            ):
+                results[index] = {"index": index, "error": "username, email and password are required"}
+            elif item["username"] in usernames or item["email"] in emails:
+                results[index] = {"index": index, "error": "Duplicate username or email in batch"}
+            else:
+                usernames.add(item["username"])
+                emails.add(item["email"])
+                valid.append((index, item))
+
+        pending = []
+        if valid:
+            taken_usernames, taken_emails = await repo.get_taken(list(usernames), list(emails))
+            for index, item in valid:
+                if item["username"] in taken_usernames or item["email"] in taken_emails:
+                    results[index] = {"index": index, "error": "Username or email already exists"}
+                else:
+                    pending.append((index, item))
+
+        if pending:
+            hashes = []
+            for start in range(0, len(pending), hasher.workers):
+                window = pending[start:start + hasher.workers]
+                hashes.extend(await asyncio.gather(*(hasher.hash(item["password"]) for _, item in window)))
+            created = await repo.bulk_create_users([
+                {"username": item["username"], "email": item["email"], "password": password}
+                for (_, item), password in zip(pending, hashes)
+            ])
+            for index, item in pending:
+                user_id = created.get(item["username"])
+                if user_id is None:
+                    results[index] = {"index": index, "error": "Username or email already exists"}
+                else:
+                    results[index] = {"index": index, "id": user_id, "username": item["username"], "email": item["email"]}
+        return [results[index] for index in sorted(results)]
+
 
 class ChatService:
     async def create_chat(self, db, name: str, user_ids: list[int], creator_id: int):
         repo = ChatRepository(db)
-        return await repo.create_chat(name, user_ids, creator_id)
+        chat = await repo.create_chat(name, user_ids, creator_id)
+        members = await repo.get_member_ids(chat.id)
+        membership_cache.set_members(chat.id, members)
+        unread_counters.invalidate_users(members)
+        return chat
+
+    async def bulk_create_chats(self, db, batch: list[tuple[int, object]]) -> list[dict]:
+        """Пачка групповых чатов [(index, {"name", "user_ids"})]: результат или ошибка на каждый элемент.
+
+        Как и в create_chat, несуществующие пользователи пропускаются, создатель — первый найденный.
+        """
+        repo = ChatRepository(db)
+        results = {}
+        valid = []
+        for index, item in batch:
+            if not isinstance(item, dict) or not isinstance(item.get("name"), str) or not _is_id_list(item.get("user_ids")):
+                results[index] = {"index": index, "error": "name and a non-empty list of user_ids are required"}
+            else:
+                valid.append((index, item))
+        if not valid:
+            return [results[index] for index in sorted(results)]
+
+        existing = await repo.get_existing_user_ids(list({u for _, item in valid for u in item["user_ids"]}))
+        pending = []
+        for index, item in valid:
+            members = [user_id for user_id in dict.fromkeys(item["user_ids"]) if user_id in existing]
+            if members:
+                pending.append((index, item["name"], members))
+            else:
+                results[index] = {"index": index, "error": "Users not found"}
+        if pending:
+            chat_ids = await repo.bulk_create_chats([(name, members[0], members) for _, name, members in pending])
+            for (index, name, members), chat_id in zip(pending, chat_ids):
+                membership_cache.set_members(chat_id, set(members))
+                unread_counters.invalidate_users(members)
+                results[index] = {"index": index, "id": chat_id, "name": name, "user_ids": members}
+        return [results[index] for index in sorted(results)]
+
+    async def add_members(self, db, chat_id: int, user_ids: list[int]) -> list[int]:
+        repo = ChatRepository(db)
+        added = await repo.add_members(chat_id, user_ids)
+        membership_cache.add_members(chat_id, added)
+        unread_counters.invalidate_users(added)
+        # Новые участники меняют минимальную позицию прочтения
+        history_cache.invalidate_read_state(chat_id)
+        return added
+
+    async def remove_member(self, db, chat_id: int, user_id: int) -> bool:
+        repo = ChatRepository(db)
+        removed = await repo.remove_member(chat_id, user_id)
+        membership_cache.remove_member(chat_id, user_id)
+        unread_counters.invalidate_users([user_id])
+        history_cache.invalidate_read_state(chat_id)
+        return removed
 
     async def get_history(self, db, chat_id: int, limit: int, offset: int):
+        # Если вся история чата помещается в буфер последних сообщений, БД не нужна
+        cached = history_cache.get_all(chat_id)
+        if cached is not None:
+            return cached[offset:offset + limit]
         repo = ChatRepository(db)
         return await repo.get_chat_history(chat_id, limit, offset)
 
+    async def _get_latest(self, repo: ChatRepository, chat_id: int, count: int) -> list:
+        # Свежая страница: из буфера последних сообщений, при промахе — из БД с прогревом буфера
+        cached = history_cache.get_latest(chat_id, count)
+        if cached is not None:
+            return cached
+        fetch = max(count, history_cache.per_chat)
+        token = history_cache.begin_warm(chat_id)
+        try:
+            rows = list(await repo.get_chat_history_page(chat_id, fetch, descending=True))
+        except Exception:
+            history_cache.invalidate(chat_id)
+            raise
+        history_cache.complete_warm(token, chat_id, rows, complete=len(rows) < fetch)
+        return rows[:count]
+
+    async def get_history_page(self, db, chat_id: int, limit: int, before_id: Optional[int] = None,
+                               after_id: Optional[int] = None, cursor: Optional[str] = None,
+                               order: str = "asc") -> HistoryPage:
+        repo = ChatRepository(db)
+        if cursor is not None:
+            direction, anchor, order = decode_cursor(cursor)
+        elif after_id is not None:
+            direction, anchor = AFTER, await repo.get_message_key(chat_id, after_id)
+            if anchor is None:
+                raise LookupError("Message not found")
+        elif before_id is not None:
+            direction, anchor = BEFORE, await repo.get_message_key(chat_id, before_id)
+            if anchor is None:
+                raise LookupError("Message not found")
+        else:
+            # Без якоря — самые новые сообщения
+            direction, anchor = BEFORE, None
+
+        # Берём на одну строку больше, чтобы понять, есть ли следующая страница
+        if direction == BEFORE and anchor is None:
+            rows = await self._get_latest(repo, chat_id, limit + 1)
+        elif direction == BEFORE:
+            rows = await repo.get_chat_history_page(chat_id, limit + 1, before=anchor, descending=True)
+        else:
+            rows = await repo.get_chat_history_page(chat_id, limit + 1, after=anchor)
+        has_more = len(rows) > limit
+        rows = list(rows[:limit])
+
+        next_cursor = None
+        if has_more:
+            # Строки упорядочены в направлении обхода: последняя — якорь следующей страницы
+            last = rows[-1]
+            next_cursor = encode_cursor(direction, (last.created_at, last.id), order)
+        if (direction == BEFORE) != (order == "desc"):
+            rows.reverse()
+        return HistoryPage(rows, next_cursor)
+
+
+    async def export_history(self, db, chat_id: int, compress: bool = False) -> AsyncIterator[bytes]:
+        """История чата в NDJSON (по сообщению на строку), по желанию сжатая gzip.
+
+        Каждая пачка курсора сразу кодируется и отдаётся: память не зависит от размера чата.
+        """
+        read_state = await self.get_read_state(db, chat_id)
+        compressor = zlib.compressobj(wbits=31) if compress else None
+        async for messages in ChatRepository(db).stream_chat_history(chat_id, EXPORT_BATCH_SIZE):
+            chunk = "".join(_export_codec.encode(read_state.message_dict(msg)) + "\n" for msg in messages).encode("utf-8")
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        if compressor is not None:
+            yield compressor.flush()
+
+    async def get_user_chat_ids(self, db, user_id: int) -> list[int]:
+        repo = ChatRepository(db)
+        return await repo.get_user_chat_ids(user_id)
+
+    async def search(self, db, chat_ids: list[int], query: str, limit: int,
+                     cursor: Optional[str] = None) -> HistoryPage:
+        """Поиск по тексту в заданных чатах. messages страницы — пары (Message, rank)."""
+        after = decode_search_cursor(cursor) if cursor is not None else None
+        repo = ChatRepository(db)
+        if not chat_ids:
+            return HistoryPage([], None)
+        if db.bind.dialect.name == "postgresql":
+            rows = [(row.Message, row.rank) for row in await repo.search_messages(chat_ids, query, limit + 1, after)]
+        else:
+            # Без PostgreSQL — инвертированный индекс в памяти, чаты индексируются при первом поиске
+            for chat_id in chat_ids:
+                if not search_index.is_indexed(chat_id):
+                    messages = []
+                    async for partition in repo.stream_chat_history(chat_id, EXPORT_BATCH_SIZE):
+                        messages.extend(partition)
+                    search_index.index_chat(chat_id, messages)
+            hits = search_index.search(chat_ids, query, limit + 1, after)
+            found = {message.id: message for message in await repo.get_messages_by_ids([id_ for id_, _ in hits])}
+            rows = [(found[message_id], rank) for message_id, rank in hits if message_id in found]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last, rank = rows[-1]
+            next_cursor = encode_search_cursor((rank, last.id))
+        return HistoryPage(rows, next_cursor)
+
+    async def get_read_state(self, db, chat_id: int) -> ReadState:
+        read_state = history_cache.get_read_state(chat_id)
+        if read_state is not None:
+            return read_state
+        generation = history_cache.read_generation(chat_id)
+        repo = ReadStateRepository(db)
+        read_state = ReadState(await repo.get_lowest_watermarks(chat_id))
+        history_cache.set_read_state(chat_id, read_state, generation)
+        return read_state
+
+    async def get_watermarks(self, db, chat_id: int):
+        repo = ReadStateRepository(db)
+        return await repo.get_watermarks(chat_id)
+
+    async def get_unread_counts(self, db, user_id: int) -> dict[int, int]:
+        # Счётчики в памяти; БД читается при первом запросе, сверке или частичном продвижении прочтения
+        repo = ReadStateRepository(db)
+        return await unread_counters.get(user_id, lambda: repo.get_unread_counts(user_id))
+
 
 class MessageService:
-    async def create_message(self, db, chat_id: int, sender_id: int, text: str):
-        repo = MessageRepository(db)
-        return await repo.create_message(chat_id, sender_id, text)
+    def __init__(self, batcher=None):
+        # Необязательный group-commit батчер (app.write_batcher)
+        self.batcher = batcher
+
+    async def create_message(self, db, chat_id: int, sender_id: int, text: str, client_msg_id: Optional[str] = None):
+        if self.batcher is not None:
+            message = await self.batcher.submit(chat_id, sender_id, text, client_msg_id)
+        else:
+            message = await MessageRepository(db).create_message(chat_id, sender_id, text, client_msg_id)
+        history_cache.add(message)
+        search_index.add(message)
+        unread_counters.on_message(message.chat_id, message.sender_id, message.id)
+        return message
 
     async def mark_read(self, db, message_id: int):
         repo = MessageRepository(db)
-        return await repo.mark_message_read(message_id)
+        message = await repo.mark_message_read(message_id)
+        # Флаг is_read хранится в самих сообщениях буфера: проще сбросить буфер чата
+        history_cache.invalidate(message.chat_id)
+        return message
+
+    async def mark_read_up_to(self, db, chat_id: int, user_id: int, up_to: int) -> int:
+        repo = ReadStateRepository(db)
+        watermark = await repo.advance_watermark(chat_id, user_id, up_to)
+        history_cache.invalidate_read_state(chat_id)
+        unread_counters.on_read(chat_id, user_id, watermark)
+        return watermark
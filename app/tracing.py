@@ -0,0 +1,301 @@
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+# Доля запросов и WebSocket-событий, трассы которых сохраняются для выгрузки (решение принимается в корне)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# Корневые спаны дольше порога пишутся в лог с разбивкой по дочерним и сохраняются независимо от сэмплинга; 0 — выкл.
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "1000"))
+# Ограничение дочерних спанов в одной трассе (долгая выгрузка не должна расти без предела)
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "1000"))
+# Каталог, куда при остановке сервера выгружаются накопленные трассы; пусто — не выгружать
+TRACE_EXPORT_DIR = os.getenv("TRACE_EXPORT_DIR", "")
+
+SERVICE_NAME = "fastchat"
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start_ns", "end_ns", "attributes")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.name = name
+        self.span_id = "%016x" % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+
+class Trace:
+    __slots__ = ("trace_id", "sampled", "root", "spans", "dropped")
+
+    def __init__(self, sampled: bool):
+        self.trace_id = "%032x" % random.getrandbits(128)
+        self.sampled = sampled
+        self.root: Optional[Span] = None
+        self.spans: List[Span] = []
+        self.dropped = 0
+
+    def start_span(self, name: str, parent: Optional[Span], attributes: dict) -> Optional[Span]:
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return None
+        span = Span(self, name, parent.span_id if parent is not None else None, attributes)
+        self.spans.append(span)
+        return span
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Лёгкая трассировка на contextvars: корневой спан на HTTP-запрос или WebSocket-событие,
+    дочерние — на SQL-выражения, bcrypt, рассылку и операции репозиториев.
+
+    Сэмплинг головной: решение о сохранении трассы принимается при открытии корня.
+    Медленные корни (TRACE_SLOW_MS) пишутся в лог и сохраняются, даже если не попали в выборку.
+    Если сэмплинг и порог выключены, спаны не создаются вовсе.
+    """
+
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, slow_ms: float = TRACE_SLOW_MS,
+                 buffer_size: int = TRACE_BUFFER_SIZE):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.finished: Deque[Trace] = deque(maxlen=buffer_size)
+        self.started = 0
+        self.slow = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.slow_ms > 0
+
+    def start_root(self, name: str, **attributes) -> Optional[Span]:
+        if not self.enabled:
+            return None
+        self.started += 1
+        trace = Trace(sampled=random.random() < self.sample_rate)
+        trace.root = trace.start_span(name, None, attributes)
+        return trace.root
+
+    def finish_root(self, root: Span):
+        root.finish()
+        trace = root.trace
+        slow = self.slow_ms > 0 and root.duration_ms >= self.slow_ms
+        if slow:
+            self.slow += 1
+            self._log_slow(trace)
+        if trace.sampled or slow:
+            self.finished.append(trace)
+
+    def _log_slow(self, trace: Trace):
+        # Суммарное время по именам дочерних спанов: сразу видно, ушло ли время в БД, bcrypt или рассылку
+        totals: Dict[str, List[float]] = {}
+        for span in trace.spans[1:]:
+            total = totals.setdefault(span.name, [0.0, 0])
+            total[0] += span.duration_ms
+            total[1] += 1
+        breakdown = ", ".join(
+            f"{name}={total:.1f}ms/{count}"
+            for name, (total, count) in sorted(totals.items(), key=lambda item: item[1][0], reverse=True)
+        )
+        root = trace.root
+        logger.warning("slow %s: %.1f ms trace=%s %s [%s]", root.name, root.duration_ms, trace.trace_id,
+                       root.attributes, breakdown)
+
+    @contextlib.contextmanager
+    def root(self, name: str, **attributes):
+        """Корневой спан; вложенный в уже идущую трассу становится её дочерним спаном."""
+        if _current_span.get() is not None:
+            with self.span(name, **attributes) as span:
+                yield span
+            return
+        span = self.start_root(name, **attributes)
+        if span is None:
+            yield None
+            return
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            _current_span.reset(token)
+            self.finish_root(span)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        span = self.start_span(name, **attributes)
+        if span is None:
+            yield None
+            return
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.finish()
+
+    def start_span(self, name: str, **attributes) -> Optional[Span]:
+        # Без контекстного менеджера (хуки SQLAlchemy): спан не становится текущим, закрывается через finish()
+        parent = _current_span.get()
+        if parent is None:
+            return None
+        return parent.trace.start_span(name, parent, attributes)
+
+    def traced(self, name: str):
+        """Декоратор для корутин: вызов оформляется дочерним спаном текущей трассы."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if _current_span.get() is None:
+                    return await func(*args, **kwargs)
+                with self.span(name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def clear(self):
+        self.finished.clear()
+
+    def export_chrome(self) -> dict:
+        """Формат Chrome trace event (chrome://tracing, Perfetto): трасса — отдельная дорожка."""
+        events = []
+        for lane, trace in enumerate(self.finished, start=1):
+            for span in trace.spans:
+                if span.end_ns is None:
+                    continue
+                events.append({
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": span.start_ns / 1000,
+                    "dur": (span.end_ns - span.start_ns) / 1000,
+                    "pid": 1,
+                    "tid": lane,
+                    "args": {**span.attributes, "trace_id": trace.trace_id, "span_id": span.span_id},
+                })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export_otlp(self) -> dict:
+        """OTLP/JSON (ExportTraceServiceRequest): загружается в Jaeger, Tempo и другие OTLP-приёмники."""
+        spans = []
+        for trace in self.finished:
+            for span in trace.spans:
+                if span.end_ns is None:
+                    continue
+                item = {
+                    "traceId": trace.trace_id,
+                    "spanId": span.span_id,
+                    "name": span.name,
+                    "kind": 2 if span.parent_id is None else 1,
+                    "startTimeUnixNano": str(span.start_ns),
+                    "endTimeUnixNano": str(span.end_ns),
+                    "attributes": [_otlp_attribute(key, value) for key, value in span.attributes.items()],
+                }
+                if span.parent_id is not None:
+                    item["parentSpanId"] = span.parent_id
+                spans.append(item)
+        return {"resourceSpans": [{
+            "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": SERVICE_NAME}, "spans": spans}],
+        }]}
+
+    def export(self, fmt: str = "chrome") -> dict:
+        if fmt == "chrome":
+            return self.export_chrome()
+        if fmt == "otlp":
+            return self.export_otlp()
+        raise ValueError(f"Unknown trace format: {fmt}")
+
+    def write(self, directory: str = TRACE_EXPORT_DIR) -> List[str]:
+        # Выгрузка накопленных трасс в файлы обоих форматов для разбора офлайн
+        if not directory or not self.finished:
+            return []
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        paths = []
+        for fmt in ("chrome", "otlp"):
+            path = os.path.join(directory, f"traces-{stamp}-{os.getpid()}.{fmt}.json")
+            with open(path, "w") as f:
+                json.dump(self.export(fmt), f)
+            paths.append(path)
+        return paths
+
+    def stats(self) -> dict:
+        return {
+            "sample_rate": self.sample_rate,
+            "slow_ms": self.slow_ms,
+            "started": self.started,
+            "slow": self.slow,
+            "buffered": len(self.finished),
+        }
+
+
+def _otlp_attribute(key: str, value) -> dict:
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+class TracingMiddleware:
+    """ASGI-мидлварь: корневой спан на HTTP-запрос, включая отдачу потокового тела ответа."""
+
+    def __init__(self, app, tracer: Optional[Tracer] = None):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        tracer_ = self.tracer or tracer
+        if scope["type"] != "http" or not tracer_.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        with tracer_.root(f"{scope['method']} {scope['path']}", method=scope["method"], path=scope["path"]) as span:
+            async def send_with_status(message):
+                if message["type"] == "http.response.start" and span is not None:
+                    span.set(status=message["status"])
+                await send(message)
+
+            await self.app(scope, receive, send_with_status)
+            route = scope.get("route")
+            if span is not None and getattr(route, "path", None):
+                # Имя по шаблону маршрута: /history/{chat_id}, а не /history/42
+                span.name = f"{scope['method']} {route.path}"
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+tracer = Tracer()
@@ -0,0 +1,155 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Iterable, List, Set, Tuple
+from app.metrics import CounterFunction, Gauge
+
+UNREAD_RECONCILE_SECONDS = float(os.getenv("UNREAD_RECONCILE_SECONDS", "60"))
+UNREAD_CACHE_MAX_USERS = int(os.getenv("UNREAD_CACHE_MAX_USERS", "100000"))
+
+# (chat_id, непрочитано, позиция прочтения, id последнего учтённого сообщения)
+UnreadRow = Tuple[int, int, int, int]
+
+_MESSAGE = "message"
+_READ = "read"
+
+
+class _UserUnread:
+    __slots__ = ("counts", "watermarks", "latest", "dirty", "expires_at")
+
+    def __init__(self, rows: Iterable[UnreadRow], expires_at: float):
+        self.counts: Dict[int, int] = {}
+        self.watermarks: Dict[int, int] = {}
+        self.latest: Dict[int, int] = {}
+        for chat_id, unread, watermark, latest in rows:
+            self.counts[chat_id] = unread
+            self.watermarks[chat_id] = watermark
+            self.latest[chat_id] = latest
+        # Есть чаты, где счётчик нельзя поправить в памяти: при следующем запросе пользователь перечитывается
+        self.dirty = False
+        self.expires_at = expires_at
+
+
+class UnreadCounters:
+    """Счётчики непрочитанных сообщений по чатам для пользователей, которые их запрашивали.
+
+    Счётчик растёт при сохранении сообщения и обнуляется, когда позиция прочтения доходит
+    до последнего сообщения. Частичное продвижение помечает пользователя: его счётчики
+    перечитываются из БД одним сгруппированным запросом. Раз в UNREAD_RECONCILE_SECONDS
+    счётчики сверяются с БД (сообщения, сохранённые другими воркерами, сюда не попадают).
+    """
+
+    def __init__(self, reconcile_seconds: float = UNREAD_RECONCILE_SECONDS,
+                 max_users: int = UNREAD_CACHE_MAX_USERS):
+        self.reconcile_seconds = reconcile_seconds
+        self.max_users = max_users
+        self._users: "OrderedDict[int, _UserUnread]" = OrderedDict()
+        # chat_id -> пользователи в кэше, состоящие в чате: новое сообщение обходит только их
+        self._chat_users: Dict[int, Set[int]] = {}
+        # События, пришедшие пока идут загрузки из БД: применяются к загруженному результату
+        self._loads = 0
+        self._events: List[tuple] = []
+        self.hits = 0
+        self.loads = 0
+
+    def _store(self, user_id: int, entry: _UserUnread):
+        self._drop(user_id)
+        self._users[user_id] = entry
+        for chat_id in entry.counts:
+            self._chat_users.setdefault(chat_id, set()).add(user_id)
+        while len(self._users) > self.max_users:
+            self._drop(next(iter(self._users)))
+
+    def _drop(self, user_id: int):
+        entry = self._users.pop(user_id, None)
+        if entry is None:
+            return
+        for chat_id in entry.counts:
+            users = self._chat_users.get(chat_id)
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self._chat_users[chat_id]
+
+    @staticmethod
+    def _apply_message(entry: _UserUnread, user_id: int, chat_id: int, sender_id: int, message_id: int):
+        latest = entry.latest.get(chat_id)
+        # Сообщения не новее последнего учтённого уже посчитаны запросом к БД
+        if latest is None or message_id <= latest:
+            return
+        entry.latest[chat_id] = message_id
+        if sender_id != user_id and message_id > entry.watermarks[chat_id]:
+            entry.counts[chat_id] += 1
+
+    @staticmethod
+    def _apply_read(entry: _UserUnread, chat_id: int, watermark: int):
+        if chat_id not in entry.counts or watermark <= entry.watermarks[chat_id]:
+            return
+        entry.watermarks[chat_id] = watermark
+        if watermark >= entry.latest[chat_id]:
+            entry.counts[chat_id] = 0
+        else:
+            # Сколько сообщений осталось после новой позиции, в памяти неизвестно
+            entry.dirty = True
+
+    def on_message(self, chat_id: int, sender_id: int, message_id: int):
+        if self._loads:
+            self._events.append((_MESSAGE, chat_id, sender_id, message_id))
+        for user_id in self._chat_users.get(chat_id, ()):
+            self._apply_message(self._users[user_id], user_id, chat_id, sender_id, message_id)
+
+    def on_read(self, chat_id: int, user_id: int, watermark: int):
+        if self._loads:
+            self._events.append((_READ, chat_id, user_id, watermark))
+        entry = self._users.get(user_id)
+        if entry is not None:
+            self._apply_read(entry, chat_id, watermark)
+
+    def invalidate_users(self, user_ids: Iterable[int]):
+        # Изменился состав чатов пользователя: набор его чатов перечитывается целиком
+        for user_id in user_ids:
+            self._drop(user_id)
+
+    def clear(self):
+        self._users.clear()
+        self._chat_users.clear()
+
+    async def get(self, user_id: int, load: Callable[[], Awaitable[List[UnreadRow]]]) -> Dict[int, int]:
+        """{chat_id: непрочитано}: из памяти или, при промахе и после сверки, одним запросом load()."""
+        now = time.monotonic()
+        entry = self._users.get(user_id)
+        if entry is not None and not entry.dirty and entry.expires_at > now:
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return dict(entry.counts)
+
+        self.loads += 1
+        self._loads += 1
+        start = len(self._events)
+        try:
+            rows = await load()
+        finally:
+            self._loads -= 1
+            events = self._events[start:]
+            if not self._loads:
+                self._events.clear()
+        entry = _UserUnread(rows, now + self.reconcile_seconds)
+        for kind, chat_id, actor_id, value in events:
+            if kind == _MESSAGE:
+                self._apply_message(entry, user_id, chat_id, actor_id, value)
+            elif actor_id == user_id:
+                self._apply_read(entry, chat_id, value)
+        if not entry.dirty:
+            self._store(user_id, entry)
+        return dict(entry.counts)
+
+    def stats(self) -> dict:
+        return {"users": len(self._users), "hits": self.hits, "loads": self.loads}
+
+
+unread_counters = UnreadCounters()
+
+CounterFunction("fastchat_unread_cache_hits_total", "Unread badge requests served from memory", lambda: unread_counters.hits)
+CounterFunction("fastchat_unread_cache_loads_total", "Unread counters loaded or reconciled from the database",
+                lambda: unread_counters.loads)
+Gauge("fastchat_unread_cached_users", "Users with unread counters held in memory", function=lambda: len(unread_counters._users))
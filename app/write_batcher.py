@@ -0,0 +1,189 @@
+import asyncio
+import bisect
+import os
+from typing import Dict, List, Optional, Tuple, Union
+from sqlalchemy import insert, tuple_
+from sqlalchemy.future import select
+from app.database import async_session
+from app.models import Message
+from app.metrics import CounterFunction, Gauge
+from app.repositories import DuplicateMessageError, dialect_insert
+
+MESSAGE_BATCH_ENABLED = os.getenv("MESSAGE_BATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+MESSAGE_BATCH_MAX_DELAY_MS = float(os.getenv("MESSAGE_BATCH_MAX_DELAY_MS", "5"))
+MESSAGE_BATCH_MAX_SIZE = int(os.getenv("MESSAGE_BATCH_MAX_SIZE", "100"))
+MESSAGE_BATCH_MAX_IN_FLIGHT = int(os.getenv("MESSAGE_BATCH_MAX_IN_FLIGHT", "4"))
+
+# Границы корзин гистограммы размеров пачек
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class MessageWriteBatcher:
+    """Group commit: сообщения со всех сокетов копятся несколько миллисекунд
+    (или до max_size строк) и вставляются одним INSERT ... RETURNING."""
+
+    def __init__(self, session_factory=async_session, max_delay_ms: float = MESSAGE_BATCH_MAX_DELAY_MS,
+                 max_size: int = MESSAGE_BATCH_MAX_SIZE, max_in_flight: int = MESSAGE_BATCH_MAX_IN_FLIGHT):
+        self.session_factory = session_factory
+        self.max_delay = max_delay_ms / 1000
+        self.max_size = max_size
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        # Метрики размеров пачек
+        self.batches = 0
+        self.rows = 0
+        self.max_batch = 0
+        self.failed_batches = 0
+        self.size_buckets = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+
+    async def submit(self, chat_id: int, sender_id: int, text: str, client_msg_id: Optional[str] = None) -> Message:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        values = {"chat_id": chat_id, "sender_id": sender_id, "text": text, "client_msg_id": client_msg_id}
+        self._pending.append((values, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._write(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, batch: List[Tuple[dict, asyncio.Future]]):
+        async with self._semaphore:
+            try:
+                outcomes = await self._insert([values for values, _ in batch])
+            except Exception as e:
+                self.failed_batches += 1
+                if len(batch) == 1:
+                    self._resolve(batch[0][1], exception=e)
+                    return
+                # Одна плохая строка не должна ронять всю пачку: повторяем построчно
+                for item in batch:
+                    await self._write_single(item)
+                return
+            self._record(len(batch))
+            for (_, future), outcome in zip(batch, outcomes):
+                self._resolve_outcome(future, outcome)
+
+    async def _write_single(self, item: Tuple[dict, asyncio.Future]):
+        values, future = item
+        try:
+            outcomes = await self._insert([values])
+        except Exception as e:
+            self._resolve(future, exception=e)
+            return
+        self._record(1)
+        self._resolve_outcome(future, outcomes[0])
+
+    async def _insert(self, rows: List[dict]) -> List[Union[Message, DuplicateMessageError]]:
+        outcomes: List[Union[Message, DuplicateMessageError, None]] = [None] * len(rows)
+        plain = [index for index, values in enumerate(rows) if values["client_msg_id"] is None]
+        # (sender_id, client_msg_id) -> индекс первой строки с этим ключом в пачке
+        keyed: Dict[tuple, int] = {}
+        repeated: List[Tuple[int, tuple]] = []
+        for index, values in enumerate(rows):
+            if values["client_msg_id"] is None:
+                continue
+            key = (values["sender_id"], values["client_msg_id"])
+            if key in keyed:
+                repeated.append((index, key))
+            else:
+                keyed[key] = index
+
+        async with self.session_factory() as session:
+            if plain:
+                statement = insert(Message).returning(
+                    Message.id, Message.created_at, Message.is_read, sort_by_parameter_order=True
+                )
+                result = await session.execute(statement, [rows[index] for index in plain])
+                for index, row in zip(plain, result.all()):
+                    outcomes[index] = self._message(rows[index], row)
+            if keyed:
+                # Строки с ключом идемпотентности: конфликтующие пропускаются, сопоставляем по ключу
+                statement = dialect_insert(session, Message).values(
+                    [rows[index] for index in keyed.values()]
+                ).on_conflict_do_nothing(
+                    index_elements=[Message.sender_id, Message.client_msg_id]
+                ).returning(Message.id, Message.created_at, Message.is_read, Message.sender_id, Message.client_msg_id)
+                result = await session.execute(statement)
+                for row in result.all():
+                    index = keyed[(row.sender_id, row.client_msg_id)]
+                    outcomes[index] = self._message(rows[index], row)
+                missing = [key for key, index in keyed.items() if outcomes[index] is None]
+                if missing:
+                    result = await session.execute(
+                        select(Message).where(tuple_(Message.sender_id, Message.client_msg_id).in_(missing))
+                    )
+                    for existing in result.scalars().all():
+                        outcomes[keyed[(existing.sender_id, existing.client_msg_id)]] = DuplicateMessageError(existing)
+            await session.commit()
+
+        for index, key in repeated:
+            first = outcomes[keyed[key]]
+            outcomes[index] = DuplicateMessageError(first if isinstance(first, Message) else first.message)
+        return [outcome if outcome is not None else Exception("Message not saved") for outcome in outcomes]
+
+    @staticmethod
+    def _message(values: dict, row) -> Message:
+        return Message(id=row.id, created_at=row.created_at, is_read=row.is_read, **values)
+
+    def _resolve_outcome(self, future: asyncio.Future, outcome: Union[Message, Exception]):
+        if isinstance(outcome, Exception):
+            self._resolve(future, exception=outcome)
+        else:
+            self._resolve(future, outcome)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, message: Optional[Message] = None, exception: Optional[Exception] = None):
+        # Отправитель мог отключиться, пока пачка писалась
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(message)
+
+    def _record(self, size: int):
+        self.batches += 1
+        self.rows += size
+        self.max_batch = max(self.max_batch, size)
+        self.size_buckets[bisect.bisect_left(BATCH_SIZE_BUCKETS, size)] += 1
+
+    async def close(self):
+        self._flush()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        buckets = {f"le_{bound}": count for bound, count in zip(BATCH_SIZE_BUCKETS, self.size_buckets)}
+        buckets["inf"] = self.size_buckets[-1]
+        return {
+            "batches": self.batches,
+            "rows": self.rows,
+            "avg_batch": self.rows / self.batches if self.batches else 0,
+            "max_batch": self.max_batch,
+            "failed_batches": self.failed_batches,
+            "pending": len(self._pending),
+            "size_buckets": buckets,
+        }
+
+
+write_batcher = MessageWriteBatcher() if MESSAGE_BATCH_ENABLED else None
+
+if write_batcher is not None:
+    CounterFunction("fastchat_write_batches_total", "Group-commit batches written", lambda: write_batcher.batches)
+    CounterFunction("fastchat_write_batch_rows_total", "Rows written by group commit", lambda: write_batcher.rows)
+    CounterFunction("fastchat_write_batches_failed_total", "Batches retried row by row", lambda: write_batcher.failed_batches)
+    Gauge("fastchat_write_batch_pending", "Messages waiting for the next batch", function=lambda: len(write_batcher._pending))
@@ -0,0 +1,285 @@
+"""Нагрузочный прогон REST и WebSocket путей приложения в одном процессе.
+
+Запуск: python -m benchmarks.bench --chats 10 --members 10 --messages 20 --output bench.json
+Сравнение с прошлым прогоном: --baseline old.json (код возврата 1 при регрессии).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from typing import Dict, List, Optional
+
+# База по умолчанию — локальный файл SQLite, чтобы прогон работал без PostgreSQL.
+# URL нужно выставить до импорта приложения: движок создаётся при импорте app.database
+_DEFAULT_DB_PATH = os.path.join(tempfile.gettempdir(), "fastchat-bench.db")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{_DEFAULT_DB_PATH}")
+
+from httpx import ASGITransport, AsyncClient  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+from app.main import app  # noqa: E402
+from app.auth import create_access_token, password_hasher  # noqa: E402
+from app.database import engine  # noqa: E402
+from app.models import Base, Chat, ChatType, User, chat_users  # noqa: E402
+from app.database import async_session  # noqa: E402
+from tests.ws_client import ASGIWebSocketClient  # noqa: E402
+
+BENCH_PASSWORD = "bench-password"
+
+# Метрики, где больше — лучше; для остальных (задержки) лучше меньше
+HIGHER_IS_BETTER = {"messages_per_second", "logins_per_second", "delivery_ratio"}
+
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples: List[float]) -> dict:
+    # Задержки в миллисекундах
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+        "mean_ms": statistics.fmean(samples) * 1000 if samples else 0.0,
+    }
+
+
+async def reset_database():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+
+async def seed(chats: int, members: int) -> Dict[int, List[int]]:
+    """Пользователи и чаты создаются напрямую в БД одним хешем пароля:
+    иначе подготовка упирается в bcrypt и длится дольше самого замера."""
+    password_hash = await password_hasher.hash(BENCH_PASSWORD)
+    users = [
+        {"username": f"bench{i}", "email": f"bench{i}@example.com", "password": password_hash}
+        for i in range(chats * members)
+    ]
+    layout: Dict[int, List[int]] = {}
+    async with async_session() as db:
+        user_ids = list((await db.execute(insert(User).returning(User.id), users)).scalars())
+        for chat_index in range(chats):
+            member_ids = user_ids[chat_index * members:(chat_index + 1) * members]
+            chat_id = (await db.execute(
+                insert(Chat).values(name=f"bench chat {chat_index}", type=ChatType.group, creator_id=member_ids[0])
+                .returning(Chat.id)
+            )).scalar_one()
+            await db.execute(insert(chat_users), [{"chat_id": chat_id, "user_id": uid} for uid in member_ids])
+            layout[chat_id] = member_ids
+        await db.commit()
+    return layout
+
+
+class BenchClient:
+    """Участник чата: шлёт сообщения и засекает, когда до него дошли чужие."""
+
+    def __init__(self, chat_id: int, user_id: int, expected: int, sent_at: Dict[str, float]):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.expected = expected
+        self.sent_at = sent_at
+        self.received = 0
+        self.latencies: List[float] = []
+        self.done = asyncio.Event()
+        if expected == 0:
+            self.done.set()
+
+    async def run(self, messages: int, ready: asyncio.Barrier, start: asyncio.Event, deadline: float):
+        token = create_access_token(data={"sub": f"bench{self.user_id}", "uid": self.user_id})
+        async with ASGIWebSocketClient(app, f"/ws/{self.chat_id}", f"token={token}") as ws:
+            receiver = asyncio.create_task(self._receive(ws))
+            await ready.wait()
+            await start.wait()
+            for _ in range(messages):
+                client_msg_id = uuid.uuid4().hex
+                self.sent_at[client_msg_id] = time.perf_counter()
+                await ws.send_json({"text": f"bench message from {self.user_id}", "client_msg_id": client_msg_id})
+                # Отдаём управление, чтобы отправители чередовались, а не шли пачкой
+                await asyncio.sleep(0)
+            try:
+                await asyncio.wait_for(self.done.wait(), timeout=max(0.0, deadline - time.perf_counter()))
+            except asyncio.TimeoutError:
+                pass
+            receiver.cancel()
+
+    async def _receive(self, ws: ASGIWebSocketClient):
+        while True:
+            message = await ws.receive_json(timeout=None)
+            sent = self.sent_at.get(message.get("client_msg_id")) if isinstance(message, dict) else None
+            if sent is None:
+                continue
+            self.latencies.append(time.perf_counter() - sent)
+            self.received += 1
+            if self.received >= self.expected:
+                self.done.set()
+
+
+async def bench_fanout(layout: Dict[int, List[int]], messages: int, timeout: float) -> dict:
+    sent_at: Dict[str, float] = {}
+    clients = [
+        BenchClient(chat_id, user_id, messages * len(members), sent_at)
+        for chat_id, members in layout.items() for user_id in members
+    ]
+    ready = asyncio.Barrier(len(clients) + 1)
+    start = asyncio.Event()
+    deadline = time.perf_counter() + timeout
+    tasks = [asyncio.create_task(client.run(messages, ready, start, deadline)) for client in clients]
+    await ready.wait()
+    started_at = time.perf_counter()
+    start.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started_at
+
+    expected = sum(client.expected for client in clients)
+    received = sum(client.received for client in clients)
+    latencies = [sample for client in clients for sample in client.latencies]
+    return {
+        "clients": len(clients),
+        "messages_sent": len(sent_at),
+        "deliveries_expected": expected,
+        "deliveries_received": received,
+        "delivery_ratio": received / expected if expected else 1.0,
+        "elapsed_s": elapsed,
+        "messages_per_second": len(sent_at) / elapsed if elapsed else 0.0,
+        "fanout_latency": summarize(latencies),
+    }
+
+
+async def bench_history(client: AsyncClient, chat_ids: List[int], requests: int, page_size: int) -> dict:
+    latencies: List[float] = []
+    for i in range(requests):
+        chat_id = chat_ids[i % len(chat_ids)]
+        # Чередуем последнюю страницу и старый offset-режим
+        params = {"limit": page_size, "order": "desc"} if i % 2 == 0 else {"limit": page_size}
+        started_at = time.perf_counter()
+        response = await client.get(f"/history/{chat_id}", params=params)
+        latencies.append(time.perf_counter() - started_at)
+        response.raise_for_status()
+    return {"requests": requests, "page_size": page_size, "latency": summarize(latencies)}
+
+
+async def bench_login(client: AsyncClient, users: int, logins: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def login(i: int):
+        async with semaphore:
+            started_at = time.perf_counter()
+            response = await client.post("/token", data={
+                "username": f"bench{i % users}", "password": BENCH_PASSWORD,
+            })
+            latencies.append(time.perf_counter() - started_at)
+            response.raise_for_status()
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(login(i) for i in range(logins)))
+    elapsed = time.perf_counter() - started_at
+    return {
+        "logins": logins,
+        "concurrency": concurrency,
+        "logins_per_second": logins / elapsed if elapsed else 0.0,
+        "latency": summarize(latencies),
+    }
+
+
+async def run(args) -> dict:
+    async with app.router.lifespan_context(app):
+        await reset_database()
+        layout = await seed(args.chats, args.members)
+        transport = ASGITransport(app=app)
+        async with AsyncClient(transport=transport, base_url="http://bench") as client:
+            fanout = await bench_fanout(layout, args.messages, args.timeout)
+            history = await bench_history(client, list(layout), args.history_requests, args.page_size)
+            login = await bench_login(client, args.chats * args.members, args.logins, args.login_concurrency)
+    await engine.dispose()
+    return {
+        "config": {
+            "chats": args.chats,
+            "members": args.members,
+            "messages_per_client": args.messages,
+            "database": engine.url.render_as_string(hide_password=True),
+        },
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "fanout": fanout,
+        "history": history,
+        "login": login,
+    }
+
+
+def flatten(results: dict) -> Dict[str, float]:
+    # Сравниваемые показатели: пропускная способность и p99 задержек
+    return {
+        "messages_per_second": results["fanout"]["messages_per_second"],
+        "delivery_ratio": results["fanout"]["delivery_ratio"],
+        "fanout_p50_ms": results["fanout"]["fanout_latency"]["p50_ms"],
+        "fanout_p99_ms": results["fanout"]["fanout_latency"]["p99_ms"],
+        "history_p99_ms": results["history"]["latency"]["p99_ms"],
+        "logins_per_second": results["login"]["logins_per_second"],
+    }
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Возвращает список регрессий сильнее tolerance (доля, 0.2 = 20%)."""
+    regressions = []
+    now, before = flatten(current), flatten(baseline)
+    for name, old in before.items():
+        new = now[name]
+        if name in HIGHER_IS_BETTER:
+            regressed = new < old * (1 - tolerance)
+        else:
+            regressed = new > old * (1 + tolerance)
+        if regressed:
+            regressions.append(f"{name}: {old:.3f} -> {new:.3f}")
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="FastChat benchmark")
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=10, help="Сообщений от каждого участника")
+    parser.add_argument("--history-requests", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--logins", type=int, default=20)
+    parser.add_argument("--login-concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Предел ожидания доставки, с")
+    parser.add_argument("--output", help="Файл для JSON-результатов (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое ухудшение, доля")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    results = asyncio.run(run(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,4 +10,7 @@ def event_loop():
     """Создаём event loop для тестов с scope=module"""
     loop = asyncio.get_event_loop_policy().new_event_loop()
     yield loop
+    # Соединения пула привязаны к этому loop: закрываем их, чтобы следующий модуль начал с чистого пула
+    from app.database import engine
+    loop.run_until_complete(engine.dispose())
     loop.close()
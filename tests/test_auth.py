@@ -0,0 +1,93 @@
+import asyncio
+import time
+import pytest
+from fastapi import HTTPException
+from app.auth import (
+    AuthenticatedUser,
+    PasswordHasher,
+    check_password_hashing,
+    create_access_token,
+    get_current_user,
+    invalidate_user,
+    token_cache,
+    user_cache,
+    UserIdentityCache
+)
+from app.database import engine, async_session
+from app.models import Base, User
+
+
+class CountingSession:
+    """Обёртка над сессией, считающая обращения к БД."""
+
+    def __init__(self, session):
+        self.session = session
+        self.queries = 0
+
+    async def execute(self, *args, **kwargs):
+        self.queries += 1
+        return await self.session.execute(*args, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_get_current_user_uses_token_claims_and_caches():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    token_cache.clear()
+    user_cache.clear()
+    async with async_session() as session:
+        user = User(username="cacheuser", email="cacheuser@example.com", password="x")
+        session.add(user)
+        await session.commit()
+        db = CountingSession(session)
+
+        # Токен с uid: ни одного запроса к БД
+        token = create_access_token({"sub": "cacheuser", "uid": user.id})
+        assert await get_current_user(token, db) == AuthenticatedUser(user.id, "cacheuser")
+        assert db.queries == 0
+
+        # Старый токен без uid: один запрос, дальше — из кэша личностей
+        legacy_token = create_access_token({"sub": "cacheuser"})
+        assert (await get_current_user(legacy_token, db)).id == user.id
+        assert (await get_current_user(legacy_token, db)).id == user.id
+        assert db.queries == 1
+
+        # После инвалидации пользователь перепроверяется даже по токену с uid
+        await session.delete(user)
+        await session.commit()
+        invalidate_user("cacheuser")
+        with pytest.raises(HTTPException):
+            await get_current_user(token, db)
+        assert db.queries == 2
+
+    with pytest.raises(HTTPException):
+        await get_current_user("not-a-jwt", None)
+
+
+@pytest.mark.asyncio
+async def test_password_hasher_runs_off_loop_with_concurrency_limit():
+    hasher = PasswordHasher(workers=1, kind="thread")
+    try:
+        hashes = await asyncio.gather(*(hasher.hash(f"secret{i}") for i in range(3)))
+        assert await hasher.verify("secret1", hashes[1])
+        assert not await hasher.verify("wrong", hashes[1])
+        stats = hasher.stats()
+        assert stats["calls"] == 5 and stats["waiting"] == 0
+        # Один воркер: второй и третий вызовы ждали в очереди
+        assert stats["queue_wait_max"] > 0
+        await check_password_hashing(hasher)
+    finally:
+        hasher.shutdown()
+
+
+def test_invalidations_expire_with_token_lifetime():
+    cache = UserIdentityCache(invalidation_ttl=0.05)
+    cache.invalidate("a")
+    cache.invalidate("b")
+    assert cache.needs_lookup("a")
+    time.sleep(0.06)
+    cache.invalidate("c")
+    # Токены, выданные до инвалидации "a" и "b", уже истекли: отметки удалены
+    assert not cache.needs_lookup("a")
+    assert list(cache._invalidated) == ["c"]
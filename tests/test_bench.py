@@ -0,0 +1,29 @@
+import copy
+from benchmarks.bench import compare, percentile
+
+
+def _results(messages_per_second, fanout_p99_ms):
+    latency = {"p50_ms": 1.0, "p99_ms": 2.0}
+    return {
+        "fanout": {
+            "messages_per_second": messages_per_second,
+            "delivery_ratio": 1.0,
+            "fanout_latency": {"p50_ms": 1.0, "p99_ms": fanout_p99_ms},
+        },
+        "history": {"latency": copy.deepcopy(latency)},
+        "login": {"logins_per_second": 10.0, "latency": latency},
+    }
+
+
+def test_percentile():
+    samples = [float(i) for i in range(1, 101)]
+    assert percentile(samples, 50) == 51.0
+    assert percentile(samples, 99) == 99.0
+    assert percentile([], 99) == 0.0
+
+
+def test_compare_flags_only_regressions_beyond_tolerance():
+    baseline = _results(1000.0, 10.0)
+    assert compare(_results(900.0, 11.0), baseline, tolerance=0.2) == []
+    regressions = compare(_results(700.0, 15.0), baseline, tolerance=0.2)
+    assert [line.split(":")[0] for line in regressions] == ["messages_per_second", "fanout_p99_ms"]
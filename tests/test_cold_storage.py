@@ -0,0 +1,70 @@
+import asyncio
+import datetime
+from app.cold_storage import ColdStore
+
+BASE_TIME = datetime.datetime(2020, 1, 1)
+
+
+def record(message_id: int, chat_id: int = 1):
+    return {
+        "id": message_id, "chat_id": chat_id, "sender_id": 1, "text": f"old {message_id}",
+        "created_at": (BASE_TIME + datetime.timedelta(minutes=message_id)).isoformat(), "is_read": False,
+    }
+
+
+def test_segments_roll_and_reads_cross_block_boundaries(tmp_path):
+    store = ColdStore(str(tmp_path), block_messages=3, segment_messages=6)
+    store.append(1, [record(i) for i in range(1, 8)])
+    store.append(1, [record(i) for i in range(8, 11)])
+
+    assert store.count(1) == 10
+    assert sorted(p.name for p in (tmp_path / "1").iterdir()) == ["000001.idx", "000001.seg", "000002.idx", "000002.seg"]
+    assert [m.id for m in store.read_range(1, 2, 8)] == [3, 4, 5, 6, 7, 8]
+    assert store.last_key(1) == (BASE_TIME + datetime.timedelta(minutes=10), 10)
+
+    key5 = store.find_key(1, 5)
+    assert key5 == (BASE_TIME + datetime.timedelta(minutes=5), 5)
+    assert [m.id for m in store.read_before(1, key5, 3)] == [4, 3, 2]
+    assert [m.id for m in store.read_after(1, key5, 3)] == [6, 7, 8]
+    assert [m.id for m in store.read_before(1, None, 2)] == [10, 9]
+    assert [len(p) for p in store.iter_partitions(1)] == [3, 3, 1, 3]
+    assert store.count(2) == 0
+
+
+def test_torn_index_entry_is_ignored_and_overwritten(tmp_path):
+    store = ColdStore(str(tmp_path), block_messages=2)
+    store.append(1, [record(1), record(2)])
+    # Сбой посреди записи: в индексе и сегменте остался мусор
+    with open(tmp_path / "1" / "000001.idx", "ab") as f:
+        f.write(b"\x00" * 10)
+    with open(tmp_path / "1" / "000001.seg", "ab") as f:
+        f.write(b"garbage")
+    assert store.count(1) == 2
+
+    store.append(1, [record(3)])
+    assert [m.id for m in ColdStore(str(tmp_path)).read_range(1, 0, 10)] == [1, 2, 3]
+
+
+def test_index_is_rechecked_after_interval(tmp_path):
+    reader = ColdStore(str(tmp_path), check_seconds=60)
+    assert reader.count(1) == 0
+    # Дозапись другим процессом (архиватором): до следующей проверки каталога не видна
+    ColdStore(str(tmp_path)).append(1, [record(1), record(2)])
+    assert reader.count(1) == 0
+    reader.check_seconds = 0
+    assert reader.count(1) == 2
+    # Своя дозапись видна сразу
+    reader.check_seconds = 60
+    reader.append(1, [record(3)])
+    assert reader.count(1) == 3
+
+
+def test_index_cache_is_bounded_and_boundary_reads_from_memory(tmp_path):
+    store = ColdStore(str(tmp_path), check_seconds=60, max_chats=2)
+    store.append(1, [record(1), record(5), record(3)])
+    boundary = asyncio.run(store.boundary(1))
+    assert boundary == (3, (BASE_TIME + datetime.timedelta(minutes=3), 3), 5)
+    # Чаты без холодного слоя тоже кэшируются, но вытесняются по LRU
+    assert asyncio.run(store.boundary(2)).count == 0
+    assert asyncio.run(store.boundary(3)).count == 0
+    assert list(store._indexes) == [2, 3]
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import zlib
+import msgpack
+import pytest
+from app.codecs import get_codec
+from app.connection_manager import WS_COMPRESS_MIN_BYTES, ConnectionManager, SlowConsumerPolicy
+
+
+class FakeWebSocket:
+    """Заглушка WebSocket: записывает отправленное, может "зависнуть" на отправке."""
+
+    def __init__(self, blocked: bool = False):
+        self.sent = []
+        self.closed_with = None
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        await self.unblocked.wait()
+        self.sent.append(json.loads(data))
+
+    async def send_bytes(self, data: bytes):
+        await self.unblocked.wait()
+        self.sent.append(data)
+
+    async def close(self, code: int = 1000):
+        self.closed_with = code
+
+
+async def drain():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_slow_consumer_does_not_block_broadcast():
+    manager = ConnectionManager(max_queue_size=2, policy=SlowConsumerPolicy.drop_oldest)
+    fast, slow = FakeWebSocket(), FakeWebSocket(blocked=True)
+    await manager.connect(1, fast, user_id=1)
+    await manager.connect(1, slow, user_id=2)
+
+    for i in range(5):
+        await asyncio.wait_for(manager.broadcast(1, {"n": i}), timeout=1)
+    await drain()
+
+    assert [m["n"] for m in fast.sent] == [0, 1, 2, 3, 4]
+    stats = {s["user_id"]: s for s in manager.connection_stats()}
+    assert stats[2]["dropped"] >= 2
+    assert stats[2]["max_depth"] == 2
+
+    slow.unblocked.set()
+    await drain()
+    # Писатель успел забрать первое сообщение до "зависания", затем получил два самых свежих
+    assert [m["n"] for m in slow.sent][-2:] == [3, 4]
+    manager.disconnect(1, fast)
+    manager.disconnect(1, slow)
+
+
+@pytest.mark.asyncio
+async def test_coalesce_policy_replaces_pending_message_with_same_key():
+    manager = ConnectionManager(max_queue_size=10, policy=SlowConsumerPolicy.coalesce)
+    ws = FakeWebSocket(blocked=True)
+    await manager.connect(1, ws)
+    await manager.broadcast(1, {"n": "first"})
+    await drain()
+    for i in range(3):
+        await manager.broadcast(1, {"read_up_to": i}, key="read")
+    ws.unblocked.set()
+    await drain()
+    assert ws.sent == [{"n": "first"}, {"read_up_to": 2}]
+    assert manager.connection_stats()[0]["coalesced"] == 2
+    manager.disconnect(1, ws)
+
+
+@pytest.mark.asyncio
+async def test_disconnect_policy_closes_slow_consumer():
+    manager = ConnectionManager(max_queue_size=1, policy=SlowConsumerPolicy.disconnect)
+    ws = FakeWebSocket(blocked=True)
+    await manager.connect(1, ws)
+    for i in range(3):
+        await manager.broadcast(1, {"n": i})
+    await drain()
+    assert ws.closed_with == 1013
+    assert 1 not in manager.active_connections
+    assert manager.connection_stats() == []
+
+
+@pytest.mark.asyncio
+async def test_resume_sends_replay_before_live_without_duplicates():
+    manager = ConnectionManager()
+    websocket = FakeWebSocket()
+    await manager.connect(1, websocket, user_id=1, paused=True)
+
+    # Пока идёт запрос пропущенного, приходят живые сообщения; одно из них попадёт и в досылку
+    await manager.broadcast(1, {"id": 3, "text": "c"})
+    await manager.broadcast(1, {"id": 4, "text": "d"})
+    await drain()
+    assert websocket.sent == []
+
+    manager.resume(websocket, [{"id": 2, "text": "b"}, {"id": 3, "text": "c"}])
+    await drain()
+    assert [m["id"] for m in websocket.sent] == [2, 3, 4]
+    manager.disconnect(1, websocket)
+
+
+@pytest.mark.asyncio
+async def test_paused_outbox_keeps_live_backlog_beyond_max_size():
+    manager = ConnectionManager(max_queue_size=256, policy=SlowConsumerPolicy.disconnect)
+    websocket = FakeWebSocket()
+    await manager.connect(1, websocket, user_id=1, paused=True)
+    # Медленная досылка: за это время в чат приходит больше сообщений, чем вмещает очередь
+    for i in range(2, 302):
+        await manager.broadcast(1, {"id": i})
+    manager.resume(websocket, [{"id": 1}])
+    for _ in range(50):
+        await drain()
+    assert [m["id"] for m in websocket.sent] == list(range(1, 302))
+    assert websocket.closed_with is None
+    manager.disconnect(1, websocket)
+
+
+@pytest.mark.asyncio
+async def test_paused_outbox_overflow_requires_resync(monkeypatch):
+    monkeypatch.setattr("app.connection_manager.RESUME_MAX_MESSAGES", 3)
+    manager = ConnectionManager(max_queue_size=2)
+    websocket = FakeWebSocket()
+    await manager.connect(1, websocket, user_id=1, paused=True)
+    for i in range(10):
+        await manager.broadcast(1, {"id": i})
+    await drain()
+    # Ничего не выброшено молча: клиент получает сигнал перечитать историю, соединение закрывается
+    assert websocket.sent == [{"action": "resync_required", "chat_id": 1, "reason": "live_backlog_overflow"}]
+    assert websocket.closed_with == 1013
+    manager.resume(websocket, [{"id": 0}])
+    await drain()
+    assert len(websocket.sent) == 1
+    manager.disconnect(1, websocket)
+
+
+@pytest.mark.asyncio
+async def test_batched_outbox_packs_events_and_compresses_large_frames():
+    manager = ConnectionManager()
+    ws = FakeWebSocket()
+    await manager.connect(1, ws, batch=True, compress=True)
+    for i in range(4):
+        await manager.broadcast(1, {"n": i})
+    await asyncio.sleep(0.05)
+    # События за окно склейки ушли одним фреймом-массивом; мелкий фрейм не сжимается
+    assert ws.sent == [[{"n": 0}, {"n": 1}, {"n": 2}, {"n": 3}]]
+
+    await manager.broadcast(1, {"text": "x" * WS_COMPRESS_MIN_BYTES})
+    await asyncio.sleep(0.05)
+    compressed = ws.sent[-1]
+    assert isinstance(compressed, bytes)
+    assert json.loads(zlib.decompress(compressed, -zlib.MAX_WBITS)) == [{"text": "x" * WS_COMPRESS_MIN_BYTES}]
+    stats = manager.connection_stats()[0]
+    assert (stats["events"], stats["sent"], stats["frames_saved"]) == (5, 2, 3)
+    assert stats["bytes_saved"] > WS_COMPRESS_MIN_BYTES // 2
+    manager.disconnect(1, ws)
+
+
+def test_msgpack_array_packing_matches_encoder():
+    codec = get_codec("msgpack")
+    for count in (1, 15, 16, 70000):
+        events = [{"n": i} for i in range(count)]
+        assert msgpack.unpackb(codec.pack_array([codec.encode(e) for e in events])) == events
@@ -0,0 +1,16 @@
+from app.dedup import RecentMessageFilter
+
+
+def test_recent_message_filter_is_bounded_and_expires():
+    recent = RecentMessageFilter(ttl=1.0, max_entries=3)
+    assert not recent.is_duplicate(1, 1, "hello", now=100.0)
+    assert recent.is_duplicate(1, 1, "hello", now=100.5)
+    assert not recent.is_duplicate(2, 1, "hello", now=100.5)
+
+    # По истечении окна запись вытесняется и сообщение снова разрешено
+    assert not recent.is_duplicate(1, 1, "hello", now=101.6)
+    assert len(recent) == 1
+
+    for i in range(10):
+        recent.is_duplicate(1, 1, f"text {i}", now=102.0)
+    assert len(recent) == 3
@@ -0,0 +1,79 @@
+import datetime
+from types import SimpleNamespace
+from app.history_cache import MESSAGE_OVERHEAD_BYTES, RecentHistoryCache
+
+BASE_TIME = datetime.datetime(2024, 1, 1)
+
+
+def make_message(message_id: int, chat_id: int = 1, text: str = "x"):
+    return SimpleNamespace(
+        id=message_id, chat_id=chat_id, text=text, client_msg_id=None,
+        created_at=BASE_TIME + datetime.timedelta(seconds=message_id),
+    )
+
+
+def warm(cache: RecentHistoryCache, chat_id: int, rows, complete: bool):
+    token = cache.begin_warm(chat_id)
+    cache.complete_warm(token, chat_id, rows, complete)
+
+
+def test_buffer_keeps_latest_messages_in_order():
+    cache = RecentHistoryCache(per_chat=3)
+    # Сообщения до прогрева в буфер не попадают
+    cache.add(make_message(1))
+    assert cache.get_latest(1, 1) is None
+
+    warm(cache, 1, [make_message(2), make_message(1)], complete=True)
+    assert [m.id for m in cache.get_all(1)] == [1, 2]
+
+    cache.add(make_message(4))
+    cache.add(make_message(3))
+    assert [m.id for m in cache.get_latest(1, 3)] == [4, 3, 2]
+    # Самое старое вытеснено: полной истории больше нет, длинная страница — промах
+    assert cache.get_all(1) is None
+    assert cache.get_latest(1, 4) is None
+
+
+def test_messages_sent_during_warm_are_kept_and_invalidation_discards_warm():
+    cache = RecentHistoryCache(per_chat=10)
+    token = cache.begin_warm(1)
+    cache.add(make_message(5))
+    cache.complete_warm(token, 1, [make_message(4)], complete=True)
+    assert [m.id for m in cache.get_all(1)] == [4, 5]
+
+    token = cache.begin_warm(2)
+    cache.invalidate(2)
+    cache.complete_warm(token, 2, [make_message(1, chat_id=2)], complete=True)
+    assert cache.get_latest(2, 1) is None
+
+
+def test_memory_budget_evicts_least_recently_used_chat():
+    cache = RecentHistoryCache(per_chat=10, memory_bytes=3 * (MESSAGE_OVERHEAD_BYTES + 1))
+    warm(cache, 1, [make_message(1, chat_id=1)], complete=True)
+    warm(cache, 2, [make_message(2, chat_id=2)], complete=True)
+    cache.get_latest(1, 1)
+    warm(cache, 3, [make_message(3, chat_id=3), make_message(4, chat_id=3)], complete=True)
+    assert cache.get_latest(2, 1) is None
+    assert cache.get_latest(1, 1) is not None
+    assert cache.evicted == 1
+
+
+def test_read_state_is_not_stored_after_concurrent_invalidation():
+    cache = RecentHistoryCache()
+    warm(cache, 1, [], complete=True)
+    generation = cache.read_generation(1)
+    cache.invalidate_read_state(1)
+    cache.set_read_state(1, "stale", generation)
+    assert cache.get_read_state(1) is None
+    cache.set_read_state(1, "fresh", cache.read_generation(1))
+    assert cache.get_read_state(1) == "fresh"
+
+
+def test_disabled_buffer_never_answers():
+    # Общая шина: сообщения других воркеров в буфер не попадают, поэтому он выключен
+    cache = RecentHistoryCache(enabled=False)
+    warm(cache, 1, [make_message(1)], complete=True)
+    cache.add(make_message(2))
+    assert cache.get_latest(1, 1) is None
+    assert cache.get_all(1) is None
+    assert cache.stats()["chats"] == 0
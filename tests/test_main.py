@@ -1,10 +1,24 @@
+import asyncio
+import datetime
+import gzip
+import json
+import zlib
+import msgpack
 import pytest_asyncio
 import pytest
 from httpx import ASGITransport, AsyncClient
 from app.main import app
-from app.database import engine, async_session
+from app.database import engine, async_session, pool_stats
 from app.models import Base, Message
 from sqlalchemy.future import select
+from app.membership import membership_cache
+from app.history_cache import history_cache
+from app.unread import unread_counters
+from app.tracing import tracer
+from app.cold_storage import ColdStore, archive_cold_messages
+from app.repositories import ReadStateRepository
+from app.rate_limit import FlowController
+from tests.ws_client import ASGIWebSocketClient, WebSocketRejected
 
 
 @pytest_asyncio.fixture(scope="function")
@@ -13,6 +27,9 @@ async def async_client():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.drop_all)
         await conn.run_sync(Base.metadata.create_all)
+    # Буфер последних сообщений переживает пересоздание таблиц: id чатов снова начинаются с 1
+    history_cache.clear()
+    unread_counters.clear()
     # Создание клиента для REST‑тестирования через ASGITransport
     transport = ASGITransport(app=app)
     async with AsyncClient(transport=transport, base_url="http://test") as client:
@@ -151,3 +168,601 @@ async def test_mark_message_read(async_client: AsyncClient):
         result = await session.execute(select(Message).where(Message.id == message_id))
         msg = result.scalar_one_or_none()
         assert msg is not None and msg.is_read is True
+
+
+async def create_user_with_token(client: AsyncClient, username: str, password: str = "password"):
+    response = await client.post("/users/", params={
+        "username": username,
+        "email": f"{username}@example.com",
+        "password": password
+    })
+    user = response.json()
+    response = await client.post("/token", data={"username": username, "password": password})
+    return user, response.json()["access_token"]
+
+
+@pytest.mark.asyncio
+async def test_websocket_broadcast_encodes_per_codec(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "wsuser1")
+    user2, token2 = await create_user_with_token(async_client, "wsuser2")
+    response = await async_client.post("/chats/", json={
+        "name": "WS Chat",
+        "user_ids": [user1["id"], user2["id"]]
+    })
+    chat_id = response.json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}&codec=json") as ws_json, \
+            ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token2}&codec=msgpack") as ws_msgpack:
+        await ws_msgpack.send_bytes(msgpack.packb({"text": "Hello codecs"}))
+
+        text_frame = await ws_json.receive()
+        binary_frame = await ws_msgpack.receive()
+
+    assert text_frame["type"] == "websocket.send" and "text" in text_frame
+    from_json = json.loads(text_frame["text"])
+    from_msgpack = msgpack.unpackb(binary_frame["bytes"])
+    assert from_json == from_msgpack
+    assert from_json["text"] == "Hello codecs" and from_json["sender_id"] == user2["id"]
+
+
+@pytest.mark.asyncio
+async def test_history_cursor_pagination(async_client: AsyncClient):
+    response = await async_client.post("/users/", params={
+        "username": "pageuser",
+        "email": "pageuser@example.com",
+        "password": "pass"
+    })
+    user = response.json()
+    response = await async_client.post("/chats/", json={"name": "Page Chat", "user_ids": [user["id"]]})
+    chat_id = response.json()["id"]
+
+    async with async_session() as session:
+        messages = [Message(chat_id=chat_id, sender_id=user["id"], text=f"m{i}") for i in range(5)]
+        session.add_all(messages)
+        await session.commit()
+        ids = [m.id for m in messages]
+
+    # Последние сообщения, от новых к старым
+    response = await async_client.get(f"/history/{chat_id}", params={"order": "desc", "limit": 2})
+    assert response.status_code == 200
+    page = response.json()
+    assert [m["id"] for m in page["messages"]] == [ids[4], ids[3]]
+
+    # Продолжение по курсору
+    response = await async_client.get(f"/history/{chat_id}", params={"cursor": page["next_cursor"], "limit": 2})
+    page = response.json()
+    assert [m["id"] for m in page["messages"]] == [ids[2], ids[1]]
+    response = await async_client.get(f"/history/{chat_id}", params={"cursor": page["next_cursor"], "limit": 2})
+    page = response.json()
+    assert [m["id"] for m in page["messages"]] == [ids[0]]
+    assert page["next_cursor"] is None
+
+    # Более новые сообщения после заданного, по возрастанию
+    response = await async_client.get(f"/history/{chat_id}", params={"after_id": ids[1], "limit": 10})
+    assert [m["id"] for m in response.json()["messages"]] == ids[2:]
+
+    # Более старые сообщения перед заданным, по возрастанию
+    response = await async_client.get(f"/history/{chat_id}", params={"before_id": ids[3], "limit": 2})
+    assert [m["id"] for m in response.json()["messages"]] == [ids[1], ids[2]]
+
+    response = await async_client.get(f"/history/{chat_id}", params={"cursor": "garbage"})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_read_up_to_advances_watermark_and_coalesces_updates(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "readuser1")
+    user2, token2 = await create_user_with_token(async_client, "readuser2")
+    response = await async_client.post("/chats/", json={
+        "name": "Read Chat",
+        "user_ids": [user1["id"], user2["id"]]
+    })
+    chat_id = response.json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}") as ws1, \
+            ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token2}") as ws2:
+        await ws1.send_json({"text": "first"})
+        first = await ws1.receive_json()
+        await ws2.receive_json()
+        await ws1.send_json({"text": "second"})
+        second = await ws1.receive_json()
+        await ws2.receive_json()
+
+        response = await async_client.get(f"/history/{chat_id}")
+        assert [m["is_read"] for m in response.json()] == [False, False]
+
+        # Несколько продвижений в пределах тика дают одно уведомление
+        await ws2.send_json({"action": "read", "up_to": first["id"]})
+        await ws2.send_json({"action": "read", "up_to": second["id"]})
+        await ws2.send_json({"action": "read", "message_id": first["id"]})
+        update = await ws1.receive_json()
+        assert update == {
+            "action": "read_update",
+            "chat_id": chat_id,
+            "watermarks": [{"user_id": user2["id"], "up_to": second["id"]}],
+        }
+        with pytest.raises(asyncio.TimeoutError):
+            await ws1.receive(timeout=0.2)
+
+        # Позиция за последним сообщением чата прижимается к нему: будущие сообщения не станут прочитанными
+        await ws1.send_json({"action": "read", "up_to": second["id"] + 1000})
+        await ws2.receive_json()  # уведомление о прочтении user2
+        update = await ws2.receive_json()
+        assert update["watermarks"] == [{"user_id": user1["id"], "up_to": second["id"]}]
+
+    response = await async_client.get(f"/history/{chat_id}")
+    assert [m["is_read"] for m in response.json()] == [True, True]
+    response = await async_client.get(f"/chats/{chat_id}/read_state")
+    assert sorted(response.json(), key=lambda w: w["user_id"]) == [
+        {"user_id": user1["id"], "up_to": second["id"]},
+        {"user_id": user2["id"], "up_to": second["id"]},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_client_msg_id_makes_retries_idempotent(async_client: AsyncClient):
+    user, token = await create_user_with_token(async_client, "retryuser")
+    response = await async_client.post("/chats/", json={"name": "Retry Chat", "user_ids": [user["id"]]})
+    chat_id = response.json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token}") as ws:
+        await ws.send_json({"text": "only once", "client_msg_id": "abc-1"})
+        original = await ws.receive_json()
+        # Нестроковый текст отклоняется, соединение остаётся рабочим
+        await ws.send_json({"text": 123})
+        assert (await ws.receive_json()) == {"error": "text must be a string"}
+    # Повтор после переподключения: сообщение не создаётся заново, отправитель получает подтверждение
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token}") as ws:
+        await ws.send_json({"text": "only once", "client_msg_id": "abc-1"})
+        ack = await ws.receive_json()
+
+    assert original["client_msg_id"] == "abc-1" and "duplicate" not in original
+    assert ack["duplicate"] is True and ack["id"] == original["id"]
+    async with async_session() as session:
+        result = await session.execute(select(Message).where(Message.chat_id == chat_id))
+        assert len(result.scalars().all()) == 1
+
+
+@pytest.mark.asyncio
+async def test_membership_checks_and_member_removal(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "member1")
+    user2, token2 = await create_user_with_token(async_client, "member2")
+    user3, token3 = await create_user_with_token(async_client, "member3")
+    response = await async_client.post("/chats/", json={"name": "Members", "user_ids": [user1["id"], user2["id"]]})
+    chat_id = response.json()["id"]
+
+    # Не участник не может подключиться, в том числе когда состав чата не закэширован
+    membership_cache.invalidate(chat_id)
+    with pytest.raises(WebSocketRejected):
+        async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token3}"):
+            pass
+    # Проверка при промахе снова кладёт состав в кэш
+    assert membership_cache.get_members(chat_id) == {user1["id"], user2["id"]}
+
+    response = await async_client.post(f"/chats/{chat_id}/members", json={"user_ids": [user3["id"], user2["id"]]})
+    assert response.json()["added"] == [user3["id"]]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}") as ws1, \
+            ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token2}") as ws2:
+        response = await async_client.delete(f"/chats/{chat_id}/members/{user2['id']}")
+        assert response.status_code == 200
+
+        assert await ws1.receive_json() == {"action": "member_left", "chat_id": chat_id, "user_id": user2["id"]}
+        closed = await ws2.receive()
+        assert closed["type"] == "websocket.close" and closed["code"] == 1008
+
+        await ws1.send_json({"text": "after removal"})
+        assert (await ws1.receive_json())["text"] == "after removal"
+
+    response = await async_client.delete(f"/chats/{chat_id}/members/{user2['id']}")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_idle_websocket_does_not_hold_pool_connection(async_client: AsyncClient):
+    user, token = await create_user_with_token(async_client, "idleuser")
+    response = await async_client.post("/chats/", json={"name": "Idle Chat", "user_ids": [user["id"]]})
+    chat_id = response.json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token}") as ws:
+        await ws.send_json({"text": "persisted"})
+        await ws.receive_json()
+        # Сокет открыт, но между операциями соединение возвращено в пул
+        assert pool_stats()["in_use"] == 0
+
+    response = await async_client.get("/stats/db")
+    stats = response.json()
+    assert stats["checkouts"] > 0 and stats["size"] > 0
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint_exposes_hot_path_metrics(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "metricsuser1")
+    response = await async_client.post("/chats/", json={"name": "Metrics Chat", "user_ids": [user1["id"]]})
+    chat_id = response.json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}") as ws1:
+        await ws1.send_json({"text": "measured"})
+        await ws1.receive_json()
+
+        response = await async_client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        body = response.text
+        assert f'fastchat_active_sockets{{chat_id="{chat_id}"}} 1' in body
+        assert 'fastchat_ws_messages_received_total{kind="message"}' in body
+        assert 'fastchat_repository_seconds_count{operation="create_message"}' in body
+        assert 'fastchat_db_statement_seconds_count{statement="INSERT"}' in body
+        assert 'fastchat_auth_seconds_count{stage="bcrypt"}' in body
+
+
+@pytest.mark.asyncio
+async def test_latest_history_page_served_from_recent_buffer(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "bufuser1")
+    user2, token2 = await create_user_with_token(async_client, "bufuser2")
+    response = await async_client.post("/chats/", json={"name": "Buffer Chat", "user_ids": [user1["id"], user2["id"]]})
+    chat_id = response.json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}") as ws1:
+        await ws1.send_json({"text": "before warm"})
+        first = await ws1.receive_json()
+
+        # Первый запрос прогревает буфер из БД
+        response = await async_client.get(f"/history/{chat_id}", params={"order": "desc", "limit": 10})
+        assert [m["id"] for m in response.json()["messages"]] == [first["id"]]
+        misses = history_cache.misses
+
+        # Новое сообщение попадает в буфер при отправке, запрос обслуживается без БД
+        await ws1.send_json({"text": "after warm"})
+        second = await ws1.receive_json()
+        response = await async_client.get(f"/history/{chat_id}", params={"order": "desc", "limit": 10})
+        assert [m["id"] for m in response.json()["messages"]] == [second["id"], first["id"]]
+        assert history_cache.misses == misses
+
+        # Продвижение позиции прочтения сбрасывает закэшированную сводку
+        async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token2}") as ws2:
+            await ws2.send_json({"action": "read", "up_to": second["id"]})
+            await ws1.receive_json()
+        response = await async_client.get(f"/history/{chat_id}", params={"order": "desc", "limit": 10})
+        assert [m["is_read"] for m in response.json()["messages"]] == [True, True]
+        assert history_cache.misses == misses
+
+
+@pytest.mark.asyncio
+async def test_reconnect_with_last_seen_id_replays_missed_messages(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "resumeuser1")
+    user2, token2 = await create_user_with_token(async_client, "resumeuser2")
+    response = await async_client.post("/chats/", json={"name": "Resume Chat", "user_ids": [user1["id"], user2["id"]]})
+    chat_id = response.json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}") as ws1:
+        sent = []
+        for i in range(3):
+            await ws1.send_json({"text": f"missed {i}"})
+            sent.append(await ws1.receive_json())
+
+        # Второй участник видел только первое сообщение
+        async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token2}&last_seen_id={sent[0]['id']}") as ws2:
+            await ws1.send_json({"text": "live"})
+            live = await ws1.receive_json()
+            received = [await ws2.receive_json() for _ in range(3)]
+            assert [m["id"] for m in received] == [sent[1]["id"], sent[2]["id"], live["id"]]
+            with pytest.raises(asyncio.TimeoutError):
+                await ws2.receive(timeout=0.2)
+
+        async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token2}&last_seen_id=999999") as ws2:
+            signal = await ws2.receive_json()
+            assert signal == {"action": "resync_required", "chat_id": chat_id, "reason": "unknown_last_seen_id"}
+
+
+@pytest.mark.asyncio
+async def test_export_streams_ndjson_history(async_client: AsyncClient, monkeypatch):
+    # Маленькие пачки: экспорт должен склеить несколько выборок курсора
+    monkeypatch.setattr("app.services.EXPORT_BATCH_SIZE", 2)
+    user1, token1 = await create_user_with_token(async_client, "exportuser1")
+    response = await async_client.post("/chats/", json={"name": "Export Chat", "user_ids": [user1["id"]]})
+    chat_id = response.json()["id"]
+    async with async_session() as db:
+        db.add_all([Message(chat_id=chat_id, sender_id=user1["id"], text=f"line {i}") for i in range(5)])
+        await db.commit()
+
+    response = await async_client.get(f"/chats/{chat_id}/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["text"] for line in lines] == [f"line {i}" for i in range(5)]
+
+    response = await async_client.get(f"/chats/{chat_id}/export", params={"gzip": "true"})
+    assert response.headers["content-type"] == "application/gzip"
+    assert gzip.decompress(response.content).decode().splitlines()[0] == json.dumps(lines[0], separators=(",", ":"))
+
+
+@pytest.mark.asyncio
+async def test_full_text_search_ranks_and_paginates(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "searchuser1")
+    user2, token2 = await create_user_with_token(async_client, "searchuser2")
+    chat_a = (await async_client.post("/chats/", json={"name": "A", "user_ids": [user1["id"]]})).json()["id"]
+    chat_b = (await async_client.post("/chats/", json={"name": "B", "user_ids": [user1["id"], user2["id"]]})).json()["id"]
+    async with async_session() as db:
+        db.add_all([
+            Message(chat_id=chat_a, sender_id=user1["id"], text="deploy deploy deploy tonight"),
+            Message(chat_id=chat_a, sender_id=user1["id"], text="the deploy went fine after a long wait"),
+            Message(chat_id=chat_a, sender_id=user1["id"], text="lunch?"),
+            Message(chat_id=chat_b, sender_id=user2["id"], text="deploy is blocked"),
+        ])
+        await db.commit()
+
+    response = await async_client.get(f"/chats/{chat_a}/search", params={"q": "deploy", "limit": 1})
+    assert response.status_code == 200
+    first = response.json()
+    assert [m["text"] for m in first["messages"]] == ["deploy deploy deploy tonight"]
+    response = await async_client.get(
+        f"/chats/{chat_a}/search", params={"q": "deploy", "limit": 1, "cursor": first["next_cursor"]}
+    )
+    second = response.json()
+    assert [m["text"] for m in second["messages"]] == ["the deploy went fine after a long wait"]
+    assert second["next_cursor"] is None
+
+    # Поиск по всем чатам ограничен чатами пользователя
+    response = await async_client.get("/search", params={"q": "deploy"}, headers={"Authorization": f"Bearer {token2}"})
+    assert [m["chat_id"] for m in response.json()["messages"]] == [chat_b]
+    response = await async_client.get("/search", params={"q": "deploy"}, headers={"Authorization": f"Bearer {token1}"})
+    assert len(response.json()["messages"]) == 3
+
+    response = await async_client.get(f"/chats/{chat_a}/search", params={"q": "  "})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_history_reads_across_hot_and_cold_tiers(async_client: AsyncClient, monkeypatch, tmp_path):
+    store = ColdStore(str(tmp_path), block_messages=2)
+    monkeypatch.setattr("app.repositories.cold_store", store)
+    user1, token1 = await create_user_with_token(async_client, "colduser1")
+    chat_id = (await async_client.post("/chats/", json={"name": "Cold", "user_ids": [user1["id"]]})).json()["id"]
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+    async with async_session() as db:
+        db.add_all([
+            Message(chat_id=chat_id, sender_id=user1["id"], text=f"m{i}",
+                    created_at=old + datetime.timedelta(minutes=i) if i < 5 else datetime.datetime.utcnow())
+            for i in range(8)
+        ])
+        await db.commit()
+
+    assert await archive_cold_messages(async_session, store, older_than_days=30) == 5
+    assert store.count(chat_id) == 5
+    async with async_session() as db:
+        assert len((await db.execute(select(Message).where(Message.chat_id == chat_id))).scalars().all()) == 3
+
+    texts = [f"m{i}" for i in range(8)]
+    response = await async_client.get(f"/history/{chat_id}", params={"limit": 4, "offset": 3})
+    assert [m["text"] for m in response.json()] == texts[3:7]
+
+    # Курсорный обход от новых к старым проходит через границу слоёв
+    seen, cursor = [], None
+    while True:
+        params = {"order": "desc", "limit": 3, **({"cursor": cursor} if cursor else {})}
+        page = (await async_client.get(f"/history/{chat_id}", params=params)).json()
+        seen.extend(m["text"] for m in page["messages"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == texts[::-1]
+
+    first_cold = (await async_client.get(f"/history/{chat_id}", params={"limit": 1})).json()[0]
+    response = await async_client.get(f"/history/{chat_id}", params={"after_id": first_cold["id"], "limit": 5})
+    assert [m["text"] for m in response.json()["messages"]] == texts[1:6]
+
+    response = await async_client.get(f"/chats/{chat_id}/export")
+    assert [json.loads(line)["text"] for line in response.text.splitlines()] == texts
+
+
+@pytest.mark.asyncio
+async def test_flooding_socket_gets_rate_limited_before_db(async_client: AsyncClient, monkeypatch):
+    monkeypatch.setattr("app.main.flow_control", FlowController(socket_rate=1, socket_burst=2))
+    user1, token1 = await create_user_with_token(async_client, "flooduser1")
+    chat_id = (await async_client.post("/chats/", json={"name": "Flood", "user_ids": [user1["id"]]})).json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}") as ws1:
+        for i in range(3):
+            await ws1.send_json({"text": f"flood {i}"})
+        replies = [await ws1.receive_json() for _ in range(3)]
+    assert [r.get("text") for r in replies[:2]] == ["flood 0", "flood 1"]
+    assert replies[2]["code"] == "rate_limited" and replies[2]["scope"] == "socket"
+    assert 0 < replies[2]["retry_after"] <= 1
+
+    response = await async_client.get(f"/history/{chat_id}")
+    assert len(response.json()) == 2
+
+
+@pytest.mark.asyncio
+async def test_presence_and_typing_are_ephemeral(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "presence1")
+    user2, token2 = await create_user_with_token(async_client, "presence2")
+    chat_id = (await async_client.post("/chats/", json={
+        "name": "Presence", "user_ids": [user1["id"], user2["id"]]
+    })).json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}&presence=1") as ws1:
+        snapshot = await ws1.receive_json()
+        assert snapshot == {"action": "presence", "chat_id": chat_id, "online": [user1["id"]], "typing": []}
+        async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token2}") as ws2:
+            online = await ws1.receive_json()
+            # user1 может попасть в тот же дифф, если оба подключились за один тик
+            assert user2["id"] in online["online"]
+            await ws2.send_json({"action": "typing"})
+            typing = await ws1.receive_json()
+            assert typing["typing"] == [user2["id"]]
+            await ws2.send_json({"action": "typing", "state": False})
+            assert (await ws1.receive_json())["stopped_typing"] == [user2["id"]]
+            # Сокет без ?presence=1 эфемерных событий не получает
+            with pytest.raises(asyncio.TimeoutError):
+                await ws2.receive(timeout=0.3)
+        offline = await ws1.receive_json()
+        assert offline["offline"] == [user2["id"]]
+
+    response = await async_client.get(f"/history/{chat_id}")
+    assert response.json() == []
+
+
+@pytest.mark.asyncio
+async def test_bulk_provisioning_reports_per_item_results(async_client: AsyncClient):
+    existing, _ = await create_user_with_token(async_client, "bulkexisting")
+    response = await async_client.post("/users/bulk", json=[
+        {"username": "bulk1", "email": "bulk1@example.com", "password": "secret1"},
+        {"username": "bulk2", "email": "bulk2@example.com", "password": "secret2"},
+        {"username": "bulk1", "email": "other@example.com", "password": "secret3"},
+        {"username": "bulkexisting", "email": "new@example.com", "password": "secret4"},
+        {"username": "no-password"},
+    ])
+    assert response.status_code == 200
+    body = response.json()
+    assert (body["created"], body["failed"]) == (2, 3)
+    results = body["results"]
+    assert [r["index"] for r in results] == [0, 1, 2, 3, 4]
+    assert results[0]["username"] == "bulk1" and results[1]["username"] == "bulk2"
+    assert [("error" in r) for r in results] == [False, False, True, True, True]
+    response = await async_client.post("/token", data={"username": "bulk2", "password": "secret2"})
+    assert response.status_code == 200
+
+    user_ids = [results[0]["id"], results[1]["id"]]
+    lines = [
+        json.dumps({"name": "Bulk A", "user_ids": user_ids}),
+        "not json",
+        json.dumps({"name": "Bulk B", "user_ids": [999999, existing["id"], existing["id"]]}),
+        json.dumps({"name": "Bulk C", "user_ids": [999999]}),
+    ]
+    response = await async_client.post(
+        "/chats/bulk", content="\n".join(lines) + "\n", headers={"Content-Type": "application/x-ndjson"}
+    )
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert [r["index"] for r in results] == [0, 1, 2, 3]
+    assert "error" in results[1] and results[3]["error"] == "Users not found"
+    assert results[2]["user_ids"] == [existing["id"]]
+    assert membership_cache.get_members(results[0]["id"]) == set(user_ids)
+
+    user1_token = (await async_client.post("/token", data={"username": "bulk1", "password": "secret1"})).json()["access_token"]
+    async with ASGIWebSocketClient(app, f"/ws/{results[0]['id']}", f"token={user1_token}") as ws:
+        await ws.send_json({"text": "provisioned"})
+        assert (await ws.receive_json())["text"] == "provisioned"
+
+    response = await async_client.post("/chats/bulk", json={"name": "not a list"})
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_batch_and_compress_are_negotiated_at_connect(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "batchuser")
+    chat_id = (await async_client.post("/chats/", json={"name": "Batch", "user_ids": [user1["id"]]})).json()["id"]
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}&batch=1&compress=deflate") as ws:
+        await ws.send_json({"text": "short"})
+        assert [m["text"] for m in await ws.receive_json()] == ["short"]
+        await ws.send_json({"text": "long " * 200})
+        frame = await ws.receive()
+        assert json.loads(zlib.decompress(frame["bytes"], -zlib.MAX_WBITS))[0]["text"] == "long " * 200
+
+    with pytest.raises(WebSocketRejected):
+        async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}&codec=msgpack&compress=deflate"):
+            pass
+
+
+@pytest.mark.asyncio
+async def test_unread_counters_follow_messages_and_read_position(async_client: AsyncClient):
+    user1, token1 = await create_user_with_token(async_client, "unread1")
+    user2, token2 = await create_user_with_token(async_client, "unread2")
+    chat_id = (await async_client.post("/chats/", json={
+        "name": "Unread", "user_ids": [user1["id"], user2["id"]]
+    })).json()["id"]
+    other_id = (await async_client.post("/chats/", json={"name": "Empty", "user_ids": [user2["id"]]})).json()["id"]
+    headers = {"Authorization": f"Bearer {token2}"}
+
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}") as ws1:
+        await ws1.send_json({"text": "one"})
+        first = await ws1.receive_json()
+        response = await async_client.get("/me/unread", headers=headers)
+        assert response.json() == {"chats": [{"chat_id": chat_id, "unread": 1}, {"chat_id": other_id, "unread": 0}],
+                                   "total": 1}
+        # Дальше счётчик растёт в памяти, без запроса к БД
+        loads = unread_counters.loads
+        for text in ("two", "three"):
+            await ws1.send_json({"text": text})
+            last = await ws1.receive_json()
+        assert (await async_client.get("/me/unread", headers=headers)).json()["total"] == 3
+        assert unread_counters.loads == loads
+
+        async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token2}") as ws2:
+            await ws2.send_json({"action": "read", "up_to": first["id"]})
+            await ws2.send_json({"text": "my own"})
+            await ws2.receive_json()
+            await asyncio.sleep(0.1)
+            assert (await async_client.get("/me/unread", headers=headers)).json()["total"] == 2
+            await ws2.send_json({"action": "read", "up_to": last["id"]})
+            await asyncio.sleep(0.1)
+    assert (await async_client.get("/me/unread", headers=headers)).json()["total"] == 0
+    sender = (await async_client.get("/me/unread", headers={"Authorization": f"Bearer {token1}"})).json()
+    assert sender["total"] == 1
+
+
+@pytest.mark.asyncio
+async def test_traces_attribute_time_to_db_bcrypt_and_broadcast(async_client: AsyncClient, monkeypatch):
+    monkeypatch.setattr(tracer, "sample_rate", 1.0)
+    tracer.clear()
+    user1, token1 = await create_user_with_token(async_client, "traceuser")
+    chat_id = (await async_client.post("/chats/", json={"name": "Traced", "user_ids": [user1["id"]]})).json()["id"]
+    async with ASGIWebSocketClient(app, f"/ws/{chat_id}", f"token={token1}") as ws:
+        await ws.send_json({"text": "traced"})
+        await ws.receive_json()
+
+    response = await async_client.get("/debug/traces", params={"format": "otlp"})
+    spans = response.json()["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    by_trace = {}
+    for span in spans:
+        by_trace.setdefault(span["traceId"], []).append(span["name"])
+    roots = {names[0]: names for names in by_trace.values()}
+    assert "bcrypt" in roots["POST /users/"] and "db" in roots["POST /users/"]
+    assert "POST /chats/" in roots
+    assert {"auth.get_current_user", "membership"} <= set(roots["ws.connect"])
+    assert {"MessageRepository.create_message", "db", "broadcast", "fanout"} <= set(roots["ws.message"])
+
+    chrome = (await async_client.get("/debug/traces")).json()
+    assert any(event["name"] == "ws.message" for event in chrome["traceEvents"])
+    tracer.clear()
+
+
+@pytest.mark.asyncio
+async def test_membership_cache_refills_after_expiry(async_client: AsyncClient, monkeypatch):
+    user1, _ = await create_user_with_token(async_client, "expiry1")
+    user2, _ = await create_user_with_token(async_client, "expiry2")
+    monkeypatch.setattr(membership_cache, "ttl", 0.05)
+    response = await async_client.post("/chats/", json={"name": "Expiry", "user_ids": [user1["id"], user2["id"]]})
+    chat_id = response.json()["id"]
+    await asyncio.sleep(0.06)
+    assert membership_cache.get_members(chat_id) is None
+
+    monkeypatch.setattr(membership_cache, "ttl", 60)
+    async with async_session() as session:
+        assert await membership_cache.is_member(session, chat_id, user1["id"])
+        assert membership_cache.get_members(chat_id) == {user1["id"], user2["id"]}
+    # Следующая проверка — из памяти, без сессии БД
+    assert not await membership_cache.is_member(None, chat_id, 10**9)
+
+
+@pytest.mark.asyncio
+async def test_watermark_is_clamped_to_archived_messages(async_client: AsyncClient, tmp_path):
+    store = ColdStore(str(tmp_path))
+    user1, _ = await create_user_with_token(async_client, "archivedreader")
+    chat_id = (await async_client.post("/chats/", json={"name": "Archived", "user_ids": [user1["id"]]})).json()["id"]
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=365)
+    async with async_session() as db:
+        messages = [Message(chat_id=chat_id, sender_id=user1["id"], text=f"m{i}", created_at=old) for i in range(3)]
+        db.add_all(messages)
+        await db.commit()
+        ids = sorted(message.id for message in messages)
+    # Все сообщения чата в холодном слое, в БД их нет
+    assert await archive_cold_messages(async_session, store, older_than_days=30) >= 3
+
+    async with async_session() as db:
+        repo = ReadStateRepository(db, cold=store)
+        assert await repo.advance_watermark(chat_id, user1["id"], ids[1]) == ids[1]
+        assert await repo.advance_watermark(chat_id, user1["id"], ids[-1] + 1000) == ids[-1]
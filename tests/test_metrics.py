@@ -0,0 +1,36 @@
+import pytest
+from app.metrics import Counter, Gauge, Histogram, Registry, observe_latency
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    counter = Counter("test_events_total", "Events", ["kind"], registry=registry)
+    counter.inc(labels=("a",))
+    counter.inc(2, ("a",))
+    Gauge("test_sockets", "Sockets per chat", ["chat_id"], function=lambda: {("7",): 3}, registry=registry)
+    histogram = Histogram("test_seconds", "Latency", buckets=(0.1, 1.0), registry=registry)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    text = registry.render()
+    assert "# TYPE test_events_total counter" in text
+    assert 'test_events_total{kind="a"} 3' in text
+    assert 'test_sockets{chat_id="7"} 3' in text
+    assert 'test_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_seconds_bucket{le="1"} 2' in text
+    assert 'test_seconds_bucket{le="+Inf"} 3' in text
+    assert "test_seconds_count 3" in text
+
+
+@pytest.mark.asyncio
+async def test_observe_latency_records_even_on_error():
+    histogram = Histogram("test_op_seconds", "Op latency", ["operation"], registry=None)
+
+    @observe_latency(histogram, "fail")
+    async def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        await fail()
+    assert histogram.count(("fail",)) == 1
@@ -0,0 +1,91 @@
+import asyncio
+import pytest
+from app.connection_manager import ConnectionManager
+from app.presence import PresenceTracker
+from app.pubsub import UnixSocketBus
+from tests.test_connection_manager import FakeWebSocket
+from tests.test_pubsub import wait_for
+
+
+async def wait_tick(tracker: PresenceTracker):
+    await asyncio.sleep(tracker.tick * 2)
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_presence_diffs_are_batched_per_tick_and_opt_in():
+    manager = ConnectionManager()
+    tracker = PresenceTracker(manager, tick_ms=20, typing_ttl=60)
+    alice, bob, legacy = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    await manager.connect(1, alice, 1, ephemeral=True)
+    await manager.connect(1, bob, 2, ephemeral=True)
+    await manager.connect(1, legacy, 3)
+    await wait_tick(tracker)
+    assert alice.sent == [{"action": "presence", "chat_id": 1, "online": [1, 2, 3], "offline": [],
+                           "typing": [], "stopped_typing": []}]
+    assert legacy.sent == []
+
+    # Повторные события набора только продлевают индикатор: в тик уходит один дифф
+    for _ in range(5):
+        tracker.set_typing(1, 2)
+    await wait_tick(tracker)
+    assert alice.sent[-1]["typing"] == [2]
+    assert len(alice.sent) == 2
+
+    # Уход пользователя гасит и его индикатор набора
+    manager.disconnect(1, bob)
+    await wait_tick(tracker)
+    assert alice.sent[-1] == {"action": "presence", "chat_id": 1, "online": [], "offline": [2],
+                              "typing": [], "stopped_typing": [2]}
+    assert tracker.snapshot(1) == {"action": "presence", "chat_id": 1, "online": [1, 3], "typing": []}
+    assert legacy.sent == []
+
+
+@pytest.mark.asyncio
+async def test_typing_indicator_expires_without_stop_event():
+    manager = ConnectionManager()
+    tracker = PresenceTracker(manager, tick_ms=10, typing_ttl=0.05)
+    alice = FakeWebSocket()
+    await manager.connect(1, alice, 1, ephemeral=True)
+    tracker.set_typing(1, 1)
+    await wait_tick(tracker)
+    assert alice.sent[-1]["typing"] == [1]
+
+    await asyncio.sleep(0.1)
+    await wait_tick(tracker)
+    assert alice.sent[-1]["stopped_typing"] == [1]
+    assert tracker.typing == {}
+
+
+@pytest.mark.asyncio
+async def test_presence_is_aggregated_across_workers(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    worker_a, worker_b = ConnectionManager(bus=UnixSocketBus(path)), ConnectionManager(bus=UnixSocketBus(path))
+    await worker_a.start()
+    await worker_b.start()
+    tracker_a = PresenceTracker(worker_a, tick_ms=20, typing_ttl=60)
+    tracker_b = PresenceTracker(worker_b, tick_ms=20, typing_ttl=60)
+    try:
+        alice, bob_a, bob_b = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        await worker_a.connect(1, alice, 1, ephemeral=True)
+        await worker_a.connect(1, bob_a, 2)
+        await worker_b.connect(1, bob_b, 2, ephemeral=True)
+        await wait_for(lambda: tracker_b.snapshot(1)["online"] == [1, 2])
+        assert tracker_a.snapshot(1)["online"] == [1, 2]
+
+        tracker_b.set_typing(1, 2)
+        await wait_for(lambda: any(2 in event.get("typing", ()) for event in alice.sent))
+
+        # Второе устройство bob открыто на другом воркере: закрытие первого не делает его offline
+        worker_a.disconnect(1, bob_a)
+        await wait_tick(tracker_a)
+        await wait_tick(tracker_a)
+        assert not any(2 in event.get("offline", ()) for event in alice.sent)
+
+        worker_b.disconnect(1, bob_b)
+        await wait_for(lambda: any(2 in event.get("offline", ()) for event in alice.sent))
+        assert tracker_a.snapshot(1) == {"action": "presence", "chat_id": 1, "online": [1], "typing": []}
+    finally:
+        await worker_b.stop()
+        await worker_a.stop()
@@ -0,0 +1,135 @@
+import asyncio
+import pytest
+from app.connection_manager import ConnectionManager
+from app.membership import MembershipCache
+from app.metrics import BROADCAST_SECONDS, BUS_PUBLISH_SECONDS
+from app.pubsub import UnixSocketBus
+from tests.test_connection_manager import FakeWebSocket
+
+
+async def wait_for(predicate, timeout: float = 2):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_unix_socket_bus_delivers_only_to_subscribed_workers(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    worker_a, worker_b, worker_c = UnixSocketBus(path), UnixSocketBus(path), UnixSocketBus(path)
+    received = {"a": [], "b": [], "c": []}
+    for name, bus in (("a", worker_a), ("b", worker_b), ("c", worker_c)):
+        bus.set_handler(lambda chat_id, message, key, name=name: received[name].append((chat_id, message, key)))
+        await bus.start()
+    try:
+        # Хабом становится ровно один воркер
+        assert sum(bus.hub is not None for bus in (worker_a, worker_b, worker_c)) == 1
+
+        worker_a.subscribe(1)
+        worker_b.subscribe(1)
+        worker_c.subscribe(2)
+        await wait_for(lambda: len(next(b for b in (worker_a, worker_b, worker_c) if b.hub).hub.subscribers.get(1, ())) == 2)
+
+        await worker_a.publish(1, {"text": "hi"}, key="k")
+        await wait_for(lambda: received["b"])
+
+        assert received["a"] == [(1, {"text": "hi"}, "k")]
+        assert received["b"] == [(1, {"text": "hi"}, "k")]
+        await asyncio.sleep(0.05)
+        assert received["c"] == []
+    finally:
+        for bus in (worker_c, worker_b, worker_a):
+            await bus.stop()
+
+
+async def _start_pair(path: str):
+    worker_a, worker_b = UnixSocketBus(path), UnixSocketBus(path)
+    received = []
+    worker_b.set_handler(lambda chat_id, message, key: received.append(len(message["text"])))
+    await worker_a.start()
+    await worker_b.start()
+    worker_b.subscribe(1)
+    hub = worker_a.hub or worker_b.hub
+    await wait_for(lambda: hub.subscribers.get(1))
+    return worker_a, worker_b, received
+
+
+@pytest.mark.asyncio
+async def test_unix_socket_bus_delivers_events_larger_than_stream_default(tmp_path):
+    worker_a, worker_b, received = await _start_pair(str(tmp_path / "bus.sock"))
+    try:
+        for size in (100, 100_000, 10):
+            await worker_a.publish(1, {"text": "x" * size})
+        await wait_for(lambda: len(received) == 3)
+        assert received == [100, 100_000, 10]
+    finally:
+        await worker_b.stop()
+        await worker_a.stop()
+
+
+@pytest.mark.asyncio
+async def test_oversized_event_is_skipped_without_dropping_connection(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.pubsub.CHAT_BUS_MAX_LINE_BYTES", 1000)
+    worker_a, worker_b, received = await _start_pair(str(tmp_path / "bus.sock"))
+    try:
+        # Строку длиннее предела отправитель не шлёт, а хаб (если она всё же пришла) пропускает
+        await worker_a.publish(1, {"text": "x" * 2000})
+        worker_a._writer.write(b'{"op": "pub", "chat_id": 1, "message": {"text": "' + b"y" * 2000 + b'"}}\n')
+        await worker_a.publish(1, {"text": "x" * 10})
+        await wait_for(lambda: received)
+        await asyncio.sleep(0.05)
+        assert received == [10]
+    finally:
+        await worker_b.stop()
+        await worker_a.stop()
+
+
+@pytest.mark.asyncio
+async def test_member_removal_reaches_worker_without_sockets(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    cache_a, cache_b = MembershipCache(ttl=60), MembershipCache(ttl=60)
+    worker_a = ConnectionManager(bus=UnixSocketBus(path), membership=cache_a)
+    worker_b = ConnectionManager(bus=UnixSocketBus(path), membership=cache_b)
+    await worker_a.start()
+    await worker_b.start()
+    try:
+        # Воркер A проверял доступ к чату по HTTP, но сокетов чата у него нет
+        cache_a.set_members(1, {1, 2})
+        cache_b.set_members(1, {1, 2})
+        await asyncio.sleep(0.1)
+        await worker_b.broadcast(1, {"action": "member_left", "chat_id": 1, "user_id": 2})
+        await wait_for(lambda: cache_a.get_members(1) == {1})
+
+        # Чат выпал из кэша — подписка больше не нужна
+        cache_a.invalidate(1)
+        assert 1 not in worker_a.bus.subscriptions
+    finally:
+        await worker_b.stop()
+        await worker_a.stop()
+
+
+@pytest.mark.asyncio
+async def test_fanout_latency_is_observed_where_event_is_delivered(tmp_path):
+    path = str(tmp_path / "bus.sock")
+    worker_a, worker_b = ConnectionManager(bus=UnixSocketBus(path)), ConnectionManager(bus=UnixSocketBus(path))
+    await worker_a.start()
+    await worker_b.start()
+    try:
+        websocket = FakeWebSocket()
+        await worker_b.connect(1, websocket, user_id=1)
+        hub = worker_a.bus.hub or worker_b.bus.hub
+        await wait_for(lambda: hub.subscribers.get(1))
+        fanouts, publishes = BROADCAST_SECONDS.count(), BUS_PUBLISH_SECONDS.count()
+
+        # У воркера A нет сокетов чата: он только публикует, раздачу по сокетам делает B
+        await worker_a.broadcast(1, {"id": 1})
+        await wait_for(lambda: websocket.sent)
+        assert BUS_PUBLISH_SECONDS.count() == publishes + 1
+        assert BROADCAST_SECONDS.count() == fanouts + 1
+        worker_b.disconnect(1, websocket)
+    finally:
+        await worker_b.stop()
+        await worker_a.stop()
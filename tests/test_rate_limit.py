@@ -0,0 +1,29 @@
+from app.rate_limit import THROTTLED, FlowController
+
+
+def test_socket_bucket_refills_at_configured_rate():
+    flow = FlowController(socket_rate=2, socket_burst=2, user_rate=0, chat_rate=0)
+    assert flow.acquire("ws", 1, 1, now=0.0) is None
+    assert flow.acquire("ws", 1, 1, now=0.0) is None
+    throttled = flow.acquire("ws", 1, 1, now=0.0)
+    assert throttled.scope == "socket"
+    assert throttled.retry_after == 0.5
+    assert throttled.error()["code"] == "rate_limited"
+    assert flow.acquire("ws", 1, 1, now=0.5) is None
+
+
+def test_user_limit_spans_devices_and_rejection_does_not_spend_tokens():
+    flow = FlowController(socket_rate=100, socket_burst=100, user_rate=1, user_burst=2, chat_rate=0)
+    before = THROTTLED.value(("user",))
+    assert flow.acquire("phone", 1, 1, now=0.0) is None
+    assert flow.acquire("laptop", 1, 1, now=0.0) is None
+    assert flow.acquire("tablet", 1, 1, now=0.0).scope == "user"
+    assert THROTTLED.value(("user",)) == before + 1
+    # Другой пользователь в том же чате не затронут
+    assert flow.acquire("other", 2, 1, now=0.0) is None
+
+    flow = FlowController(socket_rate=1, socket_burst=1, user_rate=0, chat_rate=1, chat_burst=1)
+    assert flow.acquire("a", 1, 7, now=0.0) is None
+    # Чат исчерпан: жетон сокета "b" не списывается
+    assert flow.acquire("b", 2, 7, now=0.0).scope == "chat"
+    assert flow.acquire("b", 2, 8, now=0.0) is None
@@ -0,0 +1,26 @@
+from types import SimpleNamespace
+from app.search import InvertedIndex, tokenize
+
+
+def message(message_id: int, chat_id: int, text: str):
+    return SimpleNamespace(id=message_id, chat_id=chat_id, text=text)
+
+
+def test_tokenize_is_case_insensitive_and_unicode_aware():
+    assert tokenize("Привет, World! 42") == ["привет", "world", "42"]
+
+
+def test_inverted_index_matches_all_terms_and_paginates_by_rank():
+    index = InvertedIndex()
+    index.add(message(1, 1, "ignored: chat not indexed yet"))
+    index.index_chat(1, [message(2, 1, "release notes"), message(3, 1, "release release notes")])
+    index.index_chat(2, [message(4, 2, "release notes draft")])
+    index.add(message(5, 1, "notes about the release"))
+
+    assert index.search([1], "chat", 10) == []
+    hits = index.search([1, 2], "Release NOTES", 10)
+    assert [message_id for message_id, _ in hits] == [3, 2, 4, 5]
+    assert [message_id for message_id, _ in index.search([1], "release notes", 10)] == [3, 2, 5]
+
+    first_page = index.search([1], "release", 2)
+    assert [message_id for message_id, _ in index.search([1], "release", 2, after=(first_page[-1][1], first_page[-1][0]))] == [5]
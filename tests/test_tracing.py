@@ -0,0 +1,55 @@
+import asyncio
+import logging
+import pytest
+from app.tracing import Tracer
+
+
+@pytest.mark.asyncio
+async def test_spans_nest_through_contextvars_and_export():
+    tracer = Tracer(sample_rate=1.0)
+
+    @tracer.traced("repo")
+    async def repo_call():
+        db = tracer.start_span("db", statement="SELECT")
+        await asyncio.sleep(0)
+        db.finish()
+
+    with tracer.root("GET /x", path="/x") as root:
+        await repo_call()
+        # Параллельная задача наследует контекст и пишет в ту же трассу
+        await asyncio.create_task(repo_call())
+    assert tracer.start_span("outside") is None
+
+    (trace,) = tracer.finished
+    names = [span.name for span in trace.spans]
+    assert names == ["GET /x", "repo", "db", "repo", "db"]
+    repo, db = trace.spans[1], trace.spans[2]
+    assert repo.parent_id == root.span_id and db.parent_id == repo.span_id
+
+    chrome = tracer.export("chrome")["traceEvents"]
+    assert [event["name"] for event in chrome] == names and chrome[0]["ph"] == "X"
+    otlp = tracer.export("otlp")["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert {span["traceId"] for span in otlp} == {trace.trace_id}
+    assert "parentSpanId" not in otlp[0] and otlp[2]["parentSpanId"] == repo.span_id
+    assert otlp[0]["attributes"] == [{"key": "path", "value": {"stringValue": "/x"}}]
+
+
+def test_disabled_tracer_creates_nothing_and_unsampled_traces_are_dropped():
+    tracer = Tracer(sample_rate=0, slow_ms=0)
+    with tracer.root("event") as span:
+        assert span is None
+    tracer = Tracer(sample_rate=0.0, slow_ms=10_000)
+    with tracer.root("event"):
+        with tracer.span("db"):
+            pass
+    assert not tracer.finished
+
+
+def test_slow_root_is_logged_and_kept_despite_sampling(caplog, monkeypatch):
+    tracer = Tracer(sample_rate=0.0, slow_ms=0.001)
+    with caplog.at_level(logging.WARNING, logger="app.tracing"):
+        with tracer.root("ws.message"):
+            with tracer.span("bcrypt"):
+                sum(range(10000))
+    assert len(tracer.finished) == 1 and tracer.slow == 1
+    assert "slow ws.message" in caplog.text and "bcrypt=" in caplog.text
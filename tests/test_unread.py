@@ -0,0 +1,48 @@
+import asyncio
+import pytest
+from app.unread import UnreadCounters
+
+
+@pytest.mark.asyncio
+async def test_events_during_load_are_applied_to_loaded_counters():
+    counters = UnreadCounters()
+    release = asyncio.Event()
+
+    async def load():
+        await release.wait()
+        # Запрос увидел сообщения до id 10 включительно
+        return [(1, 3, 7, 10), (2, 0, 5, 5)]
+
+    task = asyncio.create_task(counters.get(42, load))
+    await asyncio.sleep(0)
+    counters.on_message(1, 99, 10)  # уже учтено запросом
+    counters.on_message(1, 99, 11)
+    counters.on_message(2, 42, 6)  # собственное сообщение не считается
+    release.set()
+    assert await task == {1: 4, 2: 0}
+
+    counters.on_message(2, 99, 7)
+    counters.on_read(1, 42, 11)
+    assert await counters.get(42, load) == {1: 0, 2: 1}
+    assert counters.loads == 1 and counters.hits == 1
+
+
+@pytest.mark.asyncio
+async def test_partial_read_and_reconcile_reload_from_database():
+    counters = UnreadCounters(reconcile_seconds=60)
+    rows = [(1, 5, 0, 5)]
+
+    async def load():
+        return list(rows)
+
+    assert await counters.get(7, load) == {1: 5}
+    counters.on_read(1, 7, 2)
+    rows[:] = [(1, 3, 2, 5)]
+    assert await counters.get(7, load) == {1: 3}
+    assert counters.loads == 2
+
+    counters.reconcile_seconds = 0
+    counters.invalidate_users([7])
+    await counters.get(7, load)
+    await counters.get(7, load)
+    assert counters.loads == 4
@@ -0,0 +1,58 @@
+import asyncio
+import pytest
+from sqlalchemy.future import select
+from app.database import engine, async_session
+from app.models import Base, Chat, Message, User
+from app.repositories import DuplicateMessageError
+from app.write_batcher import MessageWriteBatcher
+
+
+@pytest.mark.asyncio
+async def test_batcher_groups_concurrent_messages_into_one_insert():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with async_session() as session:
+        user = User(username="batchuser", email="batchuser@example.com", password="x")
+        chat = Chat(name="Batch Chat", users=[user])
+        session.add(chat)
+        await session.commit()
+        chat_id, user_id = chat.id, user.id
+
+    batcher = MessageWriteBatcher(max_delay_ms=1000, max_size=3)
+    messages = await asyncio.gather(*(batcher.submit(chat_id, user_id, f"m{i}") for i in range(3)))
+
+    assert [m.text for m in messages] == ["m0", "m1", "m2"]
+    assert messages[0].id < messages[1].id < messages[2].id
+    assert all(m.created_at is not None and m.is_read is False for m in messages)
+    stats = batcher.stats()
+    assert stats["batches"] == 1 and stats["max_batch"] == 3
+
+    # Неполная пачка уходит по таймеру; строка с несуществующим чатом не ломает соседей
+    batcher = MessageWriteBatcher(max_delay_ms=5, max_size=100)
+    good, bad = await asyncio.gather(
+        batcher.submit(chat_id, user_id, "ok"),
+        batcher.submit(chat_id + 1000, user_id, "broken"),
+        return_exceptions=True,
+    )
+    assert isinstance(good, Message) and isinstance(bad, Exception)
+
+    # Повторы client_msg_id внутри пачки и относительно уже сохранённых строк
+    first, repeat_in_batch, plain = await asyncio.gather(
+        batcher.submit(chat_id, user_id, "keyed", "cid-1"),
+        batcher.submit(chat_id, user_id, "keyed", "cid-1"),
+        batcher.submit(chat_id, user_id, "plain"),
+        return_exceptions=True,
+    )
+    assert isinstance(first, Message) and first.client_msg_id == "cid-1"
+    assert isinstance(repeat_in_batch, DuplicateMessageError) and repeat_in_batch.message.id == first.id
+    assert isinstance(plain, Message)
+    with pytest.raises(DuplicateMessageError) as exc_info:
+        await batcher.submit(chat_id, user_id, "keyed", "cid-1")
+    assert exc_info.value.message.id == first.id
+
+    async with async_session() as session:
+        result = await session.execute(select(Message.text).where(Message.chat_id == chat_id).order_by(Message.id))
+        texts = result.scalars().all()
+        assert texts[:4] == ["m0", "m1", "m2", "ok"]
+        assert sorted(texts[4:]) == ["keyed", "plain"]
@@ -0,0 +1,62 @@
+import asyncio
+import json
+
+
+class WebSocketRejected(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"WebSocket closed with code {code}")
+        self.code = code
+
+
+class ASGIWebSocketClient:
+    """Минимальный WebSocket-клиент, который вызывает ASGI-приложение в том же event loop."""
+
+    def __init__(self, app, path: str, query_string: str = ""):
+        self.app = app
+        self.path = path
+        self.query_string = query_string
+        self._to_app: asyncio.Queue = asyncio.Queue()
+        self._from_app: asyncio.Queue = asyncio.Queue()
+        self._task = None
+
+    async def __aenter__(self):
+        scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "path": self.path,
+            "raw_path": self.path.encode(),
+            "root_path": "",
+            "query_string": self.query_string.encode(),
+            "headers": [],
+            "server": ("test", 80),
+            "client": ("testclient", 50000),
+            "subprotocols": [],
+        }
+        self._task = asyncio.create_task(self.app(scope, self._to_app.get, self._from_app.put))
+        await self._to_app.put({"type": "websocket.connect"})
+        message = await asyncio.wait_for(self._from_app.get(), timeout=5)
+        if message["type"] == "websocket.close":
+            await self._task
+            raise WebSocketRejected(message.get("code", 1000))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._to_app.put({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(self._task, timeout=5)
+
+    async def send_text(self, data: str):
+        await self._to_app.put({"type": "websocket.receive", "text": data})
+
+    async def send_bytes(self, data: bytes):
+        await self._to_app.put({"type": "websocket.receive", "bytes": data})
+
+    async def send_json(self, data):
+        await self.send_text(json.dumps(data))
+
+    async def receive(self, timeout: float = 5):
+        return await asyncio.wait_for(self._from_app.get(), timeout=timeout)
+
+    async def receive_json(self, timeout: float = 5):
+        message = await self.receive(timeout)
+        return json.loads(message.get("text") or message.get("bytes"))